@@ -14,7 +14,7 @@ from pyutils import MultilevelFormatter, AsyncTyper
 from pyutils.utils import set_config
 from blitzmodels import get_config_file, WGApiWoTBlitzTankopedia, Maps
 
-from .replays import upload, analyze
+from .replays import upload, analyze, pack, stats
 
 logger = logging.getLogger()
 error = logger.error
@@ -30,9 +30,13 @@ debug = logger.debug
 
 app = AsyncTyper()
 app.add_typer(analyze.app, name="analyze")
+app.add_typer(stats.app, name="stats")
 app.async_command(
     name="upload",
 )(upload.upload)
+app.async_command(
+    name="pack",
+)(pack.pack)
 
 
 ##############################################
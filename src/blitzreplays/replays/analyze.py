@@ -1,9 +1,21 @@
 import typer
 import sys
 from typer import Context, Option, Argument
-from typing import Annotated, Optional, List, Final, Tuple
-from asyncio import create_task, Task, sleep
+from typing import Annotated, AsyncIterator, Iterator, Optional, List, Final, Set, Tuple
+from asyncio import (
+    FIRST_COMPLETED,
+    Future,
+    create_task,
+    get_running_loop,
+    Task,
+    sleep,
+    to_thread,
+    wait,
+)
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
 import logging
+import multiprocessing
 from pathlib import Path
 from configparser import ConfigParser
 from alive_progress import alive_bar  # type: ignore
@@ -29,18 +41,27 @@ from blitzmodels import (
 )
 # from blitzmodels.wotinspector.wi_apiv1 import ReplayJSON
 
-from .args import EnumStatsTypes, read_param_list
+from .args import EnumStatsTypes, EnumJSONReader, read_param_list
+from .models_replay import HAS_ORJSON, ReplayHeader, read_bytes
+from .pack import ReplayPack, split_packs
+from .parallel import ANALYZE_BATCH, Partial, analyze_batch, init_analyze_worker
+from .plan import Plan, Values
+from .archive import iter_archive, split_archives, is_archive
+from .memory import items_fitting
+from .ratelimit import RateLimiter, rate_limit_file
+from .replay_filter import FILTER_FIELDS, ReplayFilter
+from .rows import HAS_PYARROW, RowExporter
+from .spill import ReplaySpill
+from .store import StatsStore
 from .models_reports import (
-    Category,
     EnrichedReplay,
     Fields,
     Reports,
-    ValueStore,
 )
 from .cache import (
     QueryCache,
     StatsCache,
-    StatsType,
+    StatsMode,
 )
 
 from .analyze_info import app as info_app, read_analyze_fields, read_analyze_reports
@@ -68,6 +89,10 @@ WG_RATE_LIMIT: float = 10.0  # 10/sec
 WG_REGION: Region = Region.eu
 WG_WORKERS: int = 5
 REPLAY_READERS: int = 3
+READ_CHUNK: int = 100  # replays read from a pack or an archive at a time
+REPLAY_SIZE_ESTIMATE: int = 64 * 1024  # raw JSON + parsed replay, bytes
+ENRICHED_REPLAY_SIZE_ESTIMATE: int = 256 * 1024  # enriched replay in memory, bytes
+MiB: int = 1024 * 1024
 
 REPORTS_DEFAULT: str = "default"
 FIELDS_DEFAULT: str = "default"
@@ -79,7 +104,6 @@ def callback_paths(value: Optional[list[Path]]) -> list[Path]:
 
 # TODO: change --fields to --field-sets
 # TODO: add --fields to set fields one by one
-# TODO: add --filter: a way to filter replays based on criterias
 @app.callback()
 def analyze(
     ctx: Context,
@@ -93,7 +117,10 @@ def analyze(
     ] = None,
     stats_type_param: Annotated[
         Optional[EnumStatsTypes],
-        Option("--stats-type", help="stats to use for player stats"),
+        Option(
+            "--stats-type",
+            help="stats to use for player stats. 'multi' provides player, tier ('tier_*') and tank ('tank_*') stats",
+        ),
     ] = None,
     fields_param: Annotated[
         Optional[str],
@@ -223,20 +250,107 @@ async def files(
         Optional[float],
         Option(show_default=False, help="WG API rate limit, default=10/sec"),
     ] = None,
+    wg_rate_limit_fn: Annotated[
+        Optional[Path],
+        Option(
+            "--wg-rate-limit-file",
+            show_default=False,
+            help="share WG API rate limit with other processes using the same file (default: WG.rate_limit_file config)",
+        ),
+    ] = None,
     export: Annotated[
-        bool, Option(help="export reports to a Tab-delimited text file")
+        bool, Option(help="export reports to a Tab-delimited or CSV text file")
     ] = False,
-    export_fn: Annotated[Path, Option("--filename", help="file to export to")] = Path(
-        "export.txt"
+    export_fn: Annotated[
+        Path,
+        Option("--filename", help="file to export to, CSV if the file ends with .csv"),
+    ] = Path("export.txt"),
+    json_reader: Annotated[
+        EnumJSONReader,
+        Option(
+            "--json-reader",
+            help="replay JSON reader: 'text' (aiofiles), 'bytes' or 'orjson' (requires orjson)",
+        ),
+    ] = EnumJSONReader.bytes,
+    spill_after: Annotated[
+        Optional[int],
+        Option(
+            "--spill-after",
+            min=0,
+            show_default=False,
+            help="spill replays to a temporary file after N replays in memory, 0=never (default: based on available memory)",
+        ),
+    ] = None,
+    queue_size: Annotated[
+        Optional[int],
+        Option(
+            "--queue-size",
+            min=1,
+            show_default=False,
+            help="max size of the replay and account queues (default: based on available memory)",
+        ),
+    ] = None,
+    stats_cache_fn: Annotated[
+        Optional[Path],
+        Option(
+            "--stats-cache",
+            show_default=False,
+            help="SQLite file to store player stats to (default: stats are kept in memory)",
+        ),
+    ] = None,
+    stats_cache_mem: Annotated[
+        Optional[int],
+        Option(
+            "--stats-cache-mem",
+            min=0,
+            show_default=False,
+            help="max memory (MiB) for player stats cache with --stats-cache, 0=no limit (default: based on available memory)",
+        ),
+    ] = None,
+    historical_stats: Annotated[
+        Optional[bool],
+        Option(
+            "--historical-stats/--latest-stats",
+            show_default=False,
+            help="use player stats nearest to the battle time from the stats cache history (default: latest stats)",
+        ),
+    ] = None,
+    analyze_workers: Annotated[
+        Optional[int],
+        Option(
+            "--analyze-workers",
+            min=1,
+            show_default=False,
+            help="number of processes to analyze replays with, 1=analyze in the main process (default: 1)",
+        ),
+    ] = None,
+    export_rows_fn: Annotated[
+        Optional[Path],
+        Option(
+            "--export-rows",
+            show_default=False,
+            help="export replay and player rows with stats to Parquet files FILE and FILE_players (requires pyarrow)",
+        ),
+    ] = None,
+    filter_exprs: Annotated[
+        Optional[List[str]],
+        Option(
+            "--filter",
+            show_default=False,
+            help=f"analyze only replays matching FIELD[=|!=|<|<=|>|>=]VALUE. Fields: {', '.join(FILTER_FIELDS)}. Dates as YYYY[-MM[-DD]] (UTC). Use several times to combine",
+        ),
+    ] = None,
+    replays: List[Path] = Argument(
+        help="replay files, directories, replay packs (*.wotbpack) or zip/tar archives to analyze",
+        callback=callback_paths,
     ),
-    replays: List[Path] = Argument(help="replays to upload", callback=callback_paths),
 ) -> None:
     """
     analyze replays from JSON files
     """
     tankopedia: WGApiWoTBlitzTankopedia
     maps: Maps
-    stats_type: StatsType
+    stats_type: StatsMode
     player: int
 
     try:
@@ -254,27 +368,156 @@ async def files(
         wg_rate_limit = set_config(
             config, WG_RATE_LIMIT, "WG", "rate_limit", wg_rate_limit
         )
+        wg_rate_limit_fn = rate_limit_file(config, "WG", wg_rate_limit_fn)
+        queue_size = set_config(
+            config,
+            items_fitting(REPLAY_SIZE_ESTIMATE),
+            "REPLAYS_ANALYZE",
+            "queue_size",
+            queue_size,
+        )
+        debug("queue_size=%d", queue_size)
+        spill_after = set_config(
+            config,
+            items_fitting(
+                ENRICHED_REPLAY_SIZE_ESTIMATE,
+                share=0.5,
+                min_items=1000,
+                max_items=1000000,
+            ),
+            "REPLAYS_ANALYZE",
+            "spill_after",
+            spill_after,
+        )
+        debug("spill_after=%d", spill_after)
+        if (
+            stats_cache := set_config(
+                config,
+                "",
+                "REPLAYS_ANALYZE",
+                "stats_cache",
+                str(stats_cache_fn) if stats_cache_fn else None,
+            )
+        ) != "":
+            stats_cache_fn = Path(stats_cache).expanduser()
+        debug("stats_cache=%s", str(stats_cache_fn))
+        stats_cache_mem = set_config(
+            config,
+            items_fitting(MiB, share=0.25, min_items=64, max_items=1 << 20),
+            "REPLAYS_ANALYZE",
+            "stats_cache_mem",
+            stats_cache_mem,
+        )
+        debug("stats_cache_mem=%d MiB", stats_cache_mem)
+        historical_stats = set_config(
+            config, False, "REPLAYS_ANALYZE", "historical_stats", historical_stats
+        )
+        debug("historical_stats=%s", str(historical_stats))
+        if historical_stats and stats_cache_fn is None:
+            message("--historical-stats requires --stats-cache to have stats history")
+        analyze_workers = set_config(
+            config, 1, "REPLAYS_ANALYZE", "analyze_workers", analyze_workers
+        )
+        debug("analyze_workers=%d", analyze_workers)
+        replay_filter: ReplayFilter | None = None
+        if filter_exprs:
+            try:
+                replay_filter = ReplayFilter.from_strs(filter_exprs, player=player)
+            except ValueError as err:
+                error(f"invalid --filter: {err}")
+                typer.Exit(code=3)
+                raise SystemExit(3)
+            debug("filter: %s", str(replay_filter))
 
     except KeyError as err:
         error(f"could not read all the arguments: {err}")
         typer.Exit(code=3)
         raise SystemExit(3)
 
+    if json_reader == EnumJSONReader.orjson and not HAS_ORJSON:
+        message("orjson is not installed, using '--json-reader bytes' instead")
+        json_reader = EnumJSONReader.bytes
+
+    if export_rows_fn is not None and not HAS_PYARROW:
+        error("--export-rows requires pyarrow: pip install 'blitz-replays[arrow]'")
+        typer.Exit(code=3)
+        raise SystemExit(3)
+
+    fields_all: Fields = ctx.obj["fields"]
+    fields_param: str | None
+    if (fields_param := ctx.obj["fields_param"]) is None:
+        fields_param = FIELDS_DEFAULT
+    fields: Fields = fields_all.with_config(read_param_list(fields_param))
+
+    reports_all: Reports = ctx.obj["reports"]
+    reports_param: str | None
+    if (reports_param := ctx.obj["reports_param"]) is None:
+        reports_param = REPORTS_DEFAULT
+    reports: Reports = reports_all.with_config(read_param_list(reports_param))
+
     stats = EventCounter("Analyze replays")
     fileQ = FileQueue(filter="*.wotbreplay.json", case_sensitive=False)
+    dataQ: IterableQueue[Tuple[str, bytes]] | None = None
     replayQ: IterableQueue[EnrichedReplay] = IterableQueue()
-    accountQ: IterableQueue[AccountId] = IterableQueue()
+    accountQ: IterableQueue[AccountId] = IterableQueue(maxsize=queue_size)
+    packs: List[Path]
+    archives: List[Path]
+    packs, replays = split_packs(replays)
+    archives, replays = split_archives(replays)
+    spill_fields: Set[str] = fields.get_fields() | reports.get_fields()
+    if export_rows_fn is not None:
+        spill_fields |= RowExporter.get_fields()
+    spill = ReplaySpill(fields=spill_fields, threshold=spill_after)
+    rows: RowExporter | None = None
 
-    wg_api = WGApi(app_id=wg_app_id, rate_limit=wg_rate_limit, default_region=region)
+    # requests are rate limited by rate_limiter shared by the stats workers
+    wg_api = WGApi(app_id=wg_app_id, rate_limit=0, default_region=region)
+    rate_limiter = RateLimiter("WG API", rate=wg_rate_limit, filename=wg_rate_limit_fn)
     query_cache = QueryCache()
+    # without --stats-cache the stats are not persisted
+    stats_store: StatsStore | None = (
+        StatsStore(stats_cache_fn) if stats_cache_fn is not None else None
+    )
     # TODO: add config file reading and set stats types accordingly
     stats_cache: StatsCache = StatsCache(
-        wg_api=wg_api, stats_type=stats_type, tankopedia=tankopedia
+        wg_api=wg_api,
+        stats_type=stats_type,
+        tankopedia=tankopedia,
+        store=stats_store,
+        max_bytes=stats_cache_mem * MiB,
+        historical=historical_stats,
+        rate_limiter=rate_limiter,
     )
     replay_readers: List[Task] = list()
     api_workers: List[Task] = list()
     try:
+        if stats_store is not None:
+            await stats_store.open()
+        await rate_limiter.open()
         create_task(fileQ.mk_queue(replays))
+        if len(packs) + len(archives) > 0:
+            dataQ = IterableQueue(maxsize=queue_size)
+            replay_readers.append(
+                create_task(bulk_read_worker(sources=packs + archives, dataQ=dataQ))
+            )
+            for _ in range(REPLAY_READERS):
+                replay_readers.append(
+                    create_task(
+                        replay_data_worker(
+                            dataQ=dataQ,
+                            replayQ=replayQ,
+                            accountQ=accountQ,
+                            query_cache=query_cache,
+                            stats_cache=stats_cache,
+                            tankopedia=tankopedia,
+                            maps=maps,
+                            player=player,
+                            json_reader=json_reader,
+                            spill=spill,
+                            replay_filter=replay_filter,
+                        )
+                    )
+                )
         for _ in range(REPLAY_READERS):
             replay_readers.append(
                 create_task(
@@ -287,6 +530,9 @@ async def files(
                         tankopedia=tankopedia,
                         maps=maps,
                         player=player,
+                        json_reader=json_reader,
+                        spill=spill,
+                        replay_filter=replay_filter,
                     )
                 )
             )
@@ -297,17 +543,19 @@ async def files(
         count: int = 0
         new: int = 0
         with alive_bar(total=None, title="Reading replays", enrich_print=False) as bar:
-            while not fileQ.is_done:
-                new = fileQ.count - count
+            while not (fileQ.is_done and (dataQ is None or dataQ.is_done)):
+                new = replays_read(fileQ, dataQ) - count
                 if new > 0:
                     bar(new)
                 count += new
                 await sleep(0.5)
-            if (new := fileQ.count - count) > 0:
+            if (new := replays_read(fileQ, dataQ) - count) > 0:
                 bar(new)
         await fileQ.join()  # all replays have been read now
-        verbose(f"replays found: {fileQ.count}")
-        if fileQ.count == 0:
+        if dataQ is not None:
+            await dataQ.join()
+        verbose(f"replays found: {replays_read(fileQ, dataQ)}")
+        if replays_read(fileQ, dataQ) == 0:
             error("no replays found")
             raise SystemExit
 
@@ -318,7 +566,7 @@ async def files(
         count = accountQ.count
         new = 0
         with alive_bar(
-            total=accountQ.qsize() + count,
+            total=stats_cache.accounts_queued,
             title="Fetching player stats",
             enrich_print=False,
         ) as bar:
@@ -333,27 +581,38 @@ async def files(
 
         await accountQ.join()
         await stats.gather_stats(api_workers)
-        stats_cache.fill_cache(query_cache)
-
-        fields_all: Fields = ctx.obj["fields"]
-        fields_param: str | None
-        if (fields_param := ctx.obj["fields_param"]) is None:
-            fields_param = FIELDS_DEFAULT
-        fields: Fields = fields_all.with_config(read_param_list(fields_param))
+        await stats_cache.fill_cache(query_cache)
+        verbose(stats_cache.cache_stats.print(do_print=False))
 
-        reports_all: Reports = ctx.obj["reports"]
-        reports_param: str | None
-        if (reports_param := ctx.obj["reports_param"]) is None:
-            reports_param = REPORTS_DEFAULT
-        reports: Reports = reports_all.with_config(read_param_list(reports_param))
-
-        await analyze_replays(
-            replayQ=replayQ,
-            stats_cache=stats_cache,
-            fields=fields,
-            reports=reports,
-            player=player,
-        )
+        if len(spill) > 0:
+            verbose(
+                f"replays spilled to disk: {len(spill)} ({spill.bytes / 2**20:.1f} MiB)"
+            )
+        if export_rows_fn is not None:
+            rows = RowExporter(export_rows_fn)
+        if analyze_workers > 1:
+            await analyze_replays_parallel(
+                replayQ=replayQ,
+                spill=spill,
+                stats_cache=stats_cache,
+                fields=fields,
+                reports=reports,
+                workers=analyze_workers,
+                rows=rows,
+            )
+        else:
+            await analyze_replays(
+                replayQ=replayQ,
+                spill=spill,
+                stats_cache=stats_cache,
+                fields=fields,
+                reports=reports,
+                player=player,
+                rows=rows,
+            )
+        if rows is not None:
+            rows.close()
+            verbose(f"exported {rows.rows} replay rows to {export_rows_fn}")
 
         reports.print(fields=fields)
         typer.echo()
@@ -366,11 +625,20 @@ async def files(
         for task in replay_readers + api_workers:
             task.cancel()
         await wg_api.close()
+        if stats_store is not None:
+            await stats_store.close()
+        await rate_limiter.close()
         sys.exit(1)
 
     except Exception as err:
         error(f"{type(err)}: {err}")
     finally:
+        if rows is not None:
+            rows.close()
+        spill.close()
+        if stats_store is not None:
+            await stats_store.close()
+        await rate_limiter.close()
         await wg_api.close()
 
 
@@ -407,33 +675,196 @@ async def analyze_replays(
     fields: Fields,
     reports: Reports,
     player: int = 0,
+    spill: ReplaySpill | None = None,
+    rows: RowExporter | None = None,
 ) -> EventCounter:
     """
-    Apply stats to replays and perform analysis
+    Apply stats to replays and perform analysis. Replays with stats are
+    exported to 'rows' if given
     """
     stats = EventCounter("Analyze")
+    # evaluate subexpressions shared by fields and reports once per replay
+    plan = Plan()
+    fields.compile(plan)
+    reports.compile(plan)
 
-    async for replay in replayQ:
+    async for replay in iter_replays(replayQ, spill):
         try:
             debug("analyzing replay: %s", replay.title)
             stats_cache.add_stats(replay)
-
-            categories: List[Category] = list()
-            for report in reports.reports:
-                if (cat := report.get_category(replay=replay)) is None:
-                    continue
-                categories.append(cat)
-
-            for field_key, field in fields.items():
-                value: ValueStore = field.calc(replay=replay)
-                for cat in categories:
-                    cat.record(field=field_key, value=value)
+            if rows is not None:
+                rows.add(replay)
+            values: Values = plan.evaluate(replay)
+            reports.record(replay, fields, values)
             debug("analysis done")
         except Exception as err:
             error(err)
     return stats
 
 
+async def analyze_replays_parallel(
+    replayQ: IterableQueue[EnrichedReplay],
+    stats_cache: StatsCache,
+    fields: Fields,
+    reports: Reports,
+    spill: ReplaySpill,
+    workers: int,
+    rows: RowExporter | None = None,
+) -> EventCounter:
+    """
+    Apply stats to replays and analyze them in 'workers' processes.
+
+    Stats are added in the main process. The replays are slimmed to the fields
+    needed for the analysis and sent to the workers in batches. Each worker
+    records the batch to its own copy of the reports and the partial results
+    are merged to 'reports'.
+    """
+    stats = EventCounter("Analyze")
+    loop = get_running_loop()
+    pending: Set[Future[Tuple[Partial, int]]] = set()
+    batch: List[EnrichedReplay] = list()
+
+    def merge(done: Set[Future[Tuple[Partial, int]]]) -> None:
+        for task in done:
+            try:
+                partial, errors = task.result()
+                reports.merge(partial)
+                stats.log("errors", errors)
+            except Exception as err:
+                error(f"analysis worker failed: {err}")
+                stats.log("worker errors")
+
+    # spawn: forking a process with a running event loop and threads is unsafe
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=init_analyze_worker,
+        initargs=(fields, reports),
+    ) as pool:
+        async for replay in iter_replays(replayQ, spill):
+            try:
+                stats_cache.add_stats(replay)
+                if rows is not None:
+                    rows.add(replay)
+                batch.append(spill.slim(replay))
+                stats.log("replays")
+            except Exception as err:
+                error(err)
+                stats.log("errors")
+                continue
+            if len(batch) < ANALYZE_BATCH:
+                continue
+            pending.add(loop.run_in_executor(pool, analyze_batch, batch))
+            batch = list()
+            # limit batches waiting in memory
+            if len(pending) >= 2 * workers:
+                done, pending = await wait(pending, return_when=FIRST_COMPLETED)
+                merge(done)
+        if len(batch) > 0:
+            pending.add(loop.run_in_executor(pool, analyze_batch, batch))
+        if len(pending) > 0:
+            done, _ = await wait(pending)
+            merge(done)
+    return stats
+
+
+async def iter_replays(
+    replayQ: IterableQueue[EnrichedReplay], spill: ReplaySpill | None = None
+) -> AsyncIterator[EnrichedReplay]:
+    """
+    Iterate over replays in memory and then the ones spilled to disk
+    """
+    async for replay in replayQ:
+        yield replay
+    if spill is not None:
+        for replay in spill:
+            yield replay
+
+
+def replays_read(
+    fileQ: FileQueue, dataQ: IterableQueue[Tuple[str, bytes]] | None = None
+) -> int:
+    """
+    Return the number of replays read from files, replay packs and archives
+    """
+    if dataQ is None:
+        return fileQ.count
+    return fileQ.count + dataQ.count
+
+
+async def process_replay(
+    replay: EnrichedReplay,
+    name: str,
+    stats: EventCounter,
+    replayQ: IterableQueue[EnrichedReplay],
+    accountQ: IterableQueue[AccountId],
+    query_cache: QueryCache,
+    stats_cache: StatsCache,
+    tankopedia: WGApiWoTBlitzTankopedia,
+    maps: Maps,
+    player: int = 0,
+    spill: ReplaySpill | None = None,
+    replay_filter: ReplayFilter | None = None,
+) -> None:
+    """
+    Enrich a replay, queue its players' stats and queue it for analysis.
+    The replay is spilled to disk if there are too many replays in memory.
+    Replays not matching 'replay_filter' are dropped before queuing the stats.
+    """
+    try:
+        if is_ok(
+            res := await replay.enrich(tankopedia=tankopedia, maps=maps, player=player)
+        ):
+            if replay_filter is not None and not replay_filter.match(replay):
+                stats.log("filtered")
+                return
+            await stats_cache.queue_stats(
+                replay, accountQ=accountQ, query_cache=query_cache
+            )
+            if spill is not None and spill.should_spill(replayQ.qsize()):
+                spill.put(replay)
+                stats.log("spilled")
+            else:
+                await replayQ.put(replay)
+            stats.log("OK")
+        elif is_err(res):
+            message(f"{res.err_value}: {name}")
+            stats.log("incomplete")
+    except Exception as err:
+        if logger.getEffectiveLevel() == logging.WARNING:  # normal
+            message(f"ERROR: could not process replay: {name}")
+        else:
+            verbose(
+                "could not process replay: %s: %s: %s",
+                name,
+                type(err),
+                err,
+            )
+        stats.log("processing errors")
+
+
+async def parse_replay(
+    name: str,
+    data: bytes,
+    stats_cache: StatsCache,
+    accountQ: IterableQueue[AccountId],
+    json_reader: EnumJSONReader = EnumJSONReader.bytes,
+    queue_accounts: bool = True,
+) -> EnrichedReplay | None:
+    """
+    Queue players' stats to be fetched based on the replay header and
+    parse the replay JSON while the stats are being fetched
+    """
+    if queue_accounts:
+        try:
+            await stats_cache.queue_accounts(
+                ReplayHeader.from_bytes(data).account_ids, accountQ=accountQ
+            )
+        except Exception as err:
+            debug("could not read replay header: %s: %s: %s", name, type(err), err)
+    return await to_thread(EnrichedReplay.parse_bytes, data, json_reader)
+
+
 async def replay_read_worker(
     fileQ: FileQueue,
     replayQ: IterableQueue[EnrichedReplay],
@@ -443,6 +874,9 @@ async def replay_read_worker(
     tankopedia: WGApiWoTBlitzTankopedia,
     maps: Maps,
     player: int = 0,
+    json_reader: EnumJSONReader = EnumJSONReader.bytes,
+    spill: ReplaySpill | None = None,
+    replay_filter: ReplayFilter | None = None,
 ) -> EventCounter:
     """
     Async worker to read and pre-process replay files
@@ -454,7 +888,26 @@ async def replay_read_worker(
         replay: EnrichedReplay | None = None
         try:
             stats.log("found")
-            if (replay := await EnrichedReplay.open_json(fn)) is None:
+            if replay_filter is not None and not replay_filter.match_name(fn.name):
+                stats.log("filtered")
+                continue
+            if json_reader == EnumJSONReader.text:
+                replay = await EnrichedReplay.read_json(fn, json_reader=json_reader)
+            else:
+                data: bytes = await to_thread(read_bytes, fn)
+                if replay_filter is not None and not replay_filter.match_header(data):
+                    stats.log("filtered")
+                    continue
+                replay = await parse_replay(
+                    fn.name,
+                    data,
+                    stats_cache=stats_cache,
+                    accountQ=accountQ,
+                    json_reader=json_reader,
+                    queue_accounts=replay_filter is None
+                    or not replay_filter.needs_replay,
+                )
+            if replay is None:
                 message(f"ERROR: could not read replay: {fn.name}")
                 stats.log("errors")
                 continue
@@ -463,31 +916,125 @@ async def replay_read_worker(
             debug("%s: %s", type(err), err)
             stats.log("errors")
             continue
+        await process_replay(
+            replay,
+            name=fn.name,
+            stats=stats,
+            replayQ=replayQ,
+            accountQ=accountQ,
+            query_cache=query_cache,
+            stats_cache=stats_cache,
+            tankopedia=tankopedia,
+            maps=maps,
+            player=player,
+            spill=spill,
+            replay_filter=replay_filter,
+        )
+
+    await replayQ.finish()
+    await accountQ.finish()
+    return stats
+
+
+def _read_chunk(
+    records: Iterator[Tuple[str, bytes]], size: int
+) -> List[Tuple[str, bytes]]:
+    return list(islice(records, size))
+
+
+async def iter_chunks(
+    records: Iterator[Tuple[str, bytes]], size: int = READ_CHUNK
+) -> AsyncIterator[Tuple[str, bytes]]:
+    """
+    Iterate over (name, data) records of a blocking reader reading 'size'
+    records at a time in a thread, so decompression does not block the event loop
+    """
+    while len(chunk := await to_thread(_read_chunk, records, size)) > 0:
+        for record in chunk:
+            yield record
+
+
+async def bulk_read_worker(
+    sources: List[Path], dataQ: IterableQueue[Tuple[str, bytes]]
+) -> EventCounter:
+    """
+    Async worker to read replays from replay packs and zip/tar archives
+    """
+    stats = EventCounter("replay packs & archives")
+    await dataQ.add_producer()
+    for source in sources:
         try:
-            if is_ok(
-                res := await replay.enrich(
-                    tankopedia=tankopedia, maps=maps, player=player
-                )
-            ):
-                await stats_cache.queue_stats(
-                    replay, accountQ=accountQ, query_cache=query_cache
-                )
-                await replayQ.put(replay)
-                stats.log("OK")
-            elif is_err(res):
-                message(f"{res.err_value}: {fn.name}")
-                stats.log("incomplete")
-        except Exception as err:
-            if logger.getEffectiveLevel() == logging.WARNING:  # normal
-                message(f"ERROR: could not process replay: {fn}")
+            debug("reading replays from: %s", str(source))
+            if is_archive(source):
+                async for name, data in iter_chunks(
+                    iter_archive(source, filter="*.wotbreplay.json")
+                ):
+                    await dataQ.put((name, data))
+                stats.log("archives read")
             else:
-                verbose(
-                    "could not process replay: %s: %s: %s",
-                    str(fn.name),
-                    type(err),
-                    err,
-                )
-            stats.log("processing errors")
+                async for name, data in iter_chunks(iter(ReplayPack(source))):
+                    await dataQ.put((name, data))
+                stats.log("packs read")
+        except Exception as err:
+            error(f"could not read replays from: {source}: {type(err)}: {err}")
+            stats.log("read errors")
+    await dataQ.finish()
+    return stats
+
+
+async def replay_data_worker(
+    dataQ: IterableQueue[Tuple[str, bytes]],
+    replayQ: IterableQueue[EnrichedReplay],
+    accountQ: IterableQueue[AccountId],
+    query_cache: QueryCache,
+    stats_cache: StatsCache,
+    tankopedia: WGApiWoTBlitzTankopedia,
+    maps: Maps,
+    player: int = 0,
+    json_reader: EnumJSONReader = EnumJSONReader.bytes,
+    spill: ReplaySpill | None = None,
+    replay_filter: ReplayFilter | None = None,
+) -> EventCounter:
+    """
+    Async worker to parse and pre-process replay JSON read from replay packs and archives
+    """
+    stats = EventCounter("replays")
+    await replayQ.add_producer()
+    await accountQ.add_producer()
+    async for name, data in dataQ:
+        stats.log("found")
+        if replay_filter is not None and not (
+            replay_filter.match_name(name) and replay_filter.match_header(data)
+        ):
+            stats.log("filtered")
+            continue
+        if (
+            replay := await parse_replay(
+                name,
+                data,
+                stats_cache=stats_cache,
+                accountQ=accountQ,
+                json_reader=json_reader,
+                queue_accounts=replay_filter is None or not replay_filter.needs_replay,
+            )
+        ) is None:
+            message(f"ERROR: could not read replay: {name}")
+            stats.log("errors")
+            continue
+        await process_replay(
+            replay,
+            name=name,
+            stats=stats,
+            replayQ=replayQ,
+            accountQ=accountQ,
+            query_cache=query_cache,
+            stats_cache=stats_cache,
+            tankopedia=tankopedia,
+            maps=maps,
+            player=player,
+            spill=spill,
+            replay_filter=replay_filter,
+        )
 
     await replayQ.finish()
     await accountQ.finish()
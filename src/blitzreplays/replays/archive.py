@@ -0,0 +1,101 @@
+import logging
+import tarfile
+import zipfile
+from fnmatch import fnmatch
+from pathlib import Path, PurePosixPath
+from typing import Iterator, List, Tuple
+
+logger = logging.getLogger()
+error = logger.error
+message = logger.warning
+verbose = logger.info
+debug = logger.debug
+
+##############################################
+#
+## Replay archives (zip, tar)
+#
+##############################################
+
+ZIP_SUFFIXES: Tuple[str, ...] = (".zip",)
+TAR_SUFFIXES: Tuple[str, ...] = (
+    ".tar",
+    ".tar.gz",
+    ".tgz",
+    ".tar.bz2",
+    ".tbz2",
+    ".tar.xz",
+    ".txz",
+)
+
+
+def is_archive(filename: Path) -> bool:
+    """Test if the file is a supported archive by its suffix"""
+    name: str = filename.name.lower()
+    return name.endswith(ZIP_SUFFIXES) or name.endswith(TAR_SUFFIXES)
+
+
+def split_archives(paths: List[Path]) -> Tuple[List[Path], List[Path]]:
+    """
+    Split input paths into archives and other paths
+    """
+    archives: List[Path] = list()
+    others: List[Path] = list()
+    for path in paths:
+        if path.is_file() and is_archive(path):
+            archives.append(path)
+        else:
+            others.append(path)
+    return archives, others
+
+
+def member_name(name: str) -> str:
+    """Return the file name of an archive member without directories"""
+    return PurePosixPath(name.replace("\\", "/")).name
+
+
+def member_path(name: str) -> str:
+    """
+    Return the path of an archive member as a file name: directories are
+    joined to the name with '_'. Root, '.' and '..' components are dropped
+    """
+    return "_".join(
+        part
+        for part in PurePosixPath(name.replace("\\", "/")).parts
+        if part not in {"/", ".", ".."}
+    )
+
+
+def iter_archive(
+    filename: Path, filter: str, paths: bool = False
+) -> Iterator[Tuple[str, bytes]]:
+    """
+    Iterate over (name, content) of archive members matching 'filter'.
+
+    Members are read one by one without extracting the archive to disk.
+    Tar archives are read as a stream, i.e. sequentially. Matching is
+    case-insensitive and done against the member's file name. If 'paths' is
+    True, the members' paths in the archive are returned instead of file names.
+    """
+    pattern: str = filter.lower()
+    if filename.name.lower().endswith(ZIP_SUFFIXES):
+        with zipfile.ZipFile(filename, mode="r") as zf:
+            for info in zf.infolist():
+                if info.is_dir():
+                    continue
+                name: str = member_name(info.filename)
+                if not fnmatch(name.lower(), pattern):
+                    continue
+                yield info.filename if paths else name, zf.read(info)
+    elif filename.name.lower().endswith(TAR_SUFFIXES):
+        with tarfile.open(filename, mode="r|*") as tf:
+            for member in tf:
+                if not member.isfile():
+                    continue
+                name = member_name(member.name)
+                if not fnmatch(name.lower(), pattern):
+                    continue
+                if (f := tf.extractfile(member)) is not None:
+                    yield member.name if paths else name, f.read()
+    else:
+        raise ValueError(f"unsupported archive format: {filename}")
@@ -85,9 +85,17 @@ class EnumStatsTypes(StrEnum):
     player = "player"
     tier = "tier"
     tank = "tank"
+    multi = "multi"
+
+
+class EnumJSONReader(StrEnum):
+    text = "text"
+    bytes = "bytes"
+    orjson = "orjson"
 
 
 StatsType = Literal["player", "tier", "tank"]
+StatsMode = Literal["player", "tier", "tank", "multi"]
 StatsMeasure = Literal["wr", "avgdmg", "battles"]
 
 
@@ -1,5 +1,10 @@
 import logging
+import struct
+import sys
+from array import array
+from bisect import bisect_left
 from typing import (
+    Any,
     List,
     Self,
     Dict,
@@ -7,10 +12,12 @@ from typing import (
     Tuple,
     Optional,
     Iterable,
+    Iterator,
 )
 from abc import ABC, abstractmethod
 from pydantic import Field, model_validator, ConfigDict
-from asyncio import Lock
+from asyncio import Lock, sleep
+from time import time
 from pyutils import IterableQueue, EventCounter
 from pydantic_exportables import JSONExportable, JSONExportableRootDict, Idx
 
@@ -33,8 +40,12 @@ from .args import (
     # EnumGroupFilter,
     # EnumTeamFilter,
     StatsType,
+    StatsMode,
 )
 from .models_replay import PlayerStats, EnrichedReplay, stat_key
+from .ratelimit import RateLimiter
+from .retry import CircuitBreaker, RetryQueue
+from .store import HISTORY_KEYFRAME, LRUCache, StatsStore, StoreKind
 
 logger = logging.getLogger()
 error = logger.error
@@ -43,6 +54,17 @@ verbose = logger.info
 debug = logger.debug
 
 
+# stats types provided by '--stats-type multi'
+STATS_TYPES_MULTI: List[StatsType] = ["player", "tier", "tank"]
+
+CLAIM_POLL_INTERVAL: float = 1.0  # seconds
+
+# estimated in-memory sizes of cached API stats, bytes
+PLAYER_STAT_SIZE: int = 2 * 1024
+TANK_STATS_ARRAY_SIZE: int = 512
+TANK_STAT_SIZE: int = 21  # per tank
+
+
 class PlayerTankStat(TankStat):
     """Helper class for TankStatsDict to store individual player's tank stats"""
 
@@ -157,6 +179,151 @@ class TankStatsDict(JSONExportableRootDict[TankId, PlayerTankStat]):
         )
 
 
+class TankStatsArray:
+    """
+    Compact columnar storage for a player's tank stats.
+
+    Parallel arrays of tank_id, tier, battles, wins and damage_dealt sorted
+    by tank_id. Only the values needed for the analysis are stored.
+    """
+
+    __slots__ = ("account_id", "tank_ids", "tiers", "battles", "wins", "damage")
+
+    _HEADER = struct.Struct("<QI")  # account_id, number of tanks
+
+    def __init__(
+        self: Self,
+        account_id: AccountId,
+        rows: Iterable[Tuple[TankId, int, int, int]],
+        tank_tiers: Dict[TankId, int],
+    ):
+        """
+        'rows' are (tank_id, battles, wins, damage_dealt) tuples.
+        'tank_tiers' maps tank_id to tier (tankopedia)
+        """
+        self.account_id: AccountId = account_id
+        self.tank_ids: array = array("I")
+        self.tiers: array = array("B")
+        self.battles: array = array("I")
+        self.wins: array = array("I")
+        self.damage: array = array("Q")
+        for tank_id, battles, wins, damage in sorted(rows):
+            self.tank_ids.append(tank_id)
+            self.tiers.append(tank_tiers.get(tank_id, 0))
+            self.battles.append(battles)
+            self.wins.append(wins)
+            self.damage.append(damage)
+
+    def __len__(self) -> int:
+        return len(self.tank_ids)
+
+    @classmethod
+    def from_WGApiWoTBlitzTankStats(
+        cls,
+        account_id: AccountId,
+        api_stats: WGApiWoTBlitzTankStats,
+        tank_tiers: Dict[TankId, int],
+    ) -> "TankStatsArray":
+        rows: List[Tuple[TankId, int, int, int]] = list()
+        if api_stats.data is not None:
+            for tank_stats in api_stats.data.values():
+                if tank_stats is None:
+                    continue
+                for ts in tank_stats:
+                    rows.append(
+                        (ts.tank_id, ts.all.battles, ts.all.wins, ts.all.damage_dealt)
+                    )
+        return cls(account_id=account_id, rows=rows, tank_tiers=tank_tiers)
+
+    def to_bytes(self) -> bytes:
+        """Serialize to bytes (little-endian)"""
+        columns: List[array] = [self.tank_ids, self.battles, self.wins, self.damage]
+        if sys.byteorder == "big":
+            columns = [array(col.typecode, col) for col in columns]
+            for col in columns:
+                col.byteswap()
+        return self._HEADER.pack(self.account_id, len(self)) + b"".join(
+            col.tobytes() for col in columns
+        )
+
+    @classmethod
+    def from_bytes(cls, data: bytes, tank_tiers: Dict[TankId, int]) -> "TankStatsArray":
+        """Deserialize from bytes created with to_bytes()"""
+        account_id, count = cls._HEADER.unpack_from(data)
+        pos: int = cls._HEADER.size
+        columns: List[array] = list()
+        for typecode in ("I", "I", "I", "Q"):
+            col = array(typecode)
+            size: int = col.itemsize * count
+            col.frombytes(data[pos : pos + size])
+            if sys.byteorder == "big":
+                col.byteswap()
+            columns.append(col)
+            pos += size
+        return cls(account_id=account_id, rows=zip(*columns), tank_tiers=tank_tiers)
+
+    def rows(self) -> Iterator[Tuple[TankId, int, int, int]]:
+        """Iterate (tank_id, battles, wins, damage_dealt) rows"""
+        return zip(self.tank_ids, self.battles, self.wins, self.damage)
+
+    def diff(self, prev: "TankStatsArray") -> List[Tuple[TankId, int, int, int]] | None:
+        """
+        Return rows of tanks whose stats have changed since 'prev' with
+        the stats differences. Returns None if the stats cannot be
+        expressed as growth over 'prev' (e.g. tanks have been removed)
+        """
+        prev_rows: Dict[TankId, Tuple[int, int, int]] = {
+            tank_id: (battles, wins, damage)
+            for tank_id, battles, wins, damage in prev.rows()
+        }
+        res: List[Tuple[TankId, int, int, int]] = list()
+        for tank_id, battles, wins, damage in self.rows():
+            if (prev_row := prev_rows.pop(tank_id, None)) is not None:
+                battles -= prev_row[0]
+                wins -= prev_row[1]
+                damage -= prev_row[2]
+            if battles < 0 or wins < 0 or damage < 0:
+                return None
+            if battles > 0 or wins > 0 or damage > 0:
+                res.append((tank_id, battles, wins, damage))
+        if len(prev_rows) > 0:
+            return None
+        return res
+
+    def _mk_stats(
+        self, battles: int, wins: int, damage: int, tier: int = 0, tank_id: TankId = 0
+    ) -> PlayerStats:
+        ps = PlayerStats(account_id=self.account_id, tier=tier, tank_id=tank_id)
+        if battles > 0:
+            ps.battles = battles
+            ps.wr = wins / battles
+            ps.avgdmg = damage / battles
+        return ps
+
+    def get_player_stats(self) -> PlayerStats:
+        return self._mk_stats(sum(self.battles), sum(self.wins), sum(self.damage))
+
+    def get_tier_stats(self, tier: int) -> PlayerStats:
+        battles: int = 0
+        wins: int = 0
+        damage: int = 0
+        for t, b, w, d in zip(self.tiers, self.battles, self.wins, self.damage):
+            if t == tier:
+                battles += b
+                wins += w
+                damage += d
+        return self._mk_stats(battles, wins, damage, tier=tier)
+
+    def get_tank_stat(self, tank_id: TankId) -> PlayerStats:
+        idx: int = bisect_left(self.tank_ids, tank_id)
+        if idx < len(self) and self.tank_ids[idx] == tank_id:
+            return self._mk_stats(
+                self.battles[idx], self.wins[idx], self.damage[idx], tank_id=tank_id
+            )
+        debug("no tank stat for account_id=%d, tank_id=%d", self.account_id, tank_id)
+        return self._mk_stats(0, 0, 0, tank_id=tank_id)
+
+
 class StatsQuery(JSONExportable):
     """Class for defining player stats query"""
 
@@ -164,6 +331,7 @@ class StatsQuery(JSONExportable):
     account_id: AccountId = Field(default=...)
     tier: int = Field(default=0)
     tank_id: int = Field(default=0)
+    time: int = Field(default=0)  # resolve stats at time (epoch), 0 = latest
     key: str = Field(default="")
 
     model_config = ConfigDict(
@@ -181,7 +349,8 @@ class StatsQuery(JSONExportable):
                 account_id=self.account_id,
                 tier=self.tier,
                 tank_id=self.tank_id,
-            ),
+            )
+            + (f"@{self.time:x}" if self.time > 0 else ""),
         )
         if self.stats_type != "tier":
             self._set_skip_validation("tier", 0)
@@ -222,10 +391,259 @@ class APICache(ABC):
     """
 
     stats_type: StatsType
+    kind: StoreKind
 
-    def __init__(self: Self, wg_api: WGApi, **kwargs):
+    def __init__(
+        self: Self,
+        wg_api: WGApi,
+        store: StatsStore | None = None,
+        max_bytes: int = 0,
+        rate_limiter: RateLimiter | None = None,
+        **kwargs,
+    ):
+        """
+        'rate_limiter' limits the WG API requests. Without one the rate limit
+        of 'wg_api' is used.
+
+        Without a 'store' the stats are kept only in memory and 'max_bytes'
+        is not applied since evicted stats could not be read back.
+        """
         self._wg_api: WGApi = wg_api
+        self._rate_limiter: RateLimiter = (
+            rate_limiter if rate_limiter is not None else RateLimiter("WG API", rate=0)
+        )
+        self._store: StatsStore | None = store
         self._memcache_lock: Lock = Lock()
+        self._claimed: Set[AccountId] = set()
+        self._fresh: Set[AccountId] = set()
+        self._api_cache: LRUCache[AccountId | Tuple[AccountId, int], Any] = LRUCache(
+            max_bytes=max_bytes if store is not None else 0, sizeof=self.sizeof
+        )
+        self._retryQ: RetryQueue[Any] = RetryQueue()
+        self._breaker: CircuitBreaker = CircuitBreaker()
+
+    @property
+    def cache_stats(self) -> EventCounter:
+        """in-memory cache hit/miss/eviction stats"""
+        return self._api_cache.stats
+
+    @property
+    def store(self) -> StatsStore:
+        if self._store is None:
+            raise RuntimeError("no stats store")
+        return self._store
+
+    @abstractmethod
+    def sizeof(self, stats: Any) -> int:
+        """
+        estimate the in-memory size of cached stats in bytes
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def dump(self, stats: Any) -> bytes:
+        """
+        serialize stats for the store
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def load(self, data: bytes) -> Any | None:
+        """
+        deserialize stats read from the store
+        """
+        raise NotImplementedError
+
+    def diff(self, prev: Any, stats: Any) -> bytes | None:
+        """
+        serialize stats as a delta to 'prev' for the stats history.
+        Returns None to store a full snapshot
+        """
+        return None
+
+    def patch(self, stats: Any, delta: bytes) -> Any:
+        """
+        apply a delta created with diff() to stats
+        """
+        raise NotImplementedError
+
+    async def claim(self, account_id: AccountId) -> bool:
+        """
+        Claim an account for fetching. Returns False if the account has been
+        claimed already or there are up-to-date stats in the store.
+
+        If another process is fetching the account's stats, wait for it to
+        finish and use its results. Stats found up-to-date are used for the rest
+        of the run even if they expire before they are read.
+        """
+        async with self._memcache_lock:
+            if account_id in self._claimed:
+                return False
+            self._claimed.add(account_id)
+        if self._store is None:
+            return True
+        while not await self._store.has(self.kind, account_id):
+            if await self._store.claim(self.kind, account_id):
+                return True
+            debug("account_id=%d is being fetched by another process", account_id)
+            await sleep(CLAIM_POLL_INTERVAL)
+        self._fresh.add(account_id)
+        return False
+
+    def reset_claims(self) -> None:
+        """
+        Forget the accounts claimed so far. An account is claimed again
+        if its stats in the store have expired
+        """
+        self._claimed.clear()
+        self._fresh.clear()
+
+    async def reclaim(self, account_ids: Iterable[AccountId]) -> Set[AccountId]:
+        """
+        Refresh fetch claims of accounts before retrying them. Returns the accounts
+        still claimed: an expired claim may have been taken by another process
+        """
+        if self._store is None:
+            return set(account_ids)
+        res: Set[AccountId] = set()
+        for account_id in account_ids:
+            if await self._store.claim(self.kind, account_id):
+                res.add(account_id)
+            else:
+                debug("account_id=%d was claimed by another process", account_id)
+        return res
+
+    async def release(self, account_ids: Iterable[AccountId]) -> None:
+        """
+        Release fetch claims of accounts
+        """
+        if self._store is not None:
+            await self._store.release(self.kind, account_ids)
+
+    def api_error(self, stats: EventCounter) -> None:
+        """
+        Record a failed API request. Repeated failures pause the API requests
+        """
+        stats.log("API errors")
+        if self._breaker.failure():
+            stats.log("API pauses")
+
+    def retry(
+        self, item: Any, attempt: int, stats: EventCounter, accounts: int = 1
+    ) -> bool:
+        """
+        Schedule a retry of a failed 'item'. Returns False if there are no attempts left
+        """
+        if self._retryQ.put(item, attempt):
+            stats.log("API retries")
+            return True
+        stats.log("failed", accounts)
+        return False
+
+    async def get_cached(self, account_id: AccountId, at: int = 0) -> Any | None:
+        """
+        Get stats from the in-memory cache or the store.
+        If 'at' (epoch) is set, get the stats snapshot nearest to it.
+        Stats found up-to-date at claim() are read regardless of their age.
+        """
+        if at > 0 and (res := await self.get_snapshot(account_id, at)) is not None:
+            return res
+        if (res := self._api_cache.get(account_id)) is not None:
+            return res
+        if self._store is None:
+            return None
+        data: bytes | None
+        if account_id in self._fresh:
+            data = await self._store.get_latest(self.kind, account_id)
+        else:
+            data = await self._store.get(self.kind, account_id)
+        if data is not None:
+            if (res := self.load(data)) is not None:
+                self._api_cache.put(account_id, res)
+            return res
+        return None
+
+    async def get_snapshot(self, account_id: AccountId, at: int) -> Any | None:
+        """
+        Get the stats snapshot nearest to 'at' (epoch) from the stats history
+        """
+        if self._store is None:
+            return None
+        try:
+            if (
+                updated := await self._store.history_nearest(self.kind, account_id, at)
+            ) is None:
+                return None
+            return await self._history_snapshot(account_id, updated)
+        except Exception as err:
+            error(f"could not read stats history for account_id={account_id}: {err}")
+        return None
+
+    async def _history_snapshot(self, account_id: AccountId, updated: int) -> Any:
+        """
+        Rebuild the stats snapshot stored at 'updated' from the stats history
+        """
+        if (res := self._api_cache.get((account_id, updated))) is not None:
+            return res
+        records: List[Tuple[int, bytes]] = await self.store.get_history(
+            self.kind, account_id, updated
+        )
+        res = self.load(records[0][1])
+        for _, delta in records[1:]:
+            res = self.patch(res, delta)
+        if res is not None:
+            self._api_cache.put((account_id, updated), res)
+        return res
+
+    async def _history_record(
+        self, account_id: AccountId, stats: Any, updated: int
+    ) -> Tuple[AccountId, int, bytes]:
+        """
+        Create a stats history record as a delta to the latest snapshot in
+        the history or as a full snapshot every HISTORY_KEYFRAME records.
+
+        A snapshot stored at the same 'updated' time is replaced with
+        a full snapshot.
+        """
+        if (
+            (latest := await self.store.history_latest(self.kind, account_id))
+            is not None
+            and latest[0] < updated
+            and latest[1] < HISTORY_KEYFRAME
+            and (prev := await self._history_snapshot(account_id, latest[0]))
+            is not None
+            and (delta := self.diff(prev, stats)) is not None
+        ):
+            return account_id, latest[1] + 1, delta
+        if latest is not None and latest[0] == updated:
+            # the snapshot is replaced: update the cached copy
+            self._api_cache.put((account_id, updated), stats)
+        return account_id, 0, self.dump(stats)
+
+    async def cache_stats_many(self, stats: Dict[AccountId, Any]) -> None:
+        """
+        Add stats to the in-memory cache, the store and the stats history
+        """
+        for account_id, account_stats in stats.items():
+            self._api_cache.put(account_id, account_stats)
+        if self._store is None:
+            return None
+        self._fresh.update(stats.keys())
+        updated: int = int(time())
+        history: List[Tuple[AccountId, int, bytes]] = list()
+        for account_id, account_stats in stats.items():
+            history.append(
+                await self._history_record(account_id, account_stats, updated)
+            )
+        await self._store.put_history(self.kind, history, updated=updated)
+        await self._store.put_many(
+            self.kind,
+            [
+                (account_id, self.dump(account_stats))
+                for account_id, account_stats in stats.items()
+            ],
+            updated=updated,
+        )
 
     # @abstractmethod
     # async def queue_stats(
@@ -247,7 +665,7 @@ class APICache(ABC):
         raise NotImplementedError
 
     @abstractmethod
-    def get_stats(self, query: StatsQuery) -> PlayerStats:
+    async def get_stats(self, query: StatsQuery) -> PlayerStats:
         """
         get PlayerStats for account_id
         """
@@ -266,13 +684,16 @@ class PlayertatsAPICache(APICache):
     Cache player stats into memory or database backend for better search performance
     """
 
-    # TODO: add database cache
+    kind = "player"
 
-    def __init__(self: Self, wg_api: WGApi):
-        super().__init__(wg_api)
+    def sizeof(self, stats: PlayerStat) -> int:
+        return PLAYER_STAT_SIZE
 
-        self._api_cache: Dict[AccountId, PlayerStat | None] = dict()
-        self._stats_queries: Set[AccountId] = set()
+    def dump(self, stats: PlayerStat) -> bytes:
+        return stats.json_src().encode()
+
+    def load(self, data: bytes) -> PlayerStat | None:
+        return PlayerStat.parse_str(data.decode())
 
     async def stats_worker(self, accountQ: IterableQueue[AccountId]) -> EventCounter:
         """
@@ -286,42 +707,50 @@ class PlayertatsAPICache(APICache):
         for region in Region.API_regions():
             regionQ[region] = set()
 
-        has_stats: int = 0
-        no_stats: int = 0
         async for account_id in accountQ:
-            async with self._memcache_lock:
-                if account_id in self._api_cache:
+            try:
+                if not await self.claim(account_id):
+                    stats.log("stats cached")
                     continue
-                self._api_cache[account_id] = None
+            except Exception as err:
+                error(f"could not claim account_id={account_id}: {err}")
+                continue
 
             try:
                 region = Region.from_id(account_id)
                 regionQ[region].add(account_id)
                 if len(regionQ[region]) == 100:
-                    has_stats, no_stats = await self._fetch_api_stats(
-                        account_ids=regionQ[region], region=region
+                    await self._fetch_api_stats(
+                        account_ids=regionQ[region], region=region, stats=stats
                     )
-                    stats.log("stats found", has_stats)
-                    stats.log("no stats", no_stats)
                     regionQ[region] = set()
+                for (region, account_ids), attempt in self._retryQ.pop_due():
+                    await self._fetch_api_stats(account_ids, region, stats, attempt)
             except Exception as err:
                 error(f"{type(err)}: {err}")
 
         for region, account_ids in regionQ.items():
             if len(account_ids) > 0:
-                has_stats, no_stats = await self._fetch_api_stats(
-                    account_ids=regionQ[region], region=region
+                await self._fetch_api_stats(
+                    account_ids=regionQ[region], region=region, stats=stats
                 )
-                stats.log("stats found", has_stats)
-                stats.log("no stats", no_stats)
+        while (retry := await self._retryQ.get()) is not None:
+            (region, account_ids), attempt = retry
+            await self._fetch_api_stats(account_ids, region, stats, attempt)
         return stats
 
     async def _fetch_api_stats(
-        self, account_ids: Set[AccountId], region: Region
-    ) -> Tuple[int, int]:
+        self,
+        account_ids: Set[AccountId],
+        region: Region,
+        stats: EventCounter,
+        attempt: int = 0,
+    ) -> None:
         """
-        Actually fetch the player stats from WG API
-        Returns number of accounts that have / do not have stats
+        Actually fetch the player stats from WG API.
+
+        A failed batch is split in two and both halves are retried
+        with backoff to isolate accounts that make the request fail.
         """
         fields: List[str] = [
             "account_id",
@@ -333,31 +762,64 @@ class PlayertatsAPICache(APICache):
         player_stats: WGApiWoTBlitzAccountInfo | None
         psd: PlayerStatsDict
         has_stats: int = 0
-        no_stats: int = 0
+        retrying: Set[AccountId] = set()
 
-        if (
-            player_stats := await self._wg_api.get_account_info_full(
-                account_ids=list(account_ids),
-                region=region,
-                fields=fields,
-            )
-        ) is not None:
-            psd = PlayerStatsDict.from_WGApiWoTBlitzAccountInfo(player_stats)
-            for account_id in account_ids:
-                if account_id in psd:
-                    self._api_cache[account_id] = psd[account_id]
-                    has_stats += 1
-                    debug("player stats found for account_id=%d", account_id)
-                else:
-                    debug("player stats not found for account_id=%d", account_id)
-            no_stats += len(account_ids) - has_stats
-        else:
-            no_stats += len(account_ids)
-            if logger.level >= logging.DEBUG:
+        try:
+            if attempt > 0:
+                # the claims may have expired while waiting for the retry
+                account_ids = await self.reclaim(account_ids)
+                if len(account_ids) == 0:
+                    return None
+            await self._breaker.wait()
+            await self._rate_limiter.acquire()
+            if (
+                player_stats := await self._wg_api.get_account_info_full(
+                    account_ids=list(account_ids),
+                    region=region,
+                    fields=fields,
+                )
+            ) is None or player_stats.status != "ok":
+                debug("could not fetch player stats for %d accounts", len(account_ids))
+                retrying = self._retry_batch(account_ids, region, stats, attempt)
+            else:
+                self._breaker.success()
+                psd = PlayerStatsDict.from_WGApiWoTBlitzAccountInfo(player_stats)
+                found: Dict[AccountId, PlayerStat] = dict()
                 for account_id in account_ids:
-                    debug("player stats not found for account_id=%d", account_id)
+                    if account_id in psd:
+                        found[account_id] = psd[account_id]
+                        has_stats += 1
+                        debug("player stats found for account_id=%d", account_id)
+                    else:
+                        debug("player stats not found for account_id=%d", account_id)
+                await self.cache_stats_many(found)
+                stats.log("stats found", has_stats)
+                stats.log("no stats", len(account_ids) - has_stats)
+        except Exception as err:
+            error(f"could not fetch player stats: {type(err)}: {err}")
+            retrying = self._retry_batch(account_ids, region, stats, attempt)
+        finally:
+            await self.release(account_ids - retrying)
 
-        return (has_stats, no_stats)
+    def _retry_batch(
+        self,
+        account_ids: Set[AccountId],
+        region: Region,
+        stats: EventCounter,
+        attempt: int,
+    ) -> Set[AccountId]:
+        """
+        Split a failed batch in two and schedule retries.
+        Returns account_ids that will be retried.
+        """
+        res: Set[AccountId] = set()
+        self.api_error(stats)
+        ids: List[AccountId] = sorted(account_ids)
+        half: int = max(len(ids) // 2, 1)
+        for part in [set(ids[:half]), set(ids[half:])]:
+            if len(part) > 0 and self.retry((region, part), attempt, stats, len(part)):
+                res |= part
+        return res
 
         #     for player_stat in player_stats:
         #         key = stat_key(
@@ -376,16 +838,14 @@ class PlayertatsAPICache(APICache):
         #         res[key] = PlayerStats(account_id=account_id)
         # return res
 
-    def get_stats(self, query: StatsQuery) -> PlayerStats:
+    async def get_stats(self, query: StatsQuery) -> PlayerStats:
         """
         get PlayerStats for account_id
         """
         account_id: int = query.account_id
-        player_stats: PlayerStat | None = None
-        try:
-            player_stats = self._api_cache[account_id]
-        except KeyError:
-            pass
+        player_stats: PlayerStat | None = await self.get_cached(
+            account_id, at=query.time
+        )
 
         if player_stats is None:
             debug("query=%s: no player stats found", str(query))
@@ -401,18 +861,89 @@ class TankStatsAPICache(APICache):
     Cache tank stats into memory or database backend for better search performance
     """
 
-    # TODO: add database cache
+    kind = "tank"
 
-    def __init__(self: Self, wg_api: WGApi, tankopedia: WGApiWoTBlitzTankopedia):
-        super().__init__(wg_api)
+    def __init__(
+        self: Self,
+        wg_api: WGApi,
+        store: StatsStore | None,
+        tankopedia: WGApiWoTBlitzTankopedia,
+        max_bytes: int = 0,
+        rate_limiter: RateLimiter | None = None,
+    ):
+        super().__init__(
+            wg_api, store=store, max_bytes=max_bytes, rate_limiter=rate_limiter
+        )
         self._tankopedia: WGApiWoTBlitzTankopedia = tankopedia
-        self._api_cache: Dict[AccountId, TankStatsDict | None] = dict()
+        self._tank_tiers: Dict[TankId, int] = dict()
+        for tier in range(1, 11):
+            for tank_id in tankopedia.get_tank_ids_by_tier(tier=tier):
+                self._tank_tiers[tank_id] = tier
+
+    def sizeof(self, stats: TankStatsArray) -> int:
+        return TANK_STATS_ARRAY_SIZE + TANK_STAT_SIZE * len(stats)
+
+    def dump(self, stats: TankStatsArray) -> bytes:
+        return stats.to_bytes()
+
+    def load(self, data: bytes) -> TankStatsArray | None:
+        return TankStatsArray.from_bytes(data, tank_tiers=self._tank_tiers)
+
+    def diff(self, prev: TankStatsArray, stats: TankStatsArray) -> bytes | None:
+        if (rows := stats.diff(prev)) is None:
+            return None
+        return TankStatsArray(
+            account_id=stats.account_id, rows=rows, tank_tiers=dict()
+        ).to_bytes()
+
+    def patch(self, stats: TankStatsArray, delta: bytes) -> TankStatsArray:
+        rows: Dict[TankId, List[int]] = {
+            tank_id: [battles, wins, damage]
+            for tank_id, battles, wins, damage in stats.rows()
+        }
+        for tank_id, battles, wins, damage in TankStatsArray.from_bytes(
+            delta, tank_tiers=dict()
+        ).rows():
+            row: List[int] = rows.setdefault(tank_id, [0, 0, 0])
+            row[0] += battles
+            row[1] += wins
+            row[2] += damage
+        return TankStatsArray(
+            account_id=stats.account_id,
+            rows=[(tank_id, *row) for tank_id, row in rows.items()],  # type: ignore
+            tank_tiers=self._tank_tiers,
+        )
 
     async def stats_worker(self, accountQ: IterableQueue[AccountId]) -> EventCounter:
         """
         Async worker for fetching player stats into in-memory cache
         from WG tank-stats API or a DB backend
         """
+        stats = EventCounter("WG API")
+        async for account_id in accountQ:
+            try:
+                if not await self.claim(account_id):
+                    stats.log("stats cached")
+                    continue
+            except Exception as err:
+                error(f"could not claim account_id={account_id}: {err}")
+                continue
+
+            await self._fetch_api_stats(account_id, stats)
+            for account_id, attempt in self._retryQ.pop_due():
+                await self._fetch_api_stats(account_id, stats, attempt)
+
+        while (retry := await self._retryQ.get()) is not None:
+            account_id, attempt = retry
+            await self._fetch_api_stats(account_id, stats, attempt)
+        return stats
+
+    async def _fetch_api_stats(
+        self, account_id: AccountId, stats: EventCounter, attempt: int = 0
+    ) -> None:
+        """
+        Fetch tank stats of an account from WG API. Failed requests are retried with backoff
+        """
         fields: List[str] = [
             "account_id",
             "tank_id",
@@ -421,20 +952,23 @@ class TankStatsAPICache(APICache):
             "all.wins",
             "all.damage_dealt",
         ]
-        stats = EventCounter("WG API")
-        async for account_id in accountQ:
-            try:
-                async with self._memcache_lock:
-                    if account_id in self._api_cache:
-                        continue
-                    self._api_cache[account_id] = None
-
-                # TODO: Add support for DB stats cache
-                if (
-                    tank_stats := await self._wg_api.get_tank_stats_full(
-                        account_id, fields=fields
-                    )
-                ) is None or tank_stats.data is None:
+        retrying: bool = False
+        try:
+            if attempt > 0 and len(await self.reclaim([account_id])) == 0:
+                return None
+            await self._breaker.wait()
+            await self._rate_limiter.acquire()
+            if (
+                tank_stats := await self._wg_api.get_tank_stats_full(
+                    account_id, fields=fields
+                )
+            ) is None or tank_stats.status != "ok":
+                debug("could not fetch stats: account_id=%d", account_id)
+                self.api_error(stats)
+                retrying = self.retry(account_id, attempt, stats)
+            else:
+                self._breaker.success()
+                if tank_stats.data is None:
                     stats.log("no stats")
                     debug("no stats: account_id=%d", account_id)
                 else:
@@ -444,22 +978,29 @@ class TankStatsAPICache(APICache):
                         account_id,
                         len(tank_stats),
                     )
-                    self._api_cache[
-                        account_id
-                    ] = TankStatsDict.from_WGApiWoTBlitzTankStats(api_stats=tank_stats)
-
-            except Exception as err:
-                error(f"could not fetch stats for account_id={account_id}: {err}")
-        return stats
-
-    def get_stats(self, query: StatsQuery) -> PlayerStats:
+                    await self.cache_stats_many(
+                        {
+                            account_id: TankStatsArray.from_WGApiWoTBlitzTankStats(
+                                account_id=account_id,
+                                api_stats=tank_stats,
+                                tank_tiers=self._tank_tiers,
+                            )
+                        }
+                    )
+        except Exception as err:
+            error(f"could not fetch stats for account_id={account_id}: {err}")
+            self.api_error(stats)
+            retrying = self.retry(account_id, attempt, stats)
+        finally:
+            if not retrying:
+                await self.release([account_id])
+
+    async def get_stats(self, query: StatsQuery) -> PlayerStats:
         stats: PlayerStats | None = None
         account_id: int = query.account_id
-        tank_stats: TankStatsDict | None
-        try:
-            tank_stats = self._api_cache[account_id]
-        except KeyError:
-            tank_stats = None
+        tank_stats: TankStatsArray | None = await self.get_cached(
+            account_id, at=query.time
+        )
 
         if tank_stats is None:
             debug("query=%s: stats not found", str(query))
@@ -467,13 +1008,10 @@ class TankStatsAPICache(APICache):
             debug("query=%s: stats found", query)
             match query.stats_type:
                 case "player":
-                    # should never reach here, but...
+                    # used with '--stats-type multi'
                     stats = tank_stats.get_player_stats()
                 case "tier":
-                    stats = tank_stats.get_tank_stats(
-                        tank_ids=self._tankopedia.get_tank_ids_by_tier(tier=query.tier),
-                        tier=query.tier,
-                    )
+                    stats = tank_stats.get_tier_stats(tier=query.tier)
                 case "tank":
                     stats = tank_stats.get_tank_stat(tank_id=query.tank_id)
         if tank_stats is None or stats is None:
@@ -515,36 +1053,105 @@ class StatsCache:
         self: Self,
         wg_api: WGApi,
         # accountQ: IterableQueue[AccountId],
-        stats_type: StatsType,
+        stats_type: StatsMode,
         tankopedia: WGApiWoTBlitzTankopedia,
+        store: StatsStore | None,
+        max_bytes: int = 0,
+        historical: bool = False,
+        rate_limiter: RateLimiter | None = None,
     ):
-        """creator of StatsCache must add_producer() to the statsQ before calling __init__()"""
+        """
+        creator of StatsCache must add_producer() to the statsQ before calling __init__()
+
+        'multi' stats_type fetches tank stats once and provides player, tier and tank stats.
+        API stats are kept in memory up to 'max_bytes' (0 = no limit) and stored to 'store'.
+        Without a 'store' the stats are kept only in memory for the run.
+        If 'historical' is set, stats are resolved to the snapshot nearest to the battle time.
+        WG API requests are limited by 'rate_limiter' if given.
+        """
         # fmt:off
         self._stats_cache       : Dict[str, PlayerStats] = dict()
         # self._wg_api            : WGApi = wg_api
-        self._stats_type        : StatsType = stats_type
+        self._stats_type        : StatsMode = stats_type
+        self._stats_types       : List[StatsType] = STATS_TYPES_MULTI if stats_type == "multi" else [stats_type]
         self._api_cache         : APICache 
         # self._api_cache_tanks   : Dict[AccountId, TankStatsDict | None ] = dict()
         # self._api_cache_player  : Dict[AccountId, PlayerStatsDict | None ] = dict()
         # self._api_cache_lock    : Lock = Lock()
         self._tankopedia        : WGApiWoTBlitzTankopedia = tankopedia 
+        self._queued            : Set[AccountId] = set()
+        self._historical        : bool = historical
         # fmt: on
 
         match stats_type:
             case "player":
-                self._api_cache = PlayertatsAPICache(wg_api=wg_api)
+                self._api_cache = PlayertatsAPICache(
+                    wg_api=wg_api,
+                    store=store,
+                    max_bytes=max_bytes,
+                    rate_limiter=rate_limiter,
+                )
             case _:
                 self._api_cache = TankStatsAPICache(
-                    wg_api=wg_api, tankopedia=tankopedia
+                    wg_api=wg_api,
+                    store=store,
+                    tankopedia=tankopedia,
+                    max_bytes=max_bytes,
+                    rate_limiter=rate_limiter,
                 )
 
     @property
-    def stats_type(self) -> StatsType:
+    def stats_type(self) -> StatsMode:
         return self._stats_type
 
+    @property
+    def is_multi(self) -> bool:
+        """True if player, tier and tank stats are all used"""
+        return self._stats_type == "multi"
+
+    def query_time(self, replay: "EnrichedReplay") -> int:
+        """Time (epoch) to resolve the replay's stats at. 0 = latest"""
+        if self._historical:
+            return int(replay.battle_start_time.timestamp())
+        return 0
+
+    @property
+    def cache_stats(self) -> EventCounter:
+        """API stats in-memory cache hit/miss/eviction stats"""
+        return self._api_cache.cache_stats
+
+    @property
+    def accounts_queued(self) -> int:
+        """Number of unique account_ids queued for fetching stats"""
+        return len(self._queued)
+
     async def stats_worker(self, accountQ: IterableQueue[AccountId]) -> EventCounter:
         return await self._api_cache.stats_worker(accountQ)
 
+    def reset_queued(self) -> None:
+        """
+        Forget the accounts queued so far. The accounts are queued again and
+        their stats are fetched if the stats in the store have expired
+        """
+        self._queued.clear()
+        self._api_cache.reset_claims()
+
+    async def queue_accounts(
+        self, account_ids: Iterable[AccountId], accountQ: IterableQueue[AccountId]
+    ) -> int:
+        """
+        Put account_ids to a queue for a API worker to fetch those.
+        Each account_id is queued only once. Returns the number of accounts queued.
+        """
+        queued: int = 0
+        for account_id in account_ids:
+            if account_id in self._queued:
+                continue
+            self._queued.add(account_id)
+            await accountQ.put(account_id)
+            queued += 1
+        return queued
+
     async def queue_stats(
         self,
         replay: "EnrichedReplay",
@@ -553,33 +1160,40 @@ class StatsCache:
     ):
         """
         Put account_ids to a queue for a API worker to fetch those.
+        Each account_id is queued only once.
 
         Add specific stats queries requestesd to a set.
         """
-        for account_id in replay.allies + replay.enemies:
-            await accountQ.put(account_id)
+        players: List[AccountId] = replay.get_players()
+        await self.queue_accounts(players, accountQ=accountQ)
+        time: int = self.query_time(replay)
         stats_queries: Set[StatsQuery] = set()
-        for account_id in replay.get_players():
+        for account_id in players:
             try:
-                match self.stats_type:
-                    case "player":
-                        query = StatsQuery(
-                            stats_type=self.stats_type, account_id=account_id
-                        )
-                    case "tier":
-                        query = StatsQuery(
-                            stats_type=self.stats_type,
-                            account_id=account_id,
-                            tier=replay.battle_tier,
-                        )
-                    case "tank":
-                        tank_id: int = replay.get_player_data(account_id).vehicle_descr
-                        query = StatsQuery(
-                            stats_type=self.stats_type,
-                            account_id=account_id,
-                            tank_id=tank_id,
-                        )
-                stats_queries.add(query)
+                for stats_type in self._stats_types:
+                    match stats_type:
+                        case "player":
+                            query = StatsQuery(
+                                stats_type=stats_type, account_id=account_id, time=time
+                            )
+                        case "tier":
+                            query = StatsQuery(
+                                stats_type=stats_type,
+                                account_id=account_id,
+                                tier=replay.battle_tier,
+                                time=time,
+                            )
+                        case "tank":
+                            tank_id: int = replay.get_player_data(
+                                account_id
+                            ).vehicle_descr
+                            query = StatsQuery(
+                                stats_type=stats_type,
+                                account_id=account_id,
+                                tank_id=tank_id,
+                                time=time,
+                            )
+                    stats_queries.add(query)
             except KeyError as err:
                 error(f"no player data for account_id={account_id}: {type(err)} {err}")
             except Exception as err:
@@ -631,13 +1245,17 @@ class StatsCache:
     #             error(f"could not fetch stats for account_id={account_id}: {err}")
     #     return stats
 
-    def fill_cache(self: Self, query_cache: QueryCache):
+    async def fill_cache(self: Self, query_cache: QueryCache):
+        """
+        Fill the stats cache with stats for the queries.
+        Queries are sorted by account_id to reuse stats in the in-memory API cache.
+        """
         stats: PlayerStats | None
-        for query in query_cache:
+        for query in sorted(query_cache, key=lambda q: q.account_id):
             try:
                 debug("query=%s", str(query))
-                stats = self._api_cache.get_stats(query=query)
-                self._stats_cache[stats.key] = stats
+                stats = await self._api_cache.get_stats(query=query)
+                self._stats_cache[query.key] = stats
             except Exception as err:
                 error(f"query={query}: {type(err)}: {err}")
 
@@ -697,34 +1315,37 @@ class StatsCache:
         Add player stats to the replay
         """
         battle_tier: int = replay.battle_tier
+        time: int = self.query_time(replay)
         stats: PlayerStats
         for player_data in replay.players_dict.values():
             account_id: AccountId = player_data.dbid
             tank_id: TankId = player_data.vehicle_descr
-            try:
-                query = StatsQuery(
-                    stats_type=self.stats_type,
-                    account_id=account_id,
-                    tier=battle_tier,
-                    tank_id=tank_id,
-                )
-                stats = self._stats_cache[query.key]
+            for stats_type in self._stats_types:
+                try:
+                    query = StatsQuery(
+                        stats_type=stats_type,
+                        account_id=account_id,
+                        tier=battle_tier,
+                        tank_id=tank_id,
+                        time=time,
+                    )
+                    stats = self._stats_cache[query.key]
 
-            except Exception as err:
-                error(f"{type(err)}: {err}")
-                error(
-                    f"no {self.stats_type} stats in stats cache for account_id={account_id}, tier={battle_tier}, tank_id={tank_id}"
-                )
-                error("query=%s", str(query))  # type: ignore
+                except Exception as err:
+                    error(f"{type(err)}: {err}")
+                    error(
+                        f"no {stats_type} stats in stats cache for account_id={account_id}, tier={battle_tier}, tank_id={tank_id}"
+                    )
+                    error("query=%s", str(query))  # type: ignore
 
-                stats = PlayerStats.mk_zero(
-                    stats_type=self.stats_type,
-                    account_id=account_id,
-                    tier=battle_tier,
-                    tank_id=tank_id,
-                )
+                    stats = PlayerStats.mk_zero(
+                        stats_type=stats_type,
+                        account_id=account_id,
+                        tier=battle_tier,
+                        tank_id=tank_id,
+                    )
 
-            player_data.add_stats(stats)
+                player_data.add_stats(stats, multi=self.is_multi)
             # ic("add_stats", account_id, replay.players_dict[account_id].wr)
 
 
@@ -0,0 +1,72 @@
+import logging
+import os
+from pathlib import Path
+
+logger = logging.getLogger()
+error = logger.error
+message = logger.warning
+verbose = logger.info
+debug = logger.debug
+
+##############################################
+#
+## Memory helpers
+#
+##############################################
+
+_CGROUP_LIMITS: list[tuple[Path, Path]] = [
+    # cgroup v2
+    (Path("/sys/fs/cgroup/memory.max"), Path("/sys/fs/cgroup/memory.current")),
+    # cgroup v1
+    (
+        Path("/sys/fs/cgroup/memory/memory.limit_in_bytes"),
+        Path("/sys/fs/cgroup/memory/memory.usage_in_bytes"),
+    ),
+]
+
+
+def _read_int(filename: Path) -> int | None:
+    try:
+        return int(filename.read_text().strip())
+    except (OSError, ValueError):
+        return None
+
+
+def available_memory() -> int | None:
+    """
+    Return an estimate of the memory available for the process in bytes.
+
+    Container (cgroup) limits are taken into account. Returns None
+    if the available memory cannot be determined.
+    """
+    res: int | None = None
+    try:
+        res = os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        pass
+
+    for limit_fn, usage_fn in _CGROUP_LIMITS:
+        if (limit := _read_int(limit_fn)) is None:
+            continue
+        usage: int = _read_int(usage_fn) or 0
+        if limit < (1 << 60):  # 'max' or a huge number means no limit
+            cgroup_free: int = max(limit - usage, 0)
+            res = cgroup_free if res is None else min(res, cgroup_free)
+        break
+    debug("available memory: %s", str(res))
+    return res
+
+
+def items_fitting(
+    item_size: int,
+    share: float = 0.1,
+    min_items: int = 100,
+    max_items: int = 10000,
+    fallback: int = 1000,
+) -> int:
+    """
+    Return how many items of 'item_size' bytes fit in 'share' of the available memory
+    """
+    if (mem := available_memory()) is None:
+        return fallback
+    return max(min_items, min(max_items, int(mem * share) // max(item_size, 1)))
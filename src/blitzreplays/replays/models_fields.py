@@ -1,5 +1,8 @@
 import logging
 from typing import (
+    Any,
+    Callable,
+    Iterator,
     List,
     Self,
     Dict,
@@ -10,7 +13,10 @@ from typing import (
     Literal,
     Final,
 )
+from array import array
+from bisect import bisect_right
 from math import inf
+from operator import attrgetter, eq, gt, lt
 
 from abc import abstractmethod
 from dataclasses import dataclass, field as data_field
@@ -27,6 +33,8 @@ from .args import (
     PlayerFilter,
 )
 from .models_replay import EnrichedReplay
+from .plan import Plan, Values
+from .sketch import QuantileSketch
 
 logger = logging.getLogger()
 error = logger.error
@@ -44,6 +52,8 @@ class ValueStore:
     value: int | float = 0
     n: int | float = 0
 
+    removable: ClassVar[bool] = True  # recorded values can be removed
+
     # def get(self) -> Self:
     #     return self
 
@@ -51,10 +61,59 @@ class ValueStore:
         self.value += value.value
         self.n += value.n
 
+    def remove(self, value: Self):
+        """Remove values recorded earlier"""
+        self.value -= value.value
+        self.n -= value.n
+
+
+@dataclass
+class QuantileStore(ValueStore):
+    """
+    QuantileStore stores a cell's value and a quantile sketch of the recorded values
+    """
+
+    sketch: QuantileSketch = data_field(default_factory=QuantileSketch)
+
+    removable: ClassVar[bool] = False
+
+    def record(self, value: ValueStore):
+        super().record(value)
+        if isinstance(value, QuantileStore):
+            self.sketch.merge(value.sketch)
+
+
+@dataclass
+class HistogramStore(ValueStore):
+    """
+    HistogramStore stores a cell's value and counts of the recorded values per bin
+    """
+
+    counts: array = data_field(default_factory=lambda: array("q"))
+
+    def record(self, value: ValueStore):
+        super().record(value)
+        if isinstance(value, HistogramStore):
+            counts: array = self.counts
+            if len(counts) < len(value.counts):
+                counts.extend(array("q", bytes(8 * (len(value.counts) - len(counts)))))
+            for i, count in enumerate(value.counts):
+                if count:
+                    counts[i] += count
+
+    def remove(self, value: ValueStore):
+        super().remove(value)
+        if isinstance(value, HistogramStore):
+            for i, count in enumerate(value.counts):
+                if count:
+                    self.counts[i] -= count
+
 
 ValueType = Tuple[int | float, int | float]
 FieldKey = str
+FieldCalc = Callable[[EnrichedReplay, Values], ValueStore]
 PLAYER_FIELD_PREFIX: Final[str] = "player."
+_field_name_re: re.Pattern = compile(r"^(player\.)?[a-z_]+$")
 
 
 @dataclass
@@ -130,10 +189,16 @@ class ReportField:
             "hits_received",
             "hits_splash",
             "tank",
+            "tank_avgdmg",
+            "tank_battles",
             "tank_tier",
             "tank_type",
             "tank_nation",
             "tank_is_premium",
+            "tank_wr",
+            "tier_avgdmg",
+            "tier_battles",
+            "tier_wr",
             "time_alive",
             "shots_made",
             "shots_hit",
@@ -158,6 +223,18 @@ class ReportField:
     def calc(self, replay: EnrichedReplay) -> ValueStore:
         raise NotImplementedError
 
+    def compile(self, plan: Plan) -> FieldCalc:
+        """
+        Return a function calculating the field's value for a replay from
+        the values of the subexpressions the field adds to 'plan'.
+
+        Subclasses return closures with the attribute getters and the filter
+        bound in advance. The closures fall back to calc() if an attribute
+        is missing so errors are handled the same way.
+        """
+        calc = self.calc
+        return lambda replay, values: calc(replay)
+
     # @property
     # def key(self) -> FieldKey:
     #     if self.filter is None:
@@ -165,6 +242,16 @@ class ReportField:
     #     else:
     #         return "-".join([self.metric, self.fields, self.filter.key])
 
+    def get_fields(self) -> List[str]:
+        """
+        Return the replay and player ('player.' prefixed) fields the field uses
+        """
+        return [
+            field
+            for field in re.split(r"[/<=>]", self.fields)
+            if _field_name_re.match(field) is not None
+        ]
+
     def is_player_field(self, field: str) -> bool:
         """Test if the field is player field (True) or replay field (False)"""
         return field.startswith(PLAYER_FIELD_PREFIX)
@@ -216,6 +303,14 @@ class ReportField:
         else:
             return format(self.value(value=value), self.format)
 
+    def headers(self, export: bool = False) -> List[str]:
+        """Return the field's column headers"""
+        return [self.name]
+
+    def cells(self, value: ValueStore | str, export: bool = False) -> List[str]:
+        """Return the field's column values as formatted strings"""
+        return [self.print(value)]
+
 
 @dataclass
 class Fields:
@@ -226,6 +321,10 @@ class Fields:
     registry: ClassVar[Dict[str, Type[ReportField]]] = dict()
     field_sets: Dict[str, List[str]] = data_field(default_factory=dict)
     db: Dict[FieldKey, ReportField] = data_field(default_factory=dict)
+    _calcs: List[Tuple[FieldKey, FieldCalc]] = data_field(
+        default_factory=list, repr=False, compare=False
+    )
+    _plan: Plan = data_field(default_factory=Plan, repr=False, compare=False)
 
     @classmethod
     def register(cls, measure: Type[ReportField]):
@@ -304,6 +403,46 @@ class Fields:
         """Return the number of fields"""
         return len(self.db)
 
+    def __getstate__(self) -> Dict[str, Any]:
+        # compiled calculations are closures that cannot be pickled
+        state: Dict[str, Any] = self.__dict__.copy()
+        state["_calcs"] = list()
+        state["_plan"] = Plan()
+        return state
+
+    def compile(self, plan: Plan | None = None) -> None:
+        """
+        Compile the fields' calculations. See ReportField.compile().
+        Use the same 'plan' with Reports.compile() to share subexpressions.
+        """
+        self._plan = plan if plan is not None else Plan()
+        self._calcs = [
+            (key, field.compile(self._plan)) for key, field in self.db.items()
+        ]
+
+    def calc(
+        self, replay: EnrichedReplay, values: Values | None = None
+    ) -> Iterator[Tuple[FieldKey, ValueStore]]:
+        """
+        Calculate the values of all the fields for a replay. 'values' are
+        the evaluated subexpressions of the plan the fields were compiled with.
+        The fields have to be compiled first
+        """
+        assert len(self._calcs) == len(self.db), "fields have not been compiled"
+        if values is None:
+            values = self._plan.evaluate(replay)
+        for key, calc in self._calcs:
+            yield key, calc(replay, values)
+
+    def get_fields(self) -> Set[str]:
+        """
+        Return the replay and player ('player.' prefixed) fields used by the fields
+        """
+        res: Set[str] = set()
+        for field in self.db.values():
+            res.update(field.get_fields())
+        return res
+
     def get_toml(self) -> tomlkit.items.Table:
         """
         get field TOML config
@@ -338,6 +477,7 @@ class Fields:
                         error(f"no such a field keyy defined: {field_key}")
             except KeyError:
                 error(f"no such a field set defined: {key}")
+        res.compile()
         return res
 
 
@@ -356,6 +496,12 @@ class CountField(ReportField):
         else:
             return ValueStore(len(replay.get_players(self.filter)), 1)
 
+    def compile(self, plan: Plan) -> FieldCalc:
+        if self.filter is None:
+            return lambda replay, values: ValueStore(1, 1)
+        slot: int = plan.players(self.filter)
+        return lambda replay, values: ValueStore(len(values[slot]), 1)
+
     def value(self, value: ValueStore) -> float:
         v: int | float = value.value
         return float(v)
@@ -403,6 +549,28 @@ class SumField(ReportField):
                     )
             return ValueStore(res, n)
 
+    def compile(self, plan: Plan) -> FieldCalc:
+        calc = self.calc
+        if self.filter is None:
+            get = attrgetter(self._field)
+
+            def calc_replay(replay: EnrichedReplay, values: Values) -> ValueStore:
+                try:
+                    return ValueStore(get(replay), 1)
+                except AttributeError:
+                    return calc(replay)
+
+            return calc_replay
+
+        slot: int = plan.player_sum(self.filter, self._field)
+
+        def calc_players(replay: EnrichedReplay, values: Values) -> ValueStore:
+            if (res := values[slot]) is None:
+                return calc(replay)
+            return ValueStore(res[0], res[1])
+
+        return calc_players
+
     def value(self, value: ValueStore) -> float:
         return float(value.value)
 
@@ -488,6 +656,47 @@ class AverageIfField(SumField):
             error(err)
             raise
 
+    def compile(self, plan: Plan) -> FieldCalc:
+        calc = self.calc
+        if_value: float = self._if_value
+        match self._if_ops:
+            case "eq":
+                cmp = eq
+            case "gt":
+                cmp = gt
+            case "lt":
+                cmp = lt
+            case other:
+                raise ValueError(f"invalid IF metric: {other}")
+        get = attrgetter(self._field)
+
+        if self.filter is None:
+
+            def calc_replay(replay: EnrichedReplay, values: Values) -> ValueStore:
+                try:
+                    return ValueStore(int(cmp(get(replay), if_value)), 1)
+                except AttributeError:
+                    return calc(replay)
+
+            return calc_replay
+
+        slot: int = plan.players(self.filter)
+
+        def calc_players(replay: EnrichedReplay, values: Values) -> ValueStore:
+            players = replay.players_dict
+            res: int = 0
+            n: int = 0
+            try:
+                for p in values[slot]:
+                    if cmp(get(players[p]), if_value):
+                        res += 1
+                    n += 1
+            except AttributeError:
+                return calc(replay)
+            return ValueStore(res, n)
+
+        return calc_players
+
     def _test_if(self, value: int | float) -> int:
         match self._if_ops:
             case "eq":
@@ -559,6 +768,28 @@ class MinField(ReportField):
                 n += 1
             return ValueStore(res, n)
 
+    def compile(self, plan: Plan) -> FieldCalc:
+        get = attrgetter(self._field)
+        if self.filter is None:
+            return lambda replay, values: ValueStore(get(replay), 1)
+
+        calc = self.calc
+        slot: int = plan.players(self.filter)
+
+        def calc_players(replay: EnrichedReplay, values: Values) -> ValueStore:
+            players = replay.players_dict
+            res: float = 10e8
+            n: int = 0
+            try:
+                for p in values[slot]:
+                    res = min(get(players[p]), res)
+                    n += 1
+            except AttributeError:
+                return calc(replay)
+            return ValueStore(res, n)
+
+        return calc_players
+
     def value(self, value: ValueStore) -> float:
         return float(value.value)
 
@@ -588,6 +819,28 @@ class MaxField(ReportField):
                 n += 1
             return ValueStore(res, n)
 
+    def compile(self, plan: Plan) -> FieldCalc:
+        get = attrgetter(self._field)
+        if self.filter is None:
+            return lambda replay, values: ValueStore(get(replay), 1)
+
+        calc = self.calc
+        slot: int = plan.players(self.filter)
+
+        def calc_players(replay: EnrichedReplay, values: Values) -> ValueStore:
+            players = replay.players_dict
+            res: float = -10e8
+            n: int = 0
+            try:
+                for p in values[slot]:
+                    res = max(get(players[p]), res)
+                    n += 1
+            except AttributeError:
+                return calc(replay)
+            return ValueStore(res, n)
+
+        return calc_players
+
     def value(self, value: ValueStore) -> float:
         return float(value.value)
 
@@ -595,6 +848,222 @@ class MaxField(ReportField):
 Fields.register(MaxField)
 
 
+@dataclass
+class PercentileField(ReportField):
+    """
+    Estimate a percentile of field values over replays
+    """
+
+    metric = "percentile"
+
+    percentile: float = 90
+
+    def __post_init__(self) -> None:
+        super().__post_init__()
+        if not 0 <= self.percentile <= 100:
+            raise ValueError(
+                f"FIELD '{self.key}': 'percentile' must be between 0 and 100: {self.percentile}"
+            )
+
+    def calc(self, replay: EnrichedReplay) -> ValueStore:
+        values: List[float] = list()
+        if self.filter is None:
+            try:
+                values.append(getattr(replay, self._field))
+            except AttributeError:
+                debug(
+                    "no attribute '%s' found in replay: %s", self.fields, replay.title
+                )
+        else:
+            for p in replay.get_players(self.filter):
+                try:
+                    values.append(getattr(replay.players_dict[p], self._field))
+                except AttributeError:
+                    debug(
+                        "no attribute '%s' found in replay: %s",
+                        self.fields,
+                        replay.title,
+                    )
+        return QuantileStore(sum(values), len(values), QuantileSketch(values))
+
+    def compile(self, plan: Plan) -> FieldCalc:
+        calc = self.calc
+        get = attrgetter(self._field)
+        if self.filter is None:
+
+            def calc_replay(replay: EnrichedReplay, values: Values) -> ValueStore:
+                try:
+                    value = get(replay)
+                except AttributeError:
+                    return calc(replay)
+                return QuantileStore(value, 1, QuantileSketch((value,)))
+
+            return calc_replay
+
+        slot: int = plan.players(self.filter)
+
+        def calc_players(replay: EnrichedReplay, values: Values) -> ValueStore:
+            players = replay.players_dict
+            try:
+                res: List[float] = [get(players[p]) for p in values[slot]]
+            except AttributeError:
+                return calc(replay)
+            return QuantileStore(sum(res), len(res), QuantileSketch(res))
+
+        return calc_players
+
+    def get_toml(self) -> tomlkit.items.Table:
+        table = super().get_toml()
+        table.add("percentile", self.percentile)
+        return table
+
+    def value(self, value: ValueStore) -> float:
+        if isinstance(value, QuantileStore):
+            return value.sketch.quantile(self.percentile / 100)
+        return inf
+
+
+Fields.register(PercentileField)
+
+
+@dataclass
+class MedianField(PercentileField):
+    """
+    Estimate a median of field values over replays
+    """
+
+    metric = "median"
+
+    percentile: float = 50
+
+    def get_toml(self) -> tomlkit.items.Table:
+        return ReportField.get_toml(self)
+
+
+Fields.register(MedianField)
+
+
+@dataclass
+class HistogramField(ReportField):
+    """
+    Count field values over replays into bins. 'bins' are the bins' lower bounds
+    """
+
+    metric = "histogram"
+
+    bins: List[float] = data_field(default_factory=list)
+    bin_labels: List[str] = data_field(default_factory=list)
+
+    def __post_init__(self) -> None:
+        super().__post_init__()
+        try:
+            if len(self.bins) == 0:
+                raise ValueError("'bins' not defined")
+            if sorted(self.bins) != list(self.bins):
+                raise ValueError(f"'bins' are not in ascending order: {self.bins}")
+            if len(self.bin_labels) == 0:
+                self.bin_labels = [
+                    f"{low}-{high}" for low, high in zip(self.bins, self.bins[1:])
+                ] + [f"{self.bins[-1]}+"]
+            elif len(self.bin_labels) != len(self.bins):
+                raise ValueError(
+                    f"the number of 'bins' ({len(self.bins)}) and 'bin_labels' ({len(self.bin_labels)}) does not match"
+                )
+        except Exception as err:
+            error(f"FIELD '{self.key}' has invalid field config: {err}")
+            raise
+
+    def _bin(self, value: float) -> int:
+        """Return bin index of a value. Values below the first bin go to the first bin"""
+        return max(bisect_right(self.bins, value) - 1, 0)
+
+    def calc(self, replay: EnrichedReplay) -> ValueStore:
+        res = HistogramStore(counts=array("q", bytes(8 * len(self.bins))))
+        if self.filter is None:
+            try:
+                value = getattr(replay, self._field)
+                res.counts[self._bin(value)] += 1
+                res.value, res.n = value, 1
+            except AttributeError:
+                debug(
+                    "no attribute '%s' found in replay: %s", self.fields, replay.title
+                )
+        else:
+            for p in replay.get_players(self.filter):
+                try:
+                    value = getattr(replay.players_dict[p], self._field)
+                    res.counts[self._bin(value)] += 1
+                    res.value += value
+                    res.n += 1
+                except AttributeError:
+                    debug(
+                        "no attribute '%s' found in replay: %s",
+                        self.fields,
+                        replay.title,
+                    )
+        return res
+
+    def compile(self, plan: Plan) -> FieldCalc:
+        if self.filter is None:
+            return super().compile(plan)
+        calc = self.calc
+        get = attrgetter(self._field)
+        bins: List[float] = list(self.bins)
+        empty = array("q", bytes(8 * len(bins)))
+        slot: int = plan.players(self.filter)
+
+        def calc_players(replay: EnrichedReplay, values: Values) -> ValueStore:
+            players = replay.players_dict
+            counts: array = empty[:]
+            res: float = 0
+            n: int = 0
+            try:
+                for p in values[slot]:
+                    value = get(players[p])
+                    counts[max(bisect_right(bins, value) - 1, 0)] += 1
+                    res += value
+                    n += 1
+            except AttributeError:
+                return calc(replay)
+            return HistogramStore(res, n, counts)
+
+        return calc_players
+
+    def get_toml(self) -> tomlkit.items.Table:
+        table = super().get_toml()
+        table.add("bins", self.bins)
+        table.add("bin_labels", self.bin_labels)
+        return table
+
+    def value(self, value: ValueStore) -> float:
+        """Return the number of values counted"""
+        return float(value.n)
+
+    def shares(self, value: ValueStore) -> List[float]:
+        """Return the share of values in each bin"""
+        if not isinstance(value, HistogramStore) or value.n == 0:
+            return [0] * len(self.bins)
+        return [count / value.n for count in value.counts]
+
+    def print(self, value: ValueStore | str) -> str:
+        if isinstance(value, str):
+            return value
+        return " ".join(format(share, self.format) for share in self.shares(value))
+
+    def headers(self, export: bool = False) -> List[str]:
+        if export:
+            return [f"{self.name} {label}" for label in self.bin_labels]
+        return [f"{self.name} ({', '.join(self.bin_labels)})"]
+
+    def cells(self, value: ValueStore | str, export: bool = False) -> List[str]:
+        if export and not isinstance(value, str):
+            return [format(share, self.format) for share in self.shares(value)]
+        return [self.print(value)]
+
+
+Fields.register(HistogramField)
+
+
 @dataclass
 class RatioField(SumField):
     """
@@ -675,6 +1144,49 @@ class RatioField(SumField):
 
             return ValueStore(val, div)
 
+    def compile(self, plan: Plan) -> FieldCalc:
+        calc = self.calc
+        get_value = attrgetter(self._value_field)
+        get_div = attrgetter(self._div_field)
+        if self.filter is None:
+
+            def calc_replay(replay: EnrichedReplay, values: Values) -> ValueStore:
+                try:
+                    return ValueStore(get_value(replay), get_div(replay))
+                except AttributeError:
+                    return calc(replay)
+
+            return calc_replay
+
+        value_slot: int = -1
+        div_slot: int = -1
+        if self._is_player_field_value:
+            value_slot = plan.player_sum(self.filter, self._value_field)
+        if self._is_player_field_div:
+            div_slot = plan.player_sum(self.filter, self._div_field)
+
+        def calc_players(replay: EnrichedReplay, values: Values) -> ValueStore:
+            try:
+                val: Any
+                div: Any
+                if value_slot < 0:
+                    val = get_value(replay)
+                elif (res := values[value_slot]) is None:
+                    return calc(replay)
+                else:
+                    val = res[0]
+                if div_slot < 0:
+                    div = get_div(replay)
+                elif (res := values[div_slot]) is None:
+                    return calc(replay)
+                else:
+                    div = res[0]
+                return ValueStore(val, div)
+            except AttributeError:
+                return calc(replay)
+
+        return calc_players
+
     def value(self, value: ValueStore) -> float:
         return value.value / value.n if value.n > 0 else inf
 
@@ -747,6 +1259,24 @@ class DiffField(SumField):
             debug(f"{replay.title_uniq}: divide by zero")
         return ValueStore(0, 0)
 
+    def compile(self, plan: Plan) -> FieldCalc:
+        if self.filter is None or self._filter2 is None:
+            return super().compile(plan)
+        calc = self.calc
+        slot1: int = plan.player_sum(self.filter, self._field)
+        slot2: int = plan.player_sum(self._filter2, self._field)
+
+        def calc_players(replay: EnrichedReplay, values: Values) -> ValueStore:
+            if (res1 := values[slot1]) is None or (res2 := values[slot2]) is None:
+                return calc(replay)
+            try:
+                return ValueStore(res1[0] / res1[1] - res2[0] / res2[1], 1)
+            except ZeroDivisionError:
+                debug(f"{replay.title_uniq}: divide by zero")
+            return ValueStore(0, 0)
+
+        return calc_players
+
     def value(self, value: ValueStore) -> float:
         return value.value / value.n if value.n > 0 else inf
 
@@ -1,4 +1,10 @@
+import json
 import logging
+import os
+import re
+from asyncio import to_thread
+from dataclasses import dataclass
+from pathlib import Path
 from typing import (
     List,
     Self,
@@ -25,7 +31,21 @@ from result import Result, Err, Ok
 from blitzmodels.wotinspector.wi_apiv2 import Replay, PlayerData
 from blitzmodels.wotinspector.wi_apiv1 import EnumBattleResult
 
-from .args import StatsType, StatsMeasure, EnumTeamFilter, EnumGroupFilter, PlayerFilter
+from .args import (
+    StatsType,
+    StatsMeasure,
+    EnumTeamFilter,
+    EnumGroupFilter,
+    EnumJSONReader,
+    PlayerFilter,
+)
+
+try:
+    import orjson  # type: ignore
+
+    HAS_ORJSON: bool = True
+except ImportError:
+    HAS_ORJSON = False
 
 logger = logging.getLogger()
 error = logger.error
@@ -34,6 +54,90 @@ verbose = logger.info
 debug = logger.debug
 
 
+def read_bytes(filename: Path | str) -> bytes:
+    """
+    Read a file's content with as few syscalls as possible (blocking)
+    """
+    fd: int = os.open(filename, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+    try:
+        size: int = os.fstat(fd).st_size
+        data: bytes = os.read(fd, size)
+        if len(data) < size:
+            # short read (e.g. network file systems)
+            chunks: List[bytes] = [data]
+            read: int = len(data)
+            while read < size and (chunk := os.read(fd, size - read)):
+                chunks.append(chunk)
+                read += len(chunk)
+            data = b"".join(chunks)
+        return data
+    finally:
+        os.close(fd)
+
+
+_PLAYERS_DATA_KEY: bytes = b'"players_data"'
+_protagonist_re: re.Pattern = re.compile(rb'"protagonist"\s*:\s*(\d+)')
+_allies_re: re.Pattern = re.compile(rb'"allies"\s*:\s*\[([\d,\s]*)\]')
+_enemies_re: re.Pattern = re.compile(rb'"enemies"\s*:\s*\[([\d,\s]*)\]')
+
+
+@dataclass
+class ReplayHeader:
+    """
+    Player ids of a replay read without parsing or validating the whole replay JSON
+    """
+
+    protagonist: AccountId
+    allies: List[AccountId]
+    enemies: List[AccountId]
+
+    @property
+    def account_ids(self) -> List[AccountId]:
+        """account_ids of all the players in the replay"""
+        return self.allies + self.enemies
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "ReplayHeader":
+        """
+        Read player ids from replay JSON.
+
+        The top-level keys before 'players_data' are scanned with regular
+        expressions. Falls back to parsing the whole JSON if the keys are
+        not found.
+        """
+        end: int = data.find(_PLAYERS_DATA_KEY)
+        if end < 0:
+            end = len(data)
+        if (
+            (protagonist := _protagonist_re.search(data, 0, end)) is not None
+            and (allies := _allies_re.search(data, 0, end)) is not None
+            and (enemies := _enemies_re.search(data, 0, end)) is not None
+        ):
+            return cls(
+                protagonist=int(protagonist.group(1)),
+                allies=_read_ids(allies.group(1)),
+                enemies=_read_ids(enemies.group(1)),
+            )
+        debug("could not scan replay header, parsing full JSON")
+        replay: Dict = orjson.loads(data) if HAS_ORJSON else json.loads(data)
+        return cls(
+            protagonist=int(replay["protagonist"]),
+            allies=[int(account_id) for account_id in replay["allies"]],
+            enemies=[int(account_id) for account_id in replay["enemies"]],
+        )
+
+
+def _read_ids(ids: bytes) -> List[AccountId]:
+    return [int(account_id) for account_id in ids.split(b",") if account_id.strip()]
+
+
+def replay_account_ids(data: bytes) -> List[AccountId]:
+    """
+    Read account_ids of all the players in a replay JSON without validating the replay
+    """
+    return ReplayHeader.from_bytes(data).account_ids
+
+
 def stat_key(
     stats_type: StatsType,
     account_id: AccountId,
@@ -198,6 +302,13 @@ class EnrichedPlayerData(PlayerData):
     wr: float = 0
     avgdmg: float = 0
     battles: int = 0
+    # tier and tank stats with '--stats-type multi'
+    tier_wr: float = 0
+    tier_avgdmg: float = 0
+    tier_battles: int = 0
+    tank_wr: float = 0
+    tank_avgdmg: float = 0
+    tank_battles: int = 0
 
     tank: str = "-"
     tank_id: TankId = 0
@@ -212,12 +323,26 @@ class EnrichedPlayerData(PlayerData):
         validate_assignment=False,
     )
 
-    def add_stats(self, stats: PlayerStats):
+    def add_stats(self, stats: PlayerStats, multi: bool = False):
         """
         add stats to EnrichedReplay.EnrichedPlayerData
 
-        NOT SUITABLE for storing over sessions since the same fields are used regardless of stat_type
+        By default the same fields are used regardless of stat_type. NOT SUITABLE
+        for storing over sessions. If 'multi' is set, tier and tank stats are
+        stored to 'tier_*' and 'tank_*' fields.
         """
+        if multi:
+            match stats.stats_type:
+                case "tier":
+                    self.tier_wr = stats.wr
+                    self.tier_avgdmg = stats.avgdmg
+                    self.tier_battles = stats.battles
+                    return
+                case "tank":
+                    self.tank_wr = stats.wr
+                    self.tank_avgdmg = stats.avgdmg
+                    self.tank_battles = stats.battles
+                    return
 
         self.wr = stats.wr
         self.avgdmg = stats.avgdmg
@@ -244,6 +369,37 @@ class EnrichedReplay(Replay):
         validate_assignment=False,
     )
 
+    @classmethod
+    def parse_bytes(
+        cls, data: bytes, json_reader: EnumJSONReader = EnumJSONReader.bytes
+    ) -> Self | None:
+        """
+        Parse replay JSON from bytes without decoding it to str first
+        """
+        try:
+            if json_reader == EnumJSONReader.orjson and HAS_ORJSON:
+                return cls.model_validate(orjson.loads(data))
+            return cls.model_validate_json(data)
+        except Exception as err:
+            debug("could not parse replay: %s: %s", type(err), err)
+        return None
+
+    @classmethod
+    async def read_json(
+        cls,
+        filename: Path,
+        json_reader: EnumJSONReader = EnumJSONReader.bytes,
+    ) -> Self | None:
+        """
+        Read replay JSON file using the selected reader.
+
+        'text' uses the aiofiles based open_json(), 'bytes' and 'orjson'
+        read the file in one go and parse the bytes directly.
+        """
+        if json_reader == EnumJSONReader.text:
+            return await cls.open_json(filename)
+        return cls.parse_bytes(await to_thread(read_bytes, filename), json_reader)
+
     @model_validator(mode="after")
     def read_players_dict(self) -> Self:
         self.title_uniq = (
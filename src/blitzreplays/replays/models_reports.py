@@ -1,7 +1,14 @@
 import logging
 from typing import (
+    Any,
+    Callable,
+    Deque,
+    Iterable,
+    Iterator,
     List,
+    Protocol,
     Dict,
+    Set,
     Tuple,
     ClassVar,
     Type,
@@ -9,10 +16,13 @@ from typing import (
 from math import inf
 from pathlib import Path
 from abc import abstractmethod, ABC
-from collections import defaultdict
+from asyncio import to_thread
+from collections import defaultdict, deque
+from datetime import datetime
+from heapq import heapify, heappop, heappush, nlargest
 from sortedcollections import NearestDict  # type: ignore
 from tabulate import tabulate  # type: ignore
-import aiofiles
+import csv
 
 # from icecream import ic  # type: ignore
 
@@ -27,6 +37,7 @@ from .args import (
 )
 from .models_replay import EnrichedReplay
 from .models_fields import ValueStore, FieldKey, Fields
+from .plan import Plan, Values
 
 logger = logging.getLogger()
 error = logger.error
@@ -55,6 +66,7 @@ class Category:
         # self.fields: List[str]
         self.values: Dict[FieldKey, ValueStore] = defaultdict(default_ValueStore)
         self.strings: Dict[FieldKey, str] = dict()
+        self.replays: int = 0
 
     # def __post_init__(self) -> None:
     #     for field in self.fields:
@@ -65,13 +77,28 @@ class Category:
             if isinstance(value, str):
                 self.strings[field] = value
             else:
-                self.values[field].record(value)
+                self.store(field, value).record(value)
         except KeyError as err:
             error(err)
         except Exception as err:
             error(err)
         return None
 
+    def store(self, field: FieldKey, value: ValueStore) -> ValueStore:
+        """
+        Return the field's ValueStore. A new store is the same type as 'value'
+        """
+        if (store := self.values.get(field)) is None:
+            store = self.values[field] = type(value)()
+        return store
+
+    def merge(self, other: "Category") -> None:
+        """Merge values recorded to 'other' category"""
+        for field, value in other.values.items():
+            self.store(field, value).record(value)
+        self.strings.update(other.strings)
+        self.replays += other.replays
+
     def get(self, field: FieldKey) -> ValueStore | str:
         if field in self.values:
             return self.values[field]
@@ -88,6 +115,12 @@ def default_Category() -> Category:
 CategoryKey = str
 
 
+class RowWriter(Protocol):
+    """A csv.writer() like object"""
+
+    def writerow(self, row: Iterable[Any], /) -> Any: ...
+
+
 class Categorization(ABC):
     """
     Abstract base class for replay categorization
@@ -111,10 +144,32 @@ class Categorization(ABC):
         return sorted(self._categories.keys(), key=str.casefold)
 
     @abstractmethod
-    def get_category(self, replay: EnrichedReplay) -> Category | None:
-        """Get category for a replay"""
+    def get_category(
+        self, replay: EnrichedReplay, values: Values | None = None
+    ) -> Category | None:
+        """
+        Get category for a replay. 'values' are the replay's evaluated
+        subexpressions of the plan the categorization was compiled with
+        """
         raise NotImplementedError("needs to implement in subclasses")
 
+    def compile(self, plan: Plan) -> None:
+        """
+        Add subexpressions the categorization uses to 'plan'
+        """
+        return None
+
+    def take_categories(self) -> Dict[CategoryKey, Category]:
+        """Return the recorded categories and start recording new ones"""
+        res: Dict[CategoryKey, Category] = self._categories
+        self._categories = defaultdict(default_Category)
+        return res
+
+    def merge(self, categories: Dict[CategoryKey, Category]) -> None:
+        """Merge categories recorded by another copy of the categorization"""
+        for cat_key, cat in categories.items():
+            self._categories[cat_key].merge(cat)
+
     @classmethod
     def help(cls) -> None:
         """Print help"""
@@ -123,32 +178,52 @@ class Categorization(ABC):
     def print(self, fields: Fields, export: bool = False) -> str:
         """Print a report"""
         debug("Report: %s", str(fields))
-        header: List[str] = [self.name.upper()] + [
-            field.name for field in fields.fields()
+        header: List[str] = self.header(fields, export)
+        data: List[List[str]] = [
+            self.row(cat_key, cat, fields, export) for cat_key, cat in self.rows(fields)
         ]
-        data: List[List[str]] = list()
-        for cat_key in self.categories:
-            try:
-                cat: Category = self._categories[cat_key]
-                row: List[str] = [cat_key]
-                for field_key, field in fields.items():
-                    try:
-                        row.append(field.print(cat.get(field=field_key)))
-                    except Exception as err:
-                        error(
-                            f"Category={cat_key} field={field.name}: {type(err)}: {err}"
-                        )
-                data.append(row)
-            except KeyError as err:
-                error("category=%s: %s: %s", cat_key, type(err), str(err))
         debug("data=%s", str(data))
-        colalign: List[str] = ["left"] + ["right"] * len(fields)
+        colalign: List[str] = ["left"] + ["right"] * (len(header) - 1)
 
         if export:
             return tabulate(data, headers=header, tablefmt="tsv")
         else:
             return tabulate(data, headers=header, colalign=colalign)
 
+    def export(self, writer: "RowWriter", fields: Fields) -> int:
+        """
+        Write the report to 'writer' one row at a time. Returns the number of rows
+        """
+        writer.writerow(self.header(fields, export=True))
+        rows: int = 0
+        for cat_key, cat in self.rows(fields):
+            writer.writerow(self.row(cat_key, cat, fields, export=True))
+            rows += 1
+        return rows
+
+    def header(self, fields: Fields, export: bool = False) -> List[str]:
+        """Return the report's header row"""
+        return [self.name.upper()] + [
+            header for field in fields.fields() for header in field.headers(export)
+        ]
+
+    def row(
+        self, cat_key: CategoryKey, cat: Category, fields: Fields, export: bool = False
+    ) -> List[str]:
+        """Return a category's row as formatted strings"""
+        row: List[str] = [cat_key]
+        for field_key, field in fields.items():
+            try:
+                row.extend(field.cells(cat.get(field=field_key), export))
+            except Exception as err:
+                error(f"Category={cat_key} field={field.name}: {type(err)}: {err}")
+        return row
+
+    def rows(self, fields: Fields) -> Iterator[Tuple[CategoryKey, Category]]:
+        """Return the report's rows: categories in the order of 'categories'"""
+        for cat_key in self.categories:
+            yield cat_key, self._categories[cat_key]
+
     def parse_field(self, field: str) -> Tuple[str, bool]:
         """parse field and check is it a player field"""
         if field.startswith("player."):
@@ -281,6 +356,50 @@ class Reports:
         """Return the number of reports"""
         return len(self.db)
 
+    def get_fields(self) -> Set[str]:
+        """
+        Return the replay and player ('player.' prefixed) fields used for categorization
+        """
+        return {report.category_field for report in self.db.values()}
+
+    def compile(self, plan: Plan) -> None:
+        """
+        Add subexpressions the reports use to 'plan'. Use the same 'plan'
+        with Fields.compile() to share subexpressions
+        """
+        for report in self.db.values():
+            report.compile(plan)
+
+    def record(
+        self, replay: EnrichedReplay, fields: Fields, values: Values | None = None
+    ) -> None:
+        """
+        Record replay's field values to the reports' categories.
+        'values' are the replay's evaluated subexpressions of the plan
+        """
+        categories: List[Category] = list()
+        for report in self.db.values():
+            if (cat := report.get_category(replay=replay, values=values)) is not None:
+                cat.replays += 1
+                categories.append(cat)
+
+        for field_key, value in fields.calc(replay, values):
+            for cat in categories:
+                cat.record(field=field_key, value=value)
+
+    def take_categories(self) -> Dict[str, Dict[CategoryKey, Category]]:
+        """
+        Return the categories recorded by the reports and start recording new ones
+        """
+        return {key: report.take_categories() for key, report in self.db.items()}
+
+    def merge(self, categories: Dict[str, Dict[CategoryKey, Category]]) -> None:
+        """
+        Merge categories recorded by another copy of the reports
+        """
+        for key, report_categories in categories.items():
+            self.db[key].merge(report_categories)
+
     def update(self, other: "Reports") -> None:
         """update reports with 'other'"""
         self.db.update(other.db)
@@ -300,12 +419,24 @@ class Reports:
 
     async def export(self, fields: Fields, filename: Path):
         """
-        Export reports to a TSV file
+        Export reports to a TSV file or to a CSV file if 'filename' ends with '.csv'
+        """
+        rows: int = await to_thread(self.write, fields, filename)
+        debug("exported %d rows to %s", rows, str(filename))
+
+    def write(self, fields: Fields, filename: Path) -> int:
+        """
+        Write reports to a TSV/CSV file row by row. Returns the number of rows
         """
-        async with aiofiles.open(filename, "w") as f:
+        dialect: str = "excel" if filename.suffix.lower() == ".csv" else "excel-tab"
+        rows: int = 0
+        with open(filename, "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f, dialect=dialect, lineterminator="\n")
             for report in self.db.values():
-                await f.write("\n\n")
-                await f.write(report.print(fields, export=True))
+                writer.writerow([])
+                writer.writerow([])
+                rows += report.export(writer, fields)
+        return rows
 
     def get_toml(self) -> tomlkit.items.Table:
         """
@@ -338,7 +469,9 @@ class Totals(Categorization):
         super().__init__(name="Total", field="exp")
         self._categories["Total"] = Category()
 
-    def get_category(self, replay: EnrichedReplay) -> Category | None:
+    def get_category(
+        self, replay: EnrichedReplay, values: Values | None = None
+    ) -> Category | None:
         return self._categories["Total"]
 
     def get_toml(self) -> tomlkit.items.Table:
@@ -370,7 +503,9 @@ class ClassCategorization(Categorization):
         for ndx, cat in enumerate(categories):
             self._category_cache[int(ndx)] = cat
 
-    def get_category(self, replay: EnrichedReplay) -> Category | None:
+    def get_category(
+        self, replay: EnrichedReplay, values: Values | None = None
+    ) -> Category | None:
         try:
             field_value: int = self.get_category_int(replay)
             category: CategoryKey = self._category_cache[field_value]
@@ -413,7 +548,9 @@ class NumberCategorization(Categorization):
 
     categorization = "number"
 
-    def get_category(self, replay: EnrichedReplay) -> Category | None:
+    def get_category(
+        self, replay: EnrichedReplay, values: Values | None = None
+    ) -> Category | None:
         try:
             return self._categories[self.get_category_str(replay)]
         except AttributeError as err:
@@ -430,14 +567,36 @@ Reports.register(NumberCategorization)
 
 class StrCategorization(Categorization):
     """
-    Replay categorization based on unique string values
+    Replay categorization based on unique string values.
+
+    With 'limit = K' the report shows the top K categories sorted by 'sort_by'
+    field (default: the number of replays). Only K * 10 categories with the most
+    replays are tracked: a new category replaces the one with the fewest replays
+    (space-saving heavy hitters), which keeps the memory use bounded.
     """
 
     categorization = "string"
 
-    def get_category(self, replay: EnrichedReplay) -> Category | None:
+    _capacity_factor: ClassVar[int] = 10  # categories tracked per 'limit'
+
+    def __init__(
+        self, name: str, field: str, limit: int = 0, sort_by: str | None = None
+    ):
+        super().__init__(name=name, field=field)
+        if limit < 0:
+            raise ValueError(f"'limit' has to be >= 0: {limit}")
+        self.limit: int = limit
+        self.sort_by: str | None = sort_by
+        self._heap: List[Tuple[int, CategoryKey]] = list()  # replays, category
+
+    def get_category(
+        self, replay: EnrichedReplay, values: Values | None = None
+    ) -> Category | None:
         try:
-            return self._categories[self.get_category_str(replay)]
+            cat_key: CategoryKey = self.get_category_str(replay)
+            if self.limit > 0 and cat_key not in self._categories:
+                return self._add_category(cat_key)
+            return self._categories[cat_key]
         except AttributeError as err:
             error(
                 f"field={self.category_field} not found in replay: {replay.title}: {err}"
@@ -446,10 +605,200 @@ class StrCategorization(Categorization):
             error(f"{type(err)}: {err}")
         return None
 
+    def _add_category(self, cat_key: CategoryKey) -> Category:
+        """
+        Add a category replacing the one with the fewest replays if the report is full
+        """
+        cat = Category()
+        if len(self._categories) >= self.limit * self._capacity_factor:
+            # heap entries are lower bounds of the categories' replays
+            while True:
+                replays, evicted = heappop(self._heap)
+                if (count := self._categories[evicted].replays) == replays:
+                    break
+                heappush(self._heap, (count, evicted))
+            del self._categories[evicted]
+            cat.replays = replays  # over-estimate like the space-saving algorithm
+        self._categories[cat_key] = cat
+        heappush(self._heap, (cat.replays, cat_key))
+        return cat
+
+    def take_categories(self) -> Dict[CategoryKey, Category]:
+        self._heap = list()
+        return super().take_categories()
+
+    def merge(self, categories: Dict[CategoryKey, Category]) -> None:
+        super().merge(categories)
+        if self.limit == 0:
+            return
+        capacity: int = self.limit * self._capacity_factor
+        if len(self._categories) > capacity:
+            top: List[CategoryKey] = nlargest(
+                capacity, self._categories, key=lambda k: self._categories[k].replays
+            )
+            self._categories = defaultdict(
+                default_Category, {k: self._categories[k] for k in top}
+            )
+        self._heap = [(cat.replays, key) for key, cat in self._categories.items()]
+        heapify(self._heap)
+
+    def _sort_key(self, fields: Fields) -> Callable[[CategoryKey], float]:
+        """Return a function returning the value to sort a category by"""
+        if self.sort_by is not None:
+            try:
+                field = fields[self.sort_by]
+                field_key: str = self.sort_by
+
+                def field_value(cat_key: CategoryKey) -> float:
+                    # get() does not add the field to the category's defaultdict
+                    store = self._categories[cat_key].values.get(field_key)
+                    if store is None or store.n == 0:
+                        return -inf  # categories without samples sort last
+                    return field.value(store)
+
+                return field_value
+            except KeyError:
+                error(
+                    f"REPORT '{self.name}': 'sort_by' field is not in the report's fields: {self.sort_by}"
+                )
+        return lambda cat_key: self._categories[cat_key].replays
+
+    def rows(self, fields: Fields) -> Iterator[Tuple[CategoryKey, Category]]:
+        """
+        Return the report's rows. With 'limit' or 'sort_by' the categories are
+        sorted in descending order
+        """
+        if self.limit == 0 and self.sort_by is None:
+            yield from super().rows(fields)
+            return
+        key: Callable[[CategoryKey], float] = self._sort_key(fields)
+        cat_keys: List[CategoryKey]
+        if self.limit > 0:
+            cat_keys = nlargest(self.limit, self._categories, key=key)
+        else:
+            cat_keys = sorted(self._categories, key=key, reverse=True)
+        for cat_key in cat_keys:
+            yield cat_key, self._categories[cat_key]
+
+    def get_toml(self) -> tomlkit.items.Table:
+        """
+        get TOML config of the report
+        """
+        table: tomlkit.items.Table = super().get_toml()
+        if self.limit > 0:
+            table.add("limit", self.limit)
+        if self.sort_by is not None:
+            table.add("sort_by", self.sort_by)
+        return table
+
 
 Reports.register(StrCategorization)
 
 
+class TimeCategorization(Categorization):
+    """
+    Replay categorization by battle time period: "battle", "day", "week", "month" or "year".
+
+    "battle" period categories are keyed by the battle time and the battle's ID.
+
+    With 'window = N' each row reports the N latest periods up to the row's
+    period, e.g. 'period = "battle"' and 'window = 100' gives a 100-battle
+    rolling trend. The rolling values are computed by adding the newest and
+    removing the oldest period of the window.
+    """
+
+    categorization = "time"
+
+    _formats: ClassVar[Dict[str, str]] = {
+        "battle": "%Y-%m-%d %H:%M:%S",
+        "day": "%Y-%m-%d",
+        "week": "%G-W%V",
+        "month": "%Y-%m",
+        "year": "%Y",
+    }
+    _battle_id: ClassVar[str] = "arena_unique_id"  # added to "battle" period keys
+
+    def __init__(
+        self,
+        name: str,
+        field: str = "battle_start_time",
+        period: str = "month",
+        window: int = 0,
+    ):
+        super().__init__(name=name, field=field)
+        if self._is_player_field:
+            raise ValueError(f"'field' has to be a replay field: {field}")
+        try:
+            self._format: str = self._formats[period]
+        except KeyError:
+            raise ValueError(
+                f"invalid 'period': {period}. Valid periods: {', '.join(self._formats)}"
+            )
+        if window < 0:
+            raise ValueError(f"'window' has to be >= 0: {window}")
+        self.period: str = period
+        self.window: int = window
+
+    def get_category(
+        self, replay: EnrichedReplay, values: Values | None = None
+    ) -> Category | None:
+        try:
+            battle_time: datetime = getattr(replay, self._field)
+            cat_key: CategoryKey = battle_time.strftime(self._format)
+            if self.period == "battle":
+                # battles can start in the same second
+                cat_key = f"{cat_key} {getattr(replay, self._battle_id)}"
+            return self._categories[cat_key]
+        except AttributeError as err:
+            error(
+                f"field={self.category_field} not found in replay: {replay.title}: {err}"
+            )
+        return None
+
+    def rows(self, fields: Fields) -> Iterator[Tuple[CategoryKey, Category]]:
+        """
+        Return the report's rows. With 'window' the rows are rolling aggregates
+        of the latest 'window' periods. A rolling row is valid until the next row
+        """
+        if self.window == 0:
+            yield from super().rows(fields)
+            return
+
+        rolling = Category()
+        latest: Deque[Category] = deque()
+        for cat_key in self.categories:
+            cat: Category = self._categories[cat_key]
+            rolling.merge(cat)
+            latest.append(cat)
+            if len(latest) > self.window:
+                oldest: Category = latest.popleft()
+                rolling.replays -= oldest.replays
+                for field, value in oldest.values.items():
+                    store: ValueStore = rolling.values[field]
+                    if store.removable:
+                        store.remove(value)
+                    else:
+                        # re-aggregate values that cannot be removed
+                        store = rolling.values[field] = type(value)()
+                        for c in latest:
+                            if field in c.values:
+                                store.record(c.values[field])
+            yield cat_key, rolling
+
+    def get_toml(self) -> tomlkit.items.Table:
+        """
+        get TOML config of the report
+        """
+        table: tomlkit.items.Table = super().get_toml()
+        table.add("period", self.period)
+        if self.window > 0:
+            table.add("window", self.window)
+        return table
+
+
+Reports.register(TimeCategorization)
+
+
 # TODO: could bucket categorization support any field value (metric, filter, etc) for categorization?
 class BucketCategorization(Categorization):
     """
@@ -504,6 +853,7 @@ class BucketCategorization(Categorization):
         self._filter: PlayerFilter | None = None
         if filter is not None:
             self._filter = PlayerFilter.from_str(filter)
+        self._slot: int = -1
 
         if len(buckets) != len(bucket_labels):
             message(
@@ -515,10 +865,14 @@ class BucketCategorization(Categorization):
             # debug(f"bucket_start={bucket_start}, label={label}")
             self._buckets[bucket_start] = label
 
-    def get_category(self, replay: EnrichedReplay) -> Category | None:
+    def get_category(
+        self, replay: EnrichedReplay, values: Values | None = None
+    ) -> Category | None:
         try:
             field_value: float
-            if self._filter is None:
+            if values is not None and self._slot >= 0:
+                field_value = self.get_planned_float(values, self._slot)
+            elif self._filter is None:
                 field_value = self.get_category_float(replay)
             else:
                 field_value = self.get_category_float(
@@ -536,6 +890,30 @@ class BucketCategorization(Categorization):
             error(f"{type(err)}: {err}")
         return None
 
+    def __getstate__(self) -> Dict[str, Any]:
+        # NearestDict loses its 'rounding' when pickled
+        state: Dict[str, Any] = self.__dict__.copy()
+        state["_buckets"] = list(self._buckets.items())
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        buckets: NearestDict[float, str] = NearestDict(
+            rounding=NearestDict.NEAREST_PREV
+        )
+        buckets.update(state["_buckets"])
+        state["_buckets"] = buckets
+        self.__dict__.update(state)
+
+    def compile(self, plan: Plan) -> None:
+        if self._filter is not None and self._is_player_field:
+            self._slot = plan.player_mean(self._filter, self._field)
+
+    def get_planned_float(self, values: Values, slot: int) -> float:
+        """Get the category field's value evaluated by the plan"""
+        if (res := values[slot]) is None:
+            raise AttributeError(f"no field={self._field}")
+        return res
+
     @property
     def categories(self) -> List[CategoryKey]:
         """Get category keys in in order specified"""
@@ -576,20 +954,26 @@ class DiffBucketCategorization(BucketCategorization):
         self._filter2: PlayerFilter = PlayerFilter.from_str(filter2)
         if self._filter is None:
             raise ValueError("'filter' is not defined")
+        self._slot2: int = -1
 
-    def get_category(self, replay: EnrichedReplay) -> Category | None:
+    def get_category(
+        self, replay: EnrichedReplay, values: Values | None = None
+    ) -> Category | None:
         try:
             field_value: float
             if self._filter is None:
                 raise ValueError("'filter' is not defined")
 
-            field_value = self.get_category_float(
-                replay, replay.get_players(self._filter)
-            )
-
-            field_value -= self.get_category_float(
-                replay, replay.get_players(self._filter2)
-            )
+            if values is not None and self._slot >= 0:
+                field_value = self.get_planned_float(values, self._slot)
+                field_value -= self.get_planned_float(values, self._slot2)
+            else:
+                field_value = self.get_category_float(
+                    replay, replay.get_players(self._filter)
+                )
+                field_value -= self.get_category_float(
+                    replay, replay.get_players(self._filter2)
+                )
 
             category: CategoryKey = self._buckets[field_value]
             debug(
@@ -602,6 +986,11 @@ class DiffBucketCategorization(BucketCategorization):
             error(f"{type(err)}: {err}")
         return None
 
+    def compile(self, plan: Plan) -> None:
+        super().compile(plan)
+        if self._slot >= 0:
+            self._slot2 = plan.player_mean(self._filter2, self._field)
+
     def get_toml(self) -> tomlkit.items.Table:
         """
         get TOML config of the report
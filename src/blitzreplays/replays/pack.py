@@ -0,0 +1,213 @@
+import typer
+from typing import Annotated, Optional, List, Set, Tuple, Iterator, Iterable, Self
+import logging
+import gzip
+import io
+import struct
+from pathlib import Path
+from alive_progress import alive_bar  # type: ignore
+
+from pyutils import FileQueue, EventCounter, AsyncTyper
+
+from .models_replay import read_bytes
+
+app = AsyncTyper()
+
+logger = logging.getLogger()
+error = logger.error
+message = logger.warning
+verbose = logger.info
+debug = logger.debug
+
+##############################################
+#
+## Constants
+#
+##############################################
+
+PACK_SUFFIX: str = ".wotbpack"
+PACK_MAGIC: bytes = b"WOTBPACK1\n"
+PACK_COMPRESS_LEVEL: int = 6
+PACK_BUFFER_SIZE: int = 1 << 20  # 1 MiB
+
+_RECORD_HEADER = struct.Struct("<HI")  # name length, data length
+
+
+##############################################
+#
+## ReplayPack
+#
+##############################################
+
+
+class ReplayPack:
+    """
+    Packed replay corpus: a gzip stream of length-prefixed (name, replay JSON) records.
+
+    Appending writes a new gzip member to the end of the file, so existing
+    data is never rewritten. gzip readers decompress multi-member files as
+    a single stream.
+    """
+
+    def __init__(self: Self, filename: Path):
+        self.filename: Path = filename
+
+    @classmethod
+    def is_pack(cls, filename: Path) -> bool:
+        """Test if the file is a replay pack by its suffix"""
+        return filename.name.lower().endswith(PACK_SUFFIX)
+
+    def exists(self) -> bool:
+        return self.filename.is_file() and self.filename.stat().st_size > 0
+
+    def _records(self, read_data: bool = True) -> Iterator[Tuple[str, bytes]]:
+        """
+        Iterate over records with large sequential reads.
+        Returns empty data if 'read_data' is False.
+        """
+        with open(self.filename, "rb", buffering=PACK_BUFFER_SIZE) as raw:
+            with gzip.GzipFile(fileobj=raw, mode="rb") as gz:
+                f = io.BufferedReader(gz, buffer_size=PACK_BUFFER_SIZE)  # type: ignore
+                if f.read(len(PACK_MAGIC)) != PACK_MAGIC:
+                    raise ValueError(f"not a replay pack: {self.filename}")
+                while len(header := f.read(_RECORD_HEADER.size)) == _RECORD_HEADER.size:
+                    name_len, data_len = _RECORD_HEADER.unpack(header)
+                    name: str = f.read(name_len).decode("utf-8")
+                    if read_data:
+                        data: bytes = f.read(data_len)
+                        if len(data) != data_len:
+                            raise EOFError(
+                                f"truncated record in {self.filename}: {name}"
+                            )
+                        yield name, data
+                    else:
+                        f.seek(data_len, io.SEEK_CUR)
+                        yield name, b""
+                if len(header) > 0:
+                    raise EOFError(f"truncated record header in {self.filename}")
+
+    def __iter__(self) -> Iterator[Tuple[str, bytes]]:
+        return self._records()
+
+    def names(self) -> Set[str]:
+        """Return names of the replays in the pack"""
+        if not self.exists():
+            return set()
+        return {name for name, _ in self._records(read_data=False)}
+
+    def append(
+        self,
+        replays: Iterable[Tuple[str, bytes]],
+        compress_level: int = PACK_COMPRESS_LEVEL,
+    ) -> int:
+        """
+        Append replays to the pack as a new gzip member. Returns the number of replays added
+        """
+        added: int = 0
+        is_new: bool = not self.exists()
+        with open(self.filename, "ab", buffering=PACK_BUFFER_SIZE) as raw:
+            with gzip.GzipFile(
+                fileobj=raw, mode="wb", compresslevel=compress_level
+            ) as gz:
+                if is_new:
+                    gz.write(PACK_MAGIC)
+                for name, data in replays:
+                    name_bytes: bytes = name.encode("utf-8")
+                    gz.write(_RECORD_HEADER.pack(len(name_bytes), len(data)))
+                    gz.write(name_bytes)
+                    gz.write(data)
+                    added += 1
+        return added
+
+
+def split_packs(paths: List[Path]) -> Tuple[List[Path], List[Path]]:
+    """
+    Split input paths into replay packs and other paths
+    """
+    packs: List[Path] = list()
+    others: List[Path] = list()
+    for path in paths:
+        if path.is_file() and ReplayPack.is_pack(path):
+            packs.append(path)
+        else:
+            others.append(path)
+    return packs, others
+
+
+##############################################
+#
+## pack()
+#
+##############################################
+
+
+def callback_paths(value: Optional[list[Path]]) -> list[Path]:
+    return value if value is not None else []
+
+
+@app.async_command()
+async def pack(
+    compress_level: Annotated[
+        int,
+        typer.Option(
+            "--compress-level", min=1, max=9, help="gzip compression level (1-9)"
+        ),
+    ] = PACK_COMPRESS_LEVEL,
+    pack_fn: Path = typer.Argument(
+        help=f"replay pack file to create or append to (*{PACK_SUFFIX})"
+    ),
+    replays: List[Path] = typer.Argument(
+        help="replay JSON files or directories to pack", callback=callback_paths
+    ),
+) -> int:
+    """
+    pack replay JSON files into a single compressed replay pack file
+    """
+    stats = EventCounter("Pack replays")
+    if not ReplayPack.is_pack(pack_fn):
+        pack_fn = pack_fn.with_name(pack_fn.name + PACK_SUFFIX)
+    replay_pack = ReplayPack(pack_fn)
+    try:
+        packed: Set[str] = replay_pack.names()
+    except Exception as err:
+        error(f"could not read replay pack {pack_fn}: {err}")
+        typer.Exit(code=9)
+        raise SystemExit(9)
+    debug("%d replays in %s", len(packed), str(pack_fn))
+
+    fileQ = FileQueue(filter="*.wotbreplay.json", case_sensitive=False)
+    await fileQ.mk_queue(replays)
+    todo: List[Path] = list()
+    async for fn in fileQ:
+        if fn.name in packed:
+            stats.log("skipped")
+        else:
+            packed.add(fn.name)
+            todo.append(fn)
+
+    if len(todo) == 0:
+        message(f"no new replays to add to {pack_fn}")
+        stats.print()
+        return 0
+
+    def read_replays(bar) -> Iterator[Tuple[str, bytes]]:
+        for fn in todo:
+            try:
+                yield fn.name, read_bytes(fn)
+                stats.log("packed")
+            except Exception as err:
+                error(f"could not read replay: {fn}: {type(err)}: {err}")
+                stats.log("errors")
+            finally:
+                bar()
+
+    try:
+        with alive_bar(len(todo), title="Packing replays", enrich_print=False) as bar:
+            replay_pack.append(read_replays(bar), compress_level=compress_level)
+    except Exception as err:
+        error(f"could not write replay pack {pack_fn}: {err}")
+        typer.Exit(code=10)
+        raise SystemExit(10)
+
+    stats.print()
+    return 0
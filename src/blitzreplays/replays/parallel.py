@@ -0,0 +1,53 @@
+import logging
+from typing import Dict, List, Tuple
+
+from .models_reports import Category, CategoryKey, EnrichedReplay, Fields, Reports
+from .plan import Plan
+
+logger = logging.getLogger()
+error = logger.error
+message = logger.warning
+verbose = logger.info
+debug = logger.debug
+
+##############################################
+#
+## Analysis worker processes
+#
+##############################################
+
+ANALYZE_BATCH: int = 500  # replays sent to a worker process at a time
+
+Partial = Dict[str, Dict[CategoryKey, Category]]
+
+# fields, reports and plan of the worker process, set by init_analyze_worker()
+_worker: Tuple[Fields, Reports, Plan] | None = None
+
+
+def init_analyze_worker(fields: Fields, reports: Reports) -> None:
+    """
+    Initialize an analysis worker process with copies of 'fields' and 'reports'
+    """
+    global _worker
+    plan = Plan()
+    fields.compile(plan)
+    reports.compile(plan)
+    _worker = (fields, reports, plan)
+
+
+def analyze_batch(replays: List[EnrichedReplay]) -> Tuple[Partial, int]:
+    """
+    Analyze a batch of replays with stats added in a worker process.
+    Returns the categories recorded for the batch and the number of errors
+    """
+    if _worker is None:
+        raise RuntimeError("analysis worker has not been initialized")
+    fields, reports, plan = _worker
+    errors: int = 0
+    for replay in replays:
+        try:
+            reports.record(replay, fields, plan.evaluate(replay))
+        except Exception as err:
+            error(err)
+            errors += 1
+    return reports.take_categories(), errors
@@ -0,0 +1,128 @@
+import logging
+from math import inf
+from operator import attrgetter
+from typing import Any, Callable, Dict, List, Self, Tuple
+
+from blitzmodels import AccountId
+
+from .args import PlayerFilter
+from .models_replay import EnrichedReplay
+
+logger = logging.getLogger()
+error = logger.error
+message = logger.warning
+verbose = logger.info
+debug = logger.debug
+
+##############################################
+#
+## Plan
+#
+##############################################
+
+SubExprKey = Tuple[str, ...]
+Values = List[Any]
+SubExpr = Callable[[EnrichedReplay, Values], Any]
+
+
+class Plan:
+    """
+    Evaluation plan of subexpressions shared by report fields and categorizations.
+
+    Fields and categorizations add the subexpressions they need when they are
+    compiled. A subexpression added several times is evaluated only once.
+    evaluate() evaluates the subexpressions of a replay in the order they were
+    added, so a subexpression can use the values of the ones added before it.
+    The compiled fields and categorizations read the values by slot index.
+
+    Subexpressions reading an attribute missing from the replay evaluate to None.
+    """
+
+    def __init__(self: Self):
+        self._slots: Dict[SubExprKey, int] = dict()
+        self._exprs: List[SubExpr] = list()
+
+    def __len__(self) -> int:
+        return len(self._exprs)
+
+    def add(self, key: SubExprKey, expr: SubExpr) -> int:
+        """
+        Add a subexpression unless one with the same key exists. Returns its slot
+        """
+        try:
+            return self._slots[key]
+        except KeyError:
+            self._exprs.append(expr)
+            self._slots[key] = len(self._exprs) - 1
+            return self._slots[key]
+
+    def evaluate(self, replay: EnrichedReplay) -> Values:
+        """
+        Evaluate subexpressions for a replay
+        """
+        values: Values = list()
+        for expr in self._exprs:
+            values.append(expr(replay, values))
+        return values
+
+    def players(self, filter: PlayerFilter) -> int:
+        """
+        Add players matching 'filter': List[AccountId]
+        """
+
+        def players(replay: EnrichedReplay, values: Values) -> List[AccountId]:
+            return replay.get_players(filter)
+
+        return self.add(("players", filter.key), players)
+
+    def player_sum(self, filter: PlayerFilter, field: str) -> int:
+        """
+        Add a sum of players' 'field' values: Tuple[sum, number of players,
+        sum of positive values, number of positive values] | None
+        """
+        players_slot: int = self.players(filter)
+        get = attrgetter(field)
+
+        def player_sum(
+            replay: EnrichedReplay, values: Values
+        ) -> Tuple[Any, int, Any, int] | None:
+            players = replay.players_dict
+            res: Any = 0
+            n: int = 0
+            pos: Any = 0
+            n_pos: int = 0
+            try:
+                for p in values[players_slot]:
+                    val = get(players[p])
+                    res += val
+                    n += 1
+                    if val > 0:
+                        pos += val
+                        n_pos += 1
+            except AttributeError:
+                return None
+            return res, n, pos, n_pos
+
+        return self.add(("sum", filter.key, field), player_sum)
+
+    def player_mean(self, filter: PlayerFilter, field: str) -> int:
+        """
+        Add an average of players' positive 'field' values: float | None.
+        Returns the recording player's value if no players match 'filter'
+        and inf if there are no positive values. Uses the player_sum() of
+        the same players and field.
+        """
+        sum_slot: int = self.player_sum(filter, field)
+        get = attrgetter(field)
+
+        def player_mean(replay: EnrichedReplay, values: Values) -> float | None:
+            if (res := values[sum_slot]) is None:
+                return None
+            if res[1] == 0:
+                try:
+                    return float(get(replay.players_dict[replay.player]))
+                except AttributeError:
+                    return None
+            return res[2] / res[3] if res[3] > 0 else inf
+
+        return self.add(("mean", filter.key, field), player_mean)
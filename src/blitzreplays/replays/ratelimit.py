@@ -0,0 +1,163 @@
+import logging
+from asyncio import Lock, sleep
+from configparser import ConfigParser
+from pathlib import Path
+from time import monotonic, time
+from typing import Self
+
+import aiosqlite
+from pyutils.utils import set_config
+
+logger = logging.getLogger()
+error = logger.error
+message = logger.warning
+verbose = logger.info
+debug = logger.debug
+
+##############################################
+#
+## Constants
+#
+##############################################
+
+RATE_LIMIT_BURST: float = 1  # requests allowed back-to-back after idle time
+RATE_LIMIT_TIMEOUT: float = 60.0  # seconds to wait for a lock held by another process
+
+
+def rate_limit_file(
+    config: ConfigParser, section: str, filename: Path | None
+) -> Path | None:
+    """
+    Return the file to share the rate limit of 'section' API through.
+    Read from 'rate_limit_file' config option if 'filename' is not given
+    """
+    if (
+        fn := set_config(
+            config,
+            "",
+            section,
+            "rate_limit_file",
+            str(filename) if filename else None,
+        )
+    ) != "":
+        return Path(fn).expanduser()
+    return None
+
+
+##############################################
+#
+## RateLimiter
+#
+##############################################
+
+
+class RateLimiter:
+    """
+    Token bucket rate limiter shared by all the tasks using it.
+
+    With 'filename' the bucket is kept in a SQLite file and shared by all
+    the processes using the same file and 'name'. Tokens are taken in
+    advance: a caller takes a token even if the bucket is empty and waits
+    until its token would have been added, which keeps the request rate
+    at the limit without polling.
+    """
+
+    def __init__(
+        self: Self,
+        name: str,
+        rate: float,
+        filename: Path | None = None,
+        burst: float = RATE_LIMIT_BURST,
+    ):
+        """
+        'rate' is requests per second, 0 means no limit
+        """
+        self.name: str = name
+        self.rate: float = rate
+        self.burst: float = max(burst, 1)
+        self.filename: Path | None = filename
+        self._tokens: float = self.burst
+        self._updated: float = monotonic()
+        self._lock: Lock = Lock()
+        self._db: aiosqlite.Connection | None = None
+
+    @property
+    def is_shared(self) -> bool:
+        """Whether the rate limit is shared with other processes"""
+        return self.filename is not None
+
+    async def open(self) -> Self:
+        if self.filename is not None and self._db is None:
+            self.filename.parent.mkdir(parents=True, exist_ok=True)
+            self._db = await aiosqlite.connect(
+                self.filename, timeout=RATE_LIMIT_TIMEOUT, isolation_level=None
+            )
+            await self._db.execute("PRAGMA journal_mode=WAL")
+            await self._db.execute(
+                """CREATE TABLE IF NOT EXISTS rate_limits (
+                    name TEXT PRIMARY KEY,
+                    tokens REAL NOT NULL,
+                    updated REAL NOT NULL
+                )"""
+            )
+            debug("shared rate limit '%s': %s", self.name, str(self.filename))
+        return self
+
+    async def close(self) -> None:
+        if self._db is not None:
+            await self._db.close()
+            self._db = None
+
+    async def __aenter__(self) -> Self:
+        return await self.open()
+
+    async def __aexit__(self, *exc) -> None:
+        await self.close()
+
+    def _take(self, tokens: float, elapsed: float) -> float:
+        """
+        Take a token from a bucket of 'tokens' refilled for 'elapsed' seconds.
+        Returns the tokens left, negative if the token is taken in advance
+        """
+        return min(self.burst, tokens + elapsed * self.rate) - 1
+
+    async def acquire(self) -> None:
+        """Wait until a request is allowed"""
+        if self.rate <= 0:
+            return
+        wait: float
+        if self._db is None:
+            now: float = monotonic()
+            self._tokens = self._take(self._tokens, now - self._updated)
+            self._updated = now
+            wait = -self._tokens / self.rate
+        else:
+            async with self._lock:
+                wait = await self._acquire_shared(self._db)
+        if wait > 0:
+            await sleep(wait)
+
+    async def _acquire_shared(self, db: aiosqlite.Connection) -> float:
+        """
+        Take a token from the shared bucket. Returns seconds to wait
+        """
+        await db.execute("BEGIN IMMEDIATE")
+        try:
+            now: float = time()
+            tokens: float = self._take(self.burst, 0)
+            async with db.execute(
+                "SELECT tokens, updated FROM rate_limits WHERE name = ?", (self.name,)
+            ) as cursor:
+                if (row := await cursor.fetchone()) is not None:
+                    tokens = self._take(row[0], max(now - row[1], 0))
+            await db.execute(
+                """INSERT INTO rate_limits (name, tokens, updated) VALUES (?, ?, ?)
+                    ON CONFLICT (name) DO UPDATE
+                    SET tokens = excluded.tokens, updated = excluded.updated""",
+                (self.name, tokens, now),
+            )
+            await db.execute("COMMIT")
+        except Exception:
+            await db.execute("ROLLBACK")
+            raise
+        return -tokens / self.rate
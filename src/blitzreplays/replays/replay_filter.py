@@ -0,0 +1,279 @@
+import logging
+import re
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from pathlib import PurePosixPath
+from typing import Any, Callable, ClassVar, Dict, List, Self, Set, Tuple
+
+from .models_replay import EnrichedReplay
+
+logger = logging.getLogger()
+error = logger.error
+message = logger.warning
+verbose = logger.info
+debug = logger.debug
+
+##############################################
+#
+## ReplayFilter
+#
+##############################################
+
+FilterOp = str
+FilterType = str  # "date", "int" or "str"
+
+# filter field: replay attribute, type, header key
+FILTER_FIELDS: Dict[str, Tuple[str, FilterType, str | None]] = {
+    "date": ("battle_start_time", "date", "battle_start_time"),
+    "map": ("map", "str", None),
+    "map_id": ("map_id", "int", "map_id"),
+    "tier": ("battle_tier", "int", None),
+    "tank": ("player.tank", "str", None),
+    "tank_id": ("player.tank_id", "int", "vehicle_descr"),
+    "battle_type": ("battle_type", "int", "battle_type"),
+    "room_type": ("room_type", "int", "room_type"),
+    "battle_result": ("battle_result", "int", "battle_result"),
+}
+# header fields that are from the point of view of the player who recorded the replay
+_PROTAGONIST_HEADER_KEYS: Set[str] = {"vehicle_descr", "battle_result"}
+
+_expr_re: re.Pattern = re.compile(r"^\s*([a-z_]+)\s*(<=|>=|!=|=|<|>)\s*(.+?)\s*$")
+_date_re: re.Pattern = re.compile(r"^(\d{4})(?:-(\d{1,2}))?(?:-(\d{1,2}))?$")
+_filename_date_re: re.Pattern = re.compile(r"^(\d{8}_\d{4})")
+_PLAYERS_DATA_KEY: bytes = b'"players_data"'
+
+# replay filenames have the local time of the recording
+FILENAME_TIME_SLACK: timedelta = timedelta(days=1)
+
+
+def _date_range(value: str) -> Tuple[datetime, datetime]:
+    """
+    Return [start, end) UTC time range of 'YYYY', 'YYYY-MM' or 'YYYY-MM-DD'
+    """
+    if (m := _date_re.match(value)) is None:
+        raise ValueError(f"invalid date: {value}. Use YYYY-MM-DD, YYYY-MM or YYYY")
+    year: int = int(m.group(1))
+    if m.group(2) is None:
+        return datetime(year, 1, 1, tzinfo=timezone.utc), datetime(
+            year + 1, 1, 1, tzinfo=timezone.utc
+        )
+    month: int = int(m.group(2))
+    if m.group(3) is None:
+        start = datetime(year, month, 1, tzinfo=timezone.utc)
+        return start, (start + timedelta(days=32)).replace(day=1)
+    start = datetime(year, month, int(m.group(3)), tzinfo=timezone.utc)
+    return start, start + timedelta(days=1)
+
+
+def _utc(value: datetime) -> datetime:
+    return value if value.tzinfo is not None else value.replace(tzinfo=timezone.utc)
+
+
+@dataclass
+class Predicate:
+    """
+    A filter condition 'field op value'. Values of '=' and '!=' can be
+    comma separated lists of values to match any of
+    """
+
+    field: str
+    op: FilterOp
+    value: str
+
+    _ops: ClassVar[Dict[FilterOp, Callable[[Any, Any], bool]]] = {
+        "=": lambda x, values: x in values,
+        "!=": lambda x, values: x not in values,
+        "<": lambda x, y: x < y,
+        "<=": lambda x, y: x <= y,
+        ">": lambda x, y: x > y,
+        ">=": lambda x, y: x >= y,
+    }
+
+    def __post_init__(self) -> None:
+        try:
+            self._attr, self._type, self._header_key = FILTER_FIELDS[self.field]
+        except KeyError:
+            raise ValueError(
+                f"unsupported filter field: {self.field}. Supported fields: {', '.join(FILTER_FIELDS)}"
+            )
+        self._player_field: bool = self._attr.startswith("player.")
+        self._attr = self._attr.removeprefix("player.")
+        self._header_re: re.Pattern | None = None
+        if self._header_key is not None:
+            pattern: str = r'"([^"]+)"' if self._type == "date" else r"(-?\d+)(?![\d.])"
+            self._header_re = re.compile(
+                rf'"{self._header_key}"\s*:\s*{pattern}'.encode()
+            )
+
+        self._range: Tuple[datetime, datetime]
+        self._values: Any
+        match self._type:
+            case "date":
+                if self.op in {"=", "!="} and "," in self.value:
+                    raise ValueError(f"date filter takes a single date: {self}")
+                self._range = _date_range(self.value)
+            case "int":
+                values: List[int] = [int(v) for v in self.value.split(",")]
+                self._values = set(values) if self.op in {"=", "!="} else values[0]
+            case _:
+                if self.op not in {"=", "!="}:
+                    raise ValueError(f"'{self.field}' filter supports only = and !=")
+                self._values = {v.strip().casefold() for v in self.value.split(",")}
+        self._test: Callable[[Any, Any], bool] = self._ops[self.op]
+
+    def __str__(self) -> str:
+        return f"{self.field}{self.op}{self.value}"
+
+    def match_date(self, value: datetime) -> bool:
+        start, end = self._range
+        match self.op:
+            case "=":
+                return start <= value < end
+            case "!=":
+                return not start <= value < end
+            case "<":
+                return value < start
+            case "<=":
+                return value < end
+            case ">":
+                return value >= end
+            case _:
+                return value >= start
+
+    def match_value(self, value: Any) -> bool:
+        """Test a field value"""
+        match self._type:
+            case "date":
+                return self.match_date(_utc(value))
+            case "str":
+                return self._test(str(value).casefold(), self._values)
+            case _:
+                return self._test(int(value), self._values)
+
+    def may_match_dates(self, earliest: datetime, latest: datetime) -> bool:
+        """
+        Test if a date between 'earliest' and 'latest' may match the predicate
+        """
+        if self._type != "date" or self.op == "!=":
+            return True
+        return (
+            self.match_date(earliest)
+            or self.match_date(latest)
+            or (
+                self.op == "="
+                and earliest < self._range[0]
+                and self._range[1] <= latest
+            )
+        )
+
+    def has_header(self, player: int = 0) -> bool:
+        """
+        Whether the predicate can be tested from the replay header.
+        The header has the tank and the result of the recording player only
+        """
+        if self._header_re is None:
+            return False
+        return player == 0 or self._header_key not in _PROTAGONIST_HEADER_KEYS
+
+    def match_header(self, data: bytes, end: int) -> bool:
+        """
+        Test a replay JSON's header. Returns True if the value is not found
+        """
+        if (
+            self._header_re is None
+            or (m := self._header_re.search(data, 0, end)) is None
+        ):
+            return True
+        if self._type == "date":
+            return self.match_date(_utc(datetime.fromisoformat(m.group(1).decode())))
+        return self._test(int(m.group(1)), self._values)
+
+    def match(self, replay: EnrichedReplay) -> bool:
+        if self._player_field:
+            return self.match_value(
+                getattr(replay.players_dict[replay.player], self._attr)
+            )
+        return self.match_value(getattr(replay, self._attr))
+
+
+class ReplayFilter:
+    """
+    Filter replays with predicates 'FIELD OP VALUE' that all have to match.
+
+    Predicates are tested as early as possible: dates against replay filenames
+    before reading the files, fields in the replay header before parsing the
+    replay and the rest after the replay has been enriched, before its
+    players' stats are fetched.
+    """
+
+    def __init__(self: Self, predicates: List[Predicate], player: int = 0):
+        self.predicates: List[Predicate] = predicates
+        self._date_predicates: List[Predicate] = [
+            p for p in predicates if p._type == "date"
+        ]
+        self._header_predicates: List[Predicate] = [
+            p for p in predicates if p.has_header(player)
+        ]
+        self.needs_replay: bool = len(self._header_predicates) < len(predicates)
+
+    @classmethod
+    def from_strs(cls, exprs: List[str], player: int = 0) -> Self:
+        """
+        Parse filter expressions. Raises ValueError for invalid expressions
+        """
+        predicates: List[Predicate] = list()
+        for expr in exprs:
+            if (m := _expr_re.match(expr)) is None:
+                raise ValueError(
+                    f"invalid filter: '{expr}'. Use FIELD[=|!=|<|<=|>|>=]VALUE"
+                )
+            predicates.append(
+                Predicate(field=m.group(1), op=m.group(2), value=m.group(3))
+            )
+        return cls(predicates, player=player)
+
+    def __str__(self) -> str:
+        return " AND ".join(str(p) for p in self.predicates)
+
+    @property
+    def fields(self) -> Set[str]:
+        """Filter fields used"""
+        return {p.field for p in self.predicates}
+
+    def match_name(self, name: str) -> bool:
+        """
+        Test replay's filename. Returns False only if the replay cannot match
+        """
+        if len(self._date_predicates) == 0:
+            return True
+        if (m := _filename_date_re.match(PurePosixPath(name).name)) is None:
+            return True
+        try:
+            recorded = datetime.strptime(m.group(1), "%Y%m%d_%H%M").replace(
+                tzinfo=timezone.utc
+            )
+        except ValueError:
+            return True
+        earliest: datetime = recorded - FILENAME_TIME_SLACK
+        latest: datetime = recorded + FILENAME_TIME_SLACK
+        return all(p.may_match_dates(earliest, latest) for p in self._date_predicates)
+
+    def match_header(self, data: bytes) -> bool:
+        """
+        Test replay JSON's top-level fields before 'players_data' without parsing
+        the JSON. Returns False only if the replay cannot match
+        """
+        if len(self._header_predicates) == 0:
+            return True
+        end: int = data.find(_PLAYERS_DATA_KEY)
+        if end < 0:
+            end = len(data)
+        return all(p.match_header(data, end) for p in self._header_predicates)
+
+    def match(self, replay: EnrichedReplay) -> bool:
+        """Test an enriched replay"""
+        try:
+            return all(p.match(replay) for p in self.predicates)
+        except (AttributeError, KeyError, ValueError, TypeError) as err:
+            debug("could not filter replay: %s: %s", replay.title, err)
+        return False
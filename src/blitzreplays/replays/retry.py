@@ -0,0 +1,157 @@
+import logging
+from asyncio import sleep
+from heapq import heappop, heappush
+from itertools import count
+from random import uniform
+from time import monotonic
+from typing import Generic, Iterator, List, Self, Tuple, TypeVar
+
+logger = logging.getLogger()
+error = logger.error
+message = logger.warning
+verbose = logger.info
+debug = logger.debug
+
+##############################################
+#
+## Constants
+#
+##############################################
+
+RETRY_MAX_ATTEMPTS: int = 5
+RETRY_BACKOFF: float = 1.0  # seconds, doubled after each attempt
+RETRY_BACKOFF_MAX: float = 60.0
+
+BREAKER_THRESHOLD: int = 5  # consecutive failures before pausing requests
+BREAKER_PAUSE: float = 10.0  # seconds, doubled while the failures continue
+BREAKER_PAUSE_MAX: float = 300.0
+
+T = TypeVar("T")
+
+
+def backoff(
+    attempt: int, base: float = RETRY_BACKOFF, max_delay: float = RETRY_BACKOFF_MAX
+) -> float:
+    """
+    Exponential backoff delay with jitter for a retry 'attempt' (0-based)
+    """
+    delay: float = min(base * (2**attempt), max_delay)
+    return uniform(delay / 2, delay)
+
+
+##############################################
+#
+## RetryQueue
+#
+##############################################
+
+
+class RetryQueue(Generic[T]):
+    """
+    Items waiting for a retry ordered by the time their retry is due.
+
+    Each put() increases the item's attempt count and delays the retry
+    with exponential backoff.
+    """
+
+    def __init__(self: Self, max_attempts: int = RETRY_MAX_ATTEMPTS):
+        self.max_attempts: int = max_attempts
+        self._heap: List[Tuple[float, int, int, T]] = list()  # due, seq, attempt, item
+        self._seq: Iterator[int] = count()
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def put(self, item: T, attempt: int) -> bool:
+        """
+        Schedule a retry of a failed 'attempt' (0-based).
+        Returns False if the item has no attempts left.
+        """
+        if attempt + 1 >= self.max_attempts:
+            return False
+        heappush(
+            self._heap,
+            (monotonic() + backoff(attempt), next(self._seq), attempt + 1, item),
+        )
+        return True
+
+    def pop_due(self) -> List[Tuple[T, int]]:
+        """
+        Return (item, attempt) of retries that are due
+        """
+        res: List[Tuple[T, int]] = list()
+        now: float = monotonic()
+        while len(self._heap) > 0 and self._heap[0][0] <= now:
+            _, _, attempt, item = heappop(self._heap)
+            res.append((item, attempt))
+        return res
+
+    async def get(self) -> Tuple[T, int] | None:
+        """
+        Wait for the next retry to be due. Returns None if the queue is empty
+        """
+        while len(self._heap) > 0:
+            if (delay := self._heap[0][0] - monotonic()) > 0:
+                await sleep(delay)
+                continue
+            _, _, attempt, item = heappop(self._heap)
+            return item, attempt
+        return None
+
+
+##############################################
+#
+## CircuitBreaker
+#
+##############################################
+
+
+class CircuitBreaker:
+    """
+    Pause API requests after repeated consecutive failures.
+
+    After 'threshold' consecutive failures the circuit opens and wait() blocks
+    for 'pause' seconds. If the first requests after the pause fail, the
+    circuit opens again with a doubled pause. A success resets the breaker.
+    """
+
+    def __init__(
+        self: Self,
+        name: str = "WG API",
+        threshold: int = BREAKER_THRESHOLD,
+        pause: float = BREAKER_PAUSE,
+        max_pause: float = BREAKER_PAUSE_MAX,
+    ):
+        self.name: str = name
+        self.threshold: int = threshold
+        self._min_pause: float = pause
+        self._max_pause: float = max_pause
+        self._pause: float = pause
+        self._failures: int = 0
+        self._open_until: float = 0
+
+    @property
+    def is_open(self) -> bool:
+        return monotonic() < self._open_until
+
+    async def wait(self) -> None:
+        """Wait until the circuit is closed"""
+        while (delay := self._open_until - monotonic()) > 0:
+            await sleep(delay)
+
+    def success(self) -> None:
+        self._failures = 0
+        self._pause = self._min_pause
+
+    def failure(self) -> bool:
+        """
+        Record a failed request. Returns True if the circuit was opened
+        """
+        self._failures += 1
+        if self._failures < self.threshold or self.is_open:
+            return False
+        message(f"{self.name}: requests failing, pausing for {self._pause:.0f} seconds")
+        self._open_until = monotonic() + self._pause
+        self._pause = min(2 * self._pause, self._max_pause)
+        self._failures = self.threshold - 1  # open again if the next request fails
+        return True
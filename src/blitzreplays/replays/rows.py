@@ -0,0 +1,235 @@
+import logging
+from datetime import datetime
+from enum import Enum
+from pathlib import Path
+from types import NoneType, UnionType
+from typing import (
+    Any,
+    Dict,
+    List,
+    Literal,
+    Self,
+    Set,
+    Tuple,
+    Type,
+    Union,
+    get_args,
+    get_origin,
+)
+
+from pydantic import BaseModel
+
+from .models_fields import PLAYER_FIELD_PREFIX, ReportField
+from .models_replay import EnrichedPlayerData, EnrichedReplay
+
+try:
+    import pyarrow as pa  # type: ignore
+    import pyarrow.parquet as pq  # type: ignore
+
+    HAS_PYARROW: bool = True
+except ImportError:
+    HAS_PYARROW = False
+
+logger = logging.getLogger()
+error = logger.error
+message = logger.warning
+verbose = logger.info
+debug = logger.debug
+
+##############################################
+#
+## RowExporter
+#
+##############################################
+
+ROWS_BATCH: int = 10000  # rows written to a file at a time
+
+# replay fields used by the reports in addition to ReportField._replay_fields
+_REPLAY_KEY_FIELDS: List[str] = [
+    "title_uniq",
+    "battle_start_time",
+    "player",
+    "battle_result",
+    "battle_type",
+    "room_type",
+    "mastery_badge",
+]
+REPLAY_ROW_FIELDS: List[str] = _REPLAY_KEY_FIELDS + [
+    field for field in ReportField._replay_fields if field not in _REPLAY_KEY_FIELDS
+]
+PLAYER_ROW_FIELDS: List[str] = [
+    field.removeprefix(PLAYER_FIELD_PREFIX) for field in ReportField._player_fields
+]
+
+
+def players_filename(filename: Path) -> Path:
+    """Return the file player rows are exported to"""
+    return filename.with_name(f"{filename.stem}_players{filename.suffix}")
+
+
+def _value(value: Any) -> Any:
+    if isinstance(value, Enum):
+        return value.value
+    return value
+
+
+def arrow_type(annotation: Any) -> "pa.DataType | None":
+    """
+    Return the Arrow type of a model field's type annotation.
+    Returns None if the type is not supported
+    """
+    origin: Any = get_origin(annotation)
+    args: Tuple[Any, ...] = get_args(annotation)
+    if origin in (Union, UnionType):
+        types: Set[Any] = {arg for arg in args if arg is not NoneType}
+        if len(types) == 1:
+            return arrow_type(types.pop())
+        if types == {int, float}:
+            return pa.float64()
+        return None
+    if origin is Literal:
+        return arrow_type(Union[tuple({type(arg) for arg in args})])
+    if origin is list:
+        if len(args) == 1 and (item := arrow_type(args[0])) is not None:
+            return pa.list_(item)
+        return None
+    if not isinstance(annotation, type):
+        return None
+    if issubclass(annotation, Enum):  # exported as values
+        return arrow_type(Union[tuple({type(e.value) for e in annotation})])
+    if issubclass(annotation, bool):
+        return pa.bool_()
+    if issubclass(annotation, int):
+        return pa.int64()
+    if issubclass(annotation, float):
+        return pa.float64()
+    if issubclass(annotation, str):
+        return pa.string()
+    if issubclass(annotation, datetime):
+        return pa.timestamp("us", tz="UTC")
+    return None
+
+
+def model_types(
+    model: Type[BaseModel], fields: List[str]
+) -> Dict[str, "pa.DataType | None"]:
+    """
+    Return the Arrow types of a model's fields. The type of a field
+    that is not declared in the model is None
+    """
+    res: Dict[str, pa.DataType | None] = dict()
+    for field in fields:
+        try:
+            res[field] = arrow_type(model.model_fields[field].annotation)
+        except KeyError:
+            res[field] = None
+    return res
+
+
+class ParquetTable:
+    """
+    Write rows to a Parquet file in batches of ROWS_BATCH rows.
+
+    The schema is declared from the column types given. Columns of unknown
+    type (None) are written as strings.
+    """
+
+    def __init__(self: Self, filename: Path, columns: Dict[str, "pa.DataType | None"]):
+        self.filename: Path = filename
+        self.rows: int = 0
+        self._schema: pa.Schema = pa.schema(
+            [
+                (column, pa.string() if dtype is None else dtype)
+                for column, dtype in columns.items()
+            ]
+        )
+        self._str_columns: List[bool] = [dtype is None for dtype in columns.values()]
+        self._batch: Dict[str, List[Any]] = {column: list() for column in columns}
+        self._batch_rows: int = 0
+        self._writer: pq.ParquetWriter | None = None
+        self._closed: bool = False
+
+    def append(self, row: List[Any]) -> None:
+        for column, is_str, value in zip(self._batch.values(), self._str_columns, row):
+            column.append(str(value) if is_str and value is not None else value)
+        self._batch_rows += 1
+        if self._batch_rows >= ROWS_BATCH:
+            self.flush()
+
+    def flush(self) -> None:
+        """Write the buffered rows"""
+        if self._batch_rows == 0 and self._writer is not None:
+            return
+        if self._writer is None:
+            self._writer = pq.ParquetWriter(self.filename, self._schema)
+        self._writer.write_table(pa.Table.from_pydict(self._batch, schema=self._schema))
+        self.rows += self._batch_rows
+        for column in self._batch.values():
+            column.clear()
+        self._batch_rows = 0
+
+    def close(self) -> None:
+        if self._closed:
+            return
+        self.flush()
+        if self._writer is not None:
+            self._writer.close()
+        self._closed = True
+
+
+class RowExporter:
+    """
+    Export enriched replays to Parquet files: one row per replay to 'filename'
+    and one row per player to a '_players' suffixed file. Requires pyarrow.
+    """
+
+    def __init__(self: Self, filename: Path):
+        if not HAS_PYARROW:
+            raise ImportError("pyarrow is required to export rows")
+        self.filename: Path = filename
+        self._replays = ParquetTable(
+            filename, model_types(EnrichedReplay, REPLAY_ROW_FIELDS)
+        )
+        self._players = ParquetTable(
+            players_filename(filename),
+            {"title_uniq": pa.string(), "account_id": pa.int64()}
+            | model_types(EnrichedPlayerData, PLAYER_ROW_FIELDS),
+        )
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    @classmethod
+    def get_fields(cls) -> Set[str]:
+        """
+        Return the replay and player ('player.' prefixed) fields exported
+        """
+        return set(REPLAY_ROW_FIELDS) | {
+            PLAYER_FIELD_PREFIX + field for field in PLAYER_ROW_FIELDS
+        }
+
+    @property
+    def rows(self) -> int:
+        """Number of replay rows written"""
+        return self._replays.rows
+
+    def add(self, replay: EnrichedReplay) -> None:
+        """Add a replay with stats"""
+        self._replays.append(
+            [_value(getattr(replay, field, None)) for field in REPLAY_ROW_FIELDS]
+        )
+        for account_id, player_data in replay.players_dict.items():
+            self._players.append(
+                [replay.title_uniq, account_id]
+                + [
+                    _value(getattr(player_data, field, None))
+                    for field in PLAYER_ROW_FIELDS
+                ]
+            )
+
+    def close(self) -> None:
+        self._replays.close()
+        self._players.close()
@@ -0,0 +1,102 @@
+import logging
+from math import ceil, inf
+from random import getrandbits
+from typing import Iterable, List, Self, Tuple
+
+logger = logging.getLogger()
+error = logger.error
+message = logger.warning
+verbose = logger.info
+debug = logger.debug
+
+##############################################
+#
+## QuantileSketch
+#
+##############################################
+
+SKETCH_K: int = 200  # rank error ~1.7/k, memory ~3k values
+
+
+class QuantileSketch:
+    """
+    KLL quantile sketch of a stream of values.
+
+    The sketch keeps a bounded number of values in levels of compactors.
+    A value on level h stands for 2^h values of the stream. When the sketch
+    is full, a level is sorted and every other value (random offset) is
+    promoted to the next level. Sketches can be merged in any order, which
+    makes them suitable for accumulating report categories.
+    """
+
+    def __init__(self: Self, values: Iterable[float] = (), k: int = SKETCH_K):
+        self.k: int = k
+        self._levels: List[List[float]] = [list(values)]
+        self._size: int = len(self._levels[0])
+        self._max_size: int = self._capacity_total()
+        if self._size >= self._max_size:
+            self._compress()
+
+    def __len__(self) -> int:
+        """Number of values in the stream"""
+        return sum(len(level) << h for h, level in enumerate(self._levels))
+
+    def _capacity(self, level: int) -> int:
+        depth: int = len(self._levels) - level - 1
+        return max(2, ceil(self.k * (2 / 3) ** depth))
+
+    def _capacity_total(self) -> int:
+        return sum(self._capacity(h) for h in range(len(self._levels)))
+
+    def _compress(self) -> None:
+        """Compact levels until the sketch is below its capacity"""
+        while self._size >= self._max_size:
+            for h in range(len(self._levels)):
+                level: List[float] = self._levels[h]
+                if len(level) < self._capacity(h):
+                    continue
+                if h + 1 == len(self._levels):
+                    self._levels.append(list())
+                    self._max_size = self._capacity_total()
+                level.sort()
+                # promote an even number of values, an odd one stays on the level
+                end: int = len(level) - (len(level) & 1)
+                self._levels[h + 1].extend(level[getrandbits(1) : end : 2])
+                del level[:end]
+                self._size = sum(len(level) for level in self._levels)
+                if self._size < self._max_size:
+                    break
+
+    def add(self, value: float) -> None:
+        self._levels[0].append(value)
+        self._size += 1
+        if self._size >= self._max_size:
+            self._compress()
+
+    def merge(self, other: "QuantileSketch") -> None:
+        """Merge values of 'other' sketch"""
+        while len(self._levels) < len(other._levels):
+            self._levels.append(list())
+        self._max_size = self._capacity_total()
+        for level, other_level in zip(self._levels, other._levels):
+            level.extend(other_level)
+        self._size += other._size
+        if self._size >= self._max_size:
+            self._compress()
+
+    def quantile(self, q: float) -> float:
+        """
+        Return an estimate of the 'q' quantile (0..1). inf if the sketch is empty
+        """
+        weighted: List[Tuple[float, int]] = sorted(
+            (value, 1 << h) for h, level in enumerate(self._levels) for value in level
+        )
+        if len(weighted) == 0:
+            return inf
+        rank: float = q * sum(weight for _, weight in weighted)
+        total: int = 0
+        for value, weight in weighted:
+            total += weight
+            if total >= rank:
+                return value
+        return weighted[-1][0]
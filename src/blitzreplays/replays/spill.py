@@ -0,0 +1,161 @@
+import logging
+import pickle
+import struct
+import zlib
+from tempfile import TemporaryFile
+from typing import IO, Iterable, Iterator, Self, Set, Tuple
+
+from blitzmodels import AccountId
+
+from .models_replay import EnrichedPlayerData, EnrichedReplay
+
+logger = logging.getLogger()
+error = logger.error
+message = logger.warning
+verbose = logger.info
+debug = logger.debug
+
+##############################################
+#
+## ReplaySpill
+#
+##############################################
+
+# replay fields required by player filters, stats and analysis regardless of the config
+SPILL_REPLAY_FIELDS: Set[str] = {
+    "allies",
+    "arena_unique_id",
+    "battle_start_time",
+    "battle_tier",
+    "enemies",
+    "plat_mate",
+    "player",
+    "protagonist",
+    "title",
+    "title_uniq",
+}
+SPILL_PLAYER_FIELDS: Set[str] = {
+    "avgdmg",
+    "battles",
+    "dbid",
+    "squad_index",
+    "tank_id",
+    "tank_tier",
+    "tank_type",
+    "vehicle_descr",
+    "wr",
+}
+
+SPILL_COMPRESS_LEVEL: int = 1
+_RECORD_HEADER = struct.Struct("<I")
+
+
+def split_fields(fields: Iterable[str]) -> Tuple[Set[str], Set[str]]:
+    """
+    Split fields into replay fields and player fields ('player.' prefix removed)
+    """
+    replay_fields: Set[str] = set()
+    player_fields: Set[str] = set()
+    for field in fields:
+        if field.startswith("player."):
+            player_fields.add(field.removeprefix("player."))
+        else:
+            replay_fields.add(field)
+    return replay_fields, player_fields
+
+
+class ReplaySpill:
+    """
+    Temporary on-disk store for enriched replays waiting for analysis.
+
+    Replays are reduced to the fields the analysis uses, pickled and
+    compressed into an anonymous temporary file that is read back
+    sequentially once and removed when closed.
+    """
+
+    def __init__(
+        self: Self,
+        fields: Iterable[str],
+        threshold: int,
+        compress_level: int = SPILL_COMPRESS_LEVEL,
+    ):
+        """
+        'fields' are the replay and player ('player.' prefixed) fields used in the analysis.
+        Replays are spilled once 'threshold' replays are waiting in memory.
+        """
+        replay_fields, player_fields = split_fields(fields)
+        self._replay_fields: Set[str] = (replay_fields | SPILL_REPLAY_FIELDS) - {
+            "players_dict"
+        }
+        self._player_fields: Set[str] = player_fields | SPILL_PLAYER_FIELDS
+        self.threshold: int = threshold
+        self._compress_level: int = compress_level
+        self._file: IO[bytes] | None = None
+        self._count: int = 0
+        self._bytes: int = 0
+
+    def __len__(self) -> int:
+        return self._count
+
+    @property
+    def bytes(self) -> int:
+        """Bytes written to the spill file"""
+        return self._bytes
+
+    def should_spill(self, in_memory: int) -> bool:
+        """Test whether the next replay should be spilled to disk"""
+        return self.threshold > 0 and in_memory >= self.threshold
+
+    def slim(self, replay: EnrichedReplay) -> EnrichedReplay:
+        """
+        Return a copy of the replay with only the fields needed for analysis
+        """
+        players: dict[AccountId, EnrichedPlayerData] = dict()
+        for account_id, player_data in replay.players_dict.items():
+            players[account_id] = EnrichedPlayerData.model_construct(
+                **{
+                    field: getattr(player_data, field)
+                    for field in self._player_fields
+                    if hasattr(player_data, field)
+                }
+            )
+        return EnrichedReplay.model_construct(
+            players_dict=players,
+            **{
+                field: getattr(replay, field)
+                for field in self._replay_fields
+                if hasattr(replay, field)
+            },
+        )
+
+    def put(self, replay: EnrichedReplay) -> None:
+        """Spill a replay to disk"""
+        if self._file is None:
+            self._file = TemporaryFile(prefix="blitz-replays-", suffix=".spill")
+            debug("spilling replays to disk")
+        data: bytes = zlib.compress(
+            pickle.dumps(self.slim(replay), protocol=pickle.HIGHEST_PROTOCOL),
+            self._compress_level,
+        )
+        self._file.write(_RECORD_HEADER.pack(len(data)))
+        self._file.write(data)
+        self._count += 1
+        self._bytes += _RECORD_HEADER.size + len(data)
+
+    def __iter__(self) -> Iterator[EnrichedReplay]:
+        """Read spilled replays back in the order they were written"""
+        if self._file is None:
+            return
+        self._file.flush()
+        self._file.seek(0)
+        while (
+            len(header := self._file.read(_RECORD_HEADER.size)) == _RECORD_HEADER.size
+        ):
+            (size,) = _RECORD_HEADER.unpack(header)
+            yield pickle.loads(zlib.decompress(self._file.read(size)))
+
+    def close(self) -> None:
+        """Close and remove the spill file"""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
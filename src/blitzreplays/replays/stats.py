@@ -0,0 +1,350 @@
+import typer
+from typer import Context, Option, Argument
+from typing import Annotated, Optional, List, Set, Tuple, Iterator
+from asyncio import create_task, sleep, to_thread, Task
+import logging
+from pathlib import Path
+from configparser import ConfigParser
+from alive_progress import alive_bar  # type: ignore
+
+from pyutils import FileQueue, EventCounter, IterableQueue, AsyncTyper
+from pyutils.utils import set_config
+from blitzmodels import AccountId, Region, WGApi, WGApiWoTBlitzTankopedia
+
+from .args import EnumStatsTypes, StatsMode
+from .archive import iter_archive, split_archives
+from .cache import StatsCache
+from .models_replay import read_bytes, replay_account_ids
+from .pack import ReplayPack, split_packs
+from .ratelimit import RateLimiter, rate_limit_file
+from .store import STORE_KINDS, StatsStore, StoreKind
+from .analyze import (
+    DEFAULT_STATS_TYPE,
+    WG_APP_ID,
+    WG_RATE_LIMIT,
+    WG_REGION,
+    WG_WORKERS,
+    MiB,
+    callback_paths,
+    iter_chunks,
+)
+
+app = AsyncTyper()
+
+logger = logging.getLogger()
+error = logger.error
+message = logger.warning
+verbose = logger.info
+debug = logger.debug
+
+############################################################################################
+#
+# Defaults
+#
+############################################################################################
+
+PREFETCH_CACHE_MEM: int = 16  # MiB, stats are only written to the store
+
+
+@app.callback()
+def stats(
+    ctx: Context,
+    stats_cache_fn: Annotated[
+        Optional[Path],
+        Option(
+            "--stats-cache",
+            show_default=False,
+            help="SQLite file to store player stats to (default: REPLAYS_ANALYZE.stats_cache config)",
+        ),
+    ] = None,
+) -> None:
+    """
+    manage player stats cache used by 'analyze'
+    """
+    try:
+        config: ConfigParser = ctx.obj["config"]
+        if (
+            stats_cache := set_config(
+                config,
+                "",
+                "REPLAYS_ANALYZE",
+                "stats_cache",
+                str(stats_cache_fn) if stats_cache_fn else None,
+            )
+        ) == "":
+            error(
+                "no stats cache file set: use --stats-cache or 'stats_cache' in [REPLAYS_ANALYZE] config"
+            )
+            raise typer.Exit(code=1)
+        ctx.obj["stats_cache"] = Path(stats_cache).expanduser()
+        debug("stats_cache=%s", str(ctx.obj["stats_cache"]))
+    except KeyError as err:
+        error("%s: %s", type(err), err)
+        raise typer.Exit(code=1)
+
+
+def iter_replay_data(
+    sources: List[Path], seen: Set[str]
+) -> Iterator[Tuple[str, bytes]]:
+    """
+    Read replays not 'seen' before from replay packs and archives
+    """
+    for source in sources:
+        try:
+            replays: Iterator[Tuple[str, bytes]]
+            if ReplayPack.is_pack(source):
+                replays = iter(ReplayPack(source))
+            else:
+                replays = iter_archive(source, filter="*.wotbreplay.json")
+            for name, data in replays:
+                if name not in seen:
+                    seen.add(name)
+                    yield name, data
+        except Exception as err:
+            error(f"could not read replays from: {source}: {type(err)}: {err}")
+
+
+@app.async_command()
+async def prefetch(
+    ctx: Context,
+    wg_app_id: Annotated[Optional[str], Option(help="WG app ID")] = None,
+    wg_region: Annotated[
+        Optional[Region],
+        Option(show_default=False, help=f"WG API region (default: {WG_REGION})"),
+    ] = None,
+    wg_rate_limit: Annotated[
+        Optional[float],
+        Option(show_default=False, help="WG API rate limit, default=10/sec"),
+    ] = None,
+    wg_rate_limit_fn: Annotated[
+        Optional[Path],
+        Option(
+            "--wg-rate-limit-file",
+            show_default=False,
+            help="share WG API rate limit with other processes using the same file (default: WG.rate_limit_file config)",
+        ),
+    ] = None,
+    stats_type_param: Annotated[
+        Optional[EnumStatsTypes],
+        Option(
+            "--stats-type",
+            show_default=False,
+            help=f"stats to fetch (default: REPLAYS_ANALYZE.stats_type config or '{DEFAULT_STATS_TYPE}')",
+        ),
+    ] = None,
+    watch: Annotated[
+        int,
+        Option(
+            min=0,
+            help="re-scan replays for new players every N seconds, 0=scan only once",
+        ),
+    ] = 0,
+    replays: List[Path] = Argument(
+        help="replay files, directories, replay packs (*.wotbpack) or zip/tar archives",
+        callback=callback_paths,
+    ),
+) -> None:
+    """
+    fetch stats of players in the replays to the stats cache
+    """
+    stats_cache_fn: Path
+    tankopedia: WGApiWoTBlitzTankopedia
+    stats_type: StatsMode
+    try:
+        config: ConfigParser = ctx.obj["config"]
+        tankopedia = ctx.obj["tankopedia"]
+        stats_cache_fn = ctx.obj["stats_cache"]
+        wg_app_id = set_config(config, WG_APP_ID, "WG", "app_id", wg_app_id)
+        region: Region
+        if wg_region is None:
+            region = Region(set_config(config, WG_REGION, "WG", "default_region", None))
+        else:
+            region = wg_region
+        wg_rate_limit = set_config(
+            config, WG_RATE_LIMIT, "WG", "rate_limit", wg_rate_limit
+        )
+        wg_rate_limit_fn = rate_limit_file(config, "WG", wg_rate_limit_fn)
+        if stats_type_param is None:
+            stats_type = EnumStatsTypes[
+                set_config(
+                    config, DEFAULT_STATS_TYPE, "REPLAYS_ANALYZE", "stats_type", None
+                )
+            ].value  # type: ignore
+        else:
+            stats_type = stats_type_param.value  # type: ignore
+        debug("stats_type=%s", stats_type)
+    except (KeyError, ValueError) as err:
+        error(f"could not read all the arguments: {type(err)}: {err}")
+        raise typer.Exit(code=1)
+
+    stats = EventCounter("Prefetch stats")
+    packs, replays = split_packs(replays)
+    archives, replays = split_archives(replays)
+    seen: Set[str] = set()
+
+    # requests are rate limited by rate_limiter shared by the stats workers
+    wg_api = WGApi(app_id=wg_app_id, rate_limit=0, default_region=region)
+    rate_limiter = RateLimiter("WG API", rate=wg_rate_limit, filename=wg_rate_limit_fn)
+    stats_store = StatsStore(stats_cache_fn)
+    try:
+        await stats_store.open()
+        await rate_limiter.open()
+        stats_cache = StatsCache(
+            wg_api=wg_api,
+            stats_type=stats_type,
+            tankopedia=tankopedia,
+            store=stats_store,
+            max_bytes=PREFETCH_CACHE_MEM * MiB,
+            rate_limiter=rate_limiter,
+        )
+        while True:
+            # players seen again are fetched if their stats have expired
+            stats_cache.reset_queued()
+            accountQ: IterableQueue[AccountId] = IterableQueue()
+            await accountQ.add_producer()
+            api_workers: List[Task] = list()
+            for _ in range(WG_WORKERS):
+                api_workers.append(
+                    create_task(stats_cache.stats_worker(accountQ=accountQ))
+                )
+
+            fileQ = FileQueue(filter="*.wotbreplay.json", case_sensitive=False)
+            await fileQ.mk_queue(replays)
+            with alive_bar(
+                total=None, title="Reading player ids", enrich_print=False
+            ) as bar:
+                async for fn in fileQ:
+                    if fn.name in seen:
+                        continue
+                    try:
+                        data: bytes = await to_thread(read_bytes, fn)
+                    except Exception as err:
+                        # replays may be removed while watching: retry on next scan
+                        error(f"could not read replay: {fn}: {type(err)}: {err}")
+                        stats.log("errors")
+                        continue
+                    seen.add(fn.name)
+                    await queue_accounts(fn.name, data, stats_cache, accountQ, stats)
+                    bar()
+                async for name, data in iter_chunks(
+                    iter_replay_data(packs + archives, seen)
+                ):
+                    await queue_accounts(name, data, stats_cache, accountQ, stats)
+                    bar()
+            await accountQ.finish()
+
+            with alive_bar(
+                total=stats_cache.accounts_queued,
+                title="Fetching player stats",
+                enrich_print=False,
+            ) as bar:
+                count: int = 0
+                while not accountQ.is_done:
+                    bar(accountQ.count - count)
+                    count = accountQ.count
+                    await sleep(0.5)
+                bar(accountQ.count - count)
+            await accountQ.join()
+            await stats.gather_stats(api_workers)
+
+            if watch == 0:
+                break
+            verbose(stats.print(do_print=False))
+            await sleep(watch)
+    except KeyboardInterrupt:
+        message("canceled")
+    except Exception as err:
+        error(f"{type(err)}: {err}")
+    finally:
+        await stats_store.close()
+        await rate_limiter.close()
+        await wg_api.close()
+    stats.print()
+
+
+@app.async_command()
+async def export(
+    ctx: Context,
+    stats_type: Annotated[
+        Optional[List[str]],
+        Option(
+            "--stats-type",
+            show_default=False,
+            help=f"stats to export: {', '.join(STORE_KINDS)} (default: all)",
+        ),
+    ] = None,
+    filename: Path = Argument(help="file to export the stats cache to"),
+) -> None:
+    """
+    export stats cache to a file for importing elsewhere
+    """
+    stats_cache_fn: Path = ctx.obj["stats_cache"]
+    kinds: List[StoreKind] = list(STORE_KINDS)
+    if stats_type is not None:
+        if invalid := set(stats_type) - set(STORE_KINDS):
+            error(f"invalid --stats-type: {', '.join(invalid)}")
+            raise typer.Exit(code=1)
+        kinds = [kind for kind in STORE_KINDS if kind in stats_type]
+    if not stats_cache_fn.is_file():
+        error(f"stats cache not found: {stats_cache_fn}")
+        raise typer.Exit(code=1)
+
+    stats = EventCounter("Export stats")
+    try:
+        async with StatsStore(stats_cache_fn, ttl=0) as stats_store:
+            stats.log(
+                "accounts exported", await stats_store.export_stats(filename, kinds)
+            )
+    except Exception as err:
+        error(f"could not export stats to {filename}: {type(err)}: {err}")
+        raise typer.Exit(code=1)
+    stats.print()
+
+
+@app.async_command("import")
+async def import_(
+    ctx: Context,
+    files: List[Path] = Argument(help="stats files exported with 'stats export'"),
+) -> None:
+    """
+    import stats from files keeping the newest stats of each account
+    """
+    stats_cache_fn: Path = ctx.obj["stats_cache"]
+    stats = EventCounter("Import stats")
+    errors: int = 0
+    async with StatsStore(stats_cache_fn) as stats_store:
+        for fn in files:
+            try:
+                read, updated = await stats_store.import_stats(fn)
+                stats.log("accounts read", read)
+                stats.log("accounts updated", updated)
+                stats.log("files imported")
+            except Exception as err:
+                error(f"could not import stats from {fn}: {type(err)}: {err}")
+                stats.log("errors")
+                errors += 1
+    stats.print()
+    if errors > 0:
+        raise typer.Exit(code=1)
+
+
+async def queue_accounts(
+    name: str,
+    data: bytes,
+    stats_cache: StatsCache,
+    accountQ: IterableQueue[AccountId],
+    stats: EventCounter,
+) -> None:
+    """
+    Read account_ids from replay JSON and queue new ones for fetching stats
+    """
+    try:
+        account_ids: List[AccountId] = replay_account_ids(data)
+        stats.log("replays read")
+        stats.log(
+            "accounts queued",
+            await stats_cache.queue_accounts(account_ids, accountQ=accountQ),
+        )
+    except Exception as err:
+        error(f"could not read player ids from replay: {name}: {type(err)}: {err}")
+        stats.log("errors")
@@ -0,0 +1,522 @@
+import logging
+import os
+import struct
+import zlib
+from asyncio import to_thread
+from collections import OrderedDict
+from itertools import islice
+from pathlib import Path
+from socket import gethostname
+from uuid import uuid4
+from tempfile import mkstemp
+from time import time
+from typing import (
+    AsyncIterator,
+    BinaryIO,
+    Callable,
+    Generic,
+    Iterable,
+    Iterator,
+    List,
+    Literal,
+    Self,
+    Tuple,
+    TypeVar,
+)
+
+import aiosqlite
+from pyutils import EventCounter
+
+logger = logging.getLogger()
+error = logger.error
+message = logger.warning
+verbose = logger.info
+debug = logger.debug
+
+##############################################
+#
+## Constants
+#
+##############################################
+
+STORE_TTL: int = 7 * 24 * 3600  # 7 days
+STORE_COMPRESS_LEVEL: int = 6
+HISTORY_KEYFRAME: int = 8  # store a full snapshot after N delta snapshots
+STORE_TIMEOUT: float = 60.0  # seconds to wait for a lock held by another process
+CLAIM_TTL: int = 120  # seconds after an unreleased claim expires, refreshed on retry
+
+StoreKind = Literal["player", "tank"]  # WG API account/info vs. tank/stats
+STORE_KINDS: Tuple[StoreKind, ...] = ("player", "tank")
+
+EXPORT_MAGIC: bytes = b"BRSTATS1\n"
+EXPORT_BUFFER_SIZE: int = 1 << 20  # 1 MiB
+IMPORT_BATCH: int = 1000
+
+_EXPORT_RECORD = struct.Struct("<BqqI")  # kind, account_id, updated, data length
+_ExportRecord = Tuple[int, int, int, bytes]
+
+K = TypeVar("K")
+V = TypeVar("V")
+
+
+##############################################
+#
+## LRUCache
+#
+##############################################
+
+
+class LRUCache(Generic[K, V]):
+    """
+    In-memory LRU cache bounded by the number of entries and/or estimated bytes.
+
+    Entries are evicted least recently used first. Evicted entries are
+    expected to be available from a backing store.
+    """
+
+    def __init__(
+        self: Self,
+        max_items: int = 0,
+        max_bytes: int = 0,
+        sizeof: Callable[[V], int] = lambda _: 1,
+        name: str = "Stats cache",
+    ):
+        """
+        'max_items' and 'max_bytes' of 0 means no limit. 'sizeof' estimates an entry's bytes
+        """
+        self._data: OrderedDict[K, Tuple[V, int]] = OrderedDict()
+        self._max_items: int = max_items
+        self._max_bytes: int = max_bytes
+        self._sizeof: Callable[[V], int] = sizeof
+        self._bytes: int = 0
+        self.stats = EventCounter(name)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: K) -> bool:
+        return key in self._data
+
+    @property
+    def bytes(self) -> int:
+        """Estimated size of the cached entries in bytes"""
+        return self._bytes
+
+    def get(self, key: K) -> V | None:
+        """Get an entry and mark it as most recently used"""
+        try:
+            value, _ = self._data[key]
+            self._data.move_to_end(key)
+            self.stats.log("cache hits")
+            return value
+        except KeyError:
+            self.stats.log("cache misses")
+            return None
+
+    def put(self, key: K, value: V) -> None:
+        """Add or replace an entry and evict entries if over limits"""
+        size: int = self._sizeof(value)
+        if (old := self._data.pop(key, None)) is not None:
+            self._bytes -= old[1]
+        self._data[key] = (value, size)
+        self._bytes += size
+        self._evict()
+
+    def _evict(self) -> None:
+        while len(self._data) > 1 and (
+            (self._max_items > 0 and len(self._data) > self._max_items)
+            or (self._max_bytes > 0 and self._bytes > self._max_bytes)
+        ):
+            _, (_, size) = self._data.popitem(last=False)
+            self._bytes -= size
+            self.stats.log("cache evictions")
+
+
+##############################################
+#
+## StatsStore
+#
+##############################################
+
+
+class StatsStore:
+    """
+    Persistent SQLite store for WG API stats responses.
+
+    Stats are stored as compressed bytes per account and stats kind. Without
+    a filename a temporary database is used and removed when closed.
+
+    Each stored snapshot is also appended to a history table so stats can
+    be resolved to the time of a battle. History snapshots are stored as
+    deltas to the previous snapshot with a full snapshot (keyframe) every
+    HISTORY_KEYFRAME snapshots.
+
+    The store can be shared by several processes: the database uses WAL
+    journaling and upserts, and accounts being fetched are claimed in
+    the 'claims' table so other processes can wait for the results
+    instead of fetching the same stats.
+    """
+
+    def __init__(self: Self, filename: Path | None = None, ttl: int = STORE_TTL):
+        self._temporary: bool = filename is None
+        if filename is None:
+            fd, fn = mkstemp(prefix="blitz-replays-", suffix=".sqlite")
+            os.close(fd)
+            filename = Path(fn)
+        self.filename: Path = filename
+        self.ttl: int = ttl
+        self.owner: str = f"{gethostname()}:{os.getpid()}:{uuid4().hex[:8]}"
+        self._db: aiosqlite.Connection | None = None
+
+    async def open(self) -> Self:
+        if self._db is None:
+            self.filename.parent.mkdir(parents=True, exist_ok=True)
+            self._db = await aiosqlite.connect(self.filename, timeout=STORE_TIMEOUT)
+            await self._db.execute("PRAGMA journal_mode=WAL")
+            await self._db.execute("PRAGMA synchronous=NORMAL")
+            await self._db.execute(
+                """CREATE TABLE IF NOT EXISTS claims (
+                    kind TEXT NOT NULL,
+                    account_id INTEGER NOT NULL,
+                    owner TEXT NOT NULL,
+                    claimed INTEGER NOT NULL,
+                    PRIMARY KEY (kind, account_id)
+                ) WITHOUT ROWID"""
+            )
+            await self._db.execute(
+                """CREATE TABLE IF NOT EXISTS stats (
+                    kind TEXT NOT NULL,
+                    account_id INTEGER NOT NULL,
+                    updated INTEGER NOT NULL,
+                    data BLOB NOT NULL,
+                    PRIMARY KEY (kind, account_id)
+                )"""
+            )
+            await self._db.execute(
+                """CREATE TABLE IF NOT EXISTS history (
+                    kind TEXT NOT NULL,
+                    account_id INTEGER NOT NULL,
+                    updated INTEGER NOT NULL,
+                    chain INTEGER NOT NULL,
+                    data BLOB NOT NULL,
+                    PRIMARY KEY (kind, account_id, updated)
+                ) WITHOUT ROWID"""
+            )
+            await self._db.commit()
+            debug("opened stats store: %s", str(self.filename))
+        return self
+
+    async def close(self) -> None:
+        if self._db is not None:
+            await self._db.execute("DELETE FROM claims WHERE owner = ?", (self.owner,))
+            await self._db.commit()
+            await self._db.close()
+            self._db = None
+        if self._temporary:
+            self.filename.unlink(missing_ok=True)
+
+    async def __aenter__(self) -> Self:
+        return await self.open()
+
+    async def __aexit__(self, *exc) -> None:
+        await self.close()
+
+    @property
+    def db(self) -> aiosqlite.Connection:
+        if self._db is None:
+            raise RuntimeError("stats store is not open")
+        return self._db
+
+    def _min_updated(self) -> int:
+        return int(time()) - self.ttl if self.ttl > 0 else 0
+
+    async def get(self, kind: StoreKind, account_id: int) -> bytes | None:
+        """Get stats JSON for an account. Returns None if not found or expired"""
+        async with self.db.execute(
+            "SELECT data FROM stats WHERE kind = ? AND account_id = ? AND updated >= ?",
+            (kind, account_id, self._min_updated()),
+        ) as cursor:
+            if (row := await cursor.fetchone()) is None:
+                return None
+        return zlib.decompress(row[0])
+
+    async def has(self, kind: StoreKind, account_id: int) -> bool:
+        """Test whether there are up-to-date stats for an account"""
+        async with self.db.execute(
+            "SELECT 1 FROM stats WHERE kind = ? AND account_id = ? AND updated >= ?",
+            (kind, account_id, self._min_updated()),
+        ) as cursor:
+            return await cursor.fetchone() is not None
+
+    async def get_latest(self, kind: StoreKind, account_id: int) -> bytes | None:
+        """Get the latest stats for an account regardless of their age"""
+        async with self.db.execute(
+            "SELECT data FROM stats WHERE kind = ? AND account_id = ?",
+            (kind, account_id),
+        ) as cursor:
+            if (row := await cursor.fetchone()) is None:
+                return None
+        return zlib.decompress(row[0])
+
+    async def put(self, kind: StoreKind, account_id: int, data: bytes) -> None:
+        """Store stats JSON for an account"""
+        await self.put_many(kind, [(account_id, data)])
+
+    async def claim(self, kind: StoreKind, account_id: int) -> bool:
+        """
+        Claim an account for fetching its stats. Returns False if another
+        process has an unexpired claim for the account
+        """
+        now: int = int(time())
+        async with self.db.execute(
+            """INSERT INTO claims (kind, account_id, owner, claimed) VALUES (?, ?, ?, ?)
+                ON CONFLICT (kind, account_id) DO UPDATE
+                SET owner = excluded.owner, claimed = excluded.claimed
+                WHERE claims.owner = excluded.owner OR claims.claimed < ?""",
+            (kind, account_id, self.owner, now, now - CLAIM_TTL),
+        ) as cursor:
+            claimed: bool = cursor.rowcount > 0
+        await self.db.commit()
+        return claimed
+
+    async def release(self, kind: StoreKind, account_ids: Iterable[int]) -> None:
+        """Release claims after fetching stats"""
+        await self.db.executemany(
+            "DELETE FROM claims WHERE kind = ? AND account_id = ? AND owner = ?",
+            [(kind, account_id, self.owner) for account_id in account_ids],
+        )
+        await self.db.commit()
+
+    async def history_latest(
+        self, kind: StoreKind, account_id: int
+    ) -> Tuple[int, int] | None:
+        """
+        Return (updated, chain) of the latest snapshot in the history or None
+        if there is no history for the account. 'chain' is the number of delta
+        snapshots since the latest full snapshot
+        """
+        async with self.db.execute(
+            "SELECT updated, chain FROM history WHERE kind = ? AND account_id = ? ORDER BY updated DESC LIMIT 1",
+            (kind, account_id),
+        ) as cursor:
+            if (row := await cursor.fetchone()) is None:
+                return None
+        return row[0], row[1]
+
+    async def put_history(
+        self,
+        kind: StoreKind,
+        items: Iterable[Tuple[int, int, bytes]],
+        updated: int | None = None,
+    ) -> None:
+        """
+        Append stats snapshots (account_id, chain, data) to the history.
+        'chain' is 0 for full snapshots and the number of deltas since
+        the latest full snapshot for delta snapshots.
+
+        A snapshot replaces an account's snapshot stored at the same time.
+        It has to be a full snapshot or a delta to the snapshot before it.
+        """
+        if updated is None:
+            updated = int(time())
+        await self.db.executemany(
+            """INSERT INTO history (kind, account_id, updated, chain, data) VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (kind, account_id, updated) DO UPDATE
+                SET chain = excluded.chain, data = excluded.data""",
+            [
+                (
+                    kind,
+                    account_id,
+                    updated,
+                    chain,
+                    zlib.compress(data, STORE_COMPRESS_LEVEL),
+                )
+                for account_id, chain, data in items
+            ],
+        )
+        await self.db.commit()
+
+    async def history_nearest(
+        self, kind: StoreKind, account_id: int, at: int
+    ) -> int | None:
+        """
+        Return the time of the snapshot nearest to 'at' or None if there is no history
+        """
+        res: int | None = None
+        for sql in [
+            "SELECT updated FROM history WHERE kind = ? AND account_id = ? AND updated <= ? ORDER BY updated DESC LIMIT 1",
+            "SELECT updated FROM history WHERE kind = ? AND account_id = ? AND updated >= ? ORDER BY updated ASC LIMIT 1",
+        ]:
+            async with self.db.execute(sql, (kind, account_id, at)) as cursor:
+                if (row := await cursor.fetchone()) is not None:
+                    if res is None or abs(row[0] - at) < abs(res - at):
+                        res = row[0]
+        return res
+
+    async def get_history(
+        self, kind: StoreKind, account_id: int, updated: int
+    ) -> List[Tuple[int, bytes]]:
+        """
+        Return (chain, data) records needed to rebuild the snapshot at 'updated':
+        the latest full snapshot at or before it followed by the deltas
+        """
+        res: List[Tuple[int, bytes]] = list()
+        async with self.db.execute(
+            "SELECT chain, data FROM history WHERE kind = ? AND account_id = ? AND updated <= ? ORDER BY updated DESC LIMIT ?",
+            (kind, account_id, updated, HISTORY_KEYFRAME + 1),
+        ) as cursor:
+            async for chain, data in cursor:
+                res.append((chain, zlib.decompress(data)))
+                if chain == 0:
+                    break
+        res.reverse()
+        if len(res) == 0 or res[0][0] != 0:
+            raise ValueError(
+                f"incomplete stats history for account_id={account_id} at {updated}"
+            )
+        return res
+
+    async def iter_compressed(
+        self, kind: StoreKind
+    ) -> AsyncIterator[Tuple[int, int, bytes]]:
+        """Iterate over (account_id, updated, compressed data) of stored stats"""
+        async with self.db.execute(
+            "SELECT account_id, updated, data FROM stats WHERE kind = ? ORDER BY account_id",
+            (kind,),
+        ) as cursor:
+            async for account_id, updated, data in cursor:
+                yield account_id, updated, data
+
+    async def put_compressed(
+        self, kind: StoreKind, items: Iterable[Tuple[int, int, bytes]]
+    ) -> int:
+        """
+        Merge (account_id, updated, compressed data) stats keeping the newest
+        stats of each account. Returns the number of accounts updated.
+
+        Stats newer than an account's stats history are added to the history
+        as full snapshots, so later snapshots can be stored as deltas to them.
+        """
+        items = list(items)
+        async with self.db.executemany(
+            """INSERT INTO stats (kind, account_id, updated, data) VALUES (?, ?, ?, ?)
+                ON CONFLICT (kind, account_id) DO UPDATE
+                SET updated = excluded.updated, data = excluded.data
+                WHERE excluded.updated > stats.updated""",
+            [(kind, account_id, updated, data) for account_id, updated, data in items],
+        ) as cursor:
+            res: int = cursor.rowcount
+        # stats and full history snapshots are stored in the same format
+        await self.db.executemany(
+            """INSERT INTO history (kind, account_id, updated, chain, data)
+                SELECT ?, ?, ?, 0, ? WHERE NOT EXISTS (
+                    SELECT 1 FROM history
+                    WHERE kind = ? AND account_id = ? AND updated >= ?
+                )""",
+            [
+                (kind, account_id, updated, data, kind, account_id, updated)
+                for account_id, updated, data in items
+            ],
+        )
+        await self.db.commit()
+        return res
+
+    async def export_stats(
+        self, filename: Path, kinds: Iterable[StoreKind] = STORE_KINDS
+    ) -> int:
+        """
+        Export stats to a file. The stats are written as stored (compressed).
+        Returns the number of accounts' stats exported.
+        """
+        res: int = 0
+        tmp_fn: Path = filename.with_name(filename.name + ".tmp")
+        records: List[_ExportRecord] = list()
+        try:
+            with open(tmp_fn, "wb", buffering=EXPORT_BUFFER_SIZE) as f:
+                f.write(EXPORT_MAGIC)
+                for kind in kinds:
+                    kind_idx: int = STORE_KINDS.index(kind)
+                    async for account_id, updated, data in self.iter_compressed(kind):
+                        records.append((kind_idx, account_id, updated, data))
+                        if len(records) >= IMPORT_BATCH:
+                            await to_thread(_write_records, f, records)
+                            res += len(records)
+                            records = list()
+                await to_thread(_write_records, f, records)
+                res += len(records)
+                await to_thread(f.flush)
+            tmp_fn.replace(filename)
+        finally:
+            tmp_fn.unlink(missing_ok=True)
+        return res
+
+    async def import_stats(self, filename: Path) -> Tuple[int, int]:
+        """
+        Import stats exported with export_stats() keeping the newest stats
+        of each account. Returns the number of accounts' stats read and updated.
+        """
+        read: int = 0
+        updated: int = 0
+        batch: dict[StoreKind, List[Tuple[int, int, bytes]]] = {
+            kind: list() for kind in STORE_KINDS
+        }
+        with open(filename, "rb", buffering=EXPORT_BUFFER_SIZE) as f:
+            records: Iterator[_ExportRecord] = _iter_records(f, filename)
+            while len(chunk := await to_thread(_read_records, records)) > 0:
+                for kind_idx, account_id, ts, data in chunk:
+                    kind: StoreKind = STORE_KINDS[kind_idx]
+                    batch[kind].append((account_id, ts, data))
+                    read += 1
+                    if len(batch[kind]) >= IMPORT_BATCH:
+                        updated += await self.put_compressed(kind, batch[kind])
+                        batch[kind] = list()
+        for kind, items in batch.items():
+            if len(items) > 0:
+                updated += await self.put_compressed(kind, items)
+        return read, updated
+
+    async def put_many(
+        self,
+        kind: StoreKind,
+        items: Iterable[Tuple[int, bytes]],
+        updated: int | None = None,
+    ) -> None:
+        """Store stats JSON for several accounts"""
+        if updated is None:
+            updated = int(time())
+        await self.db.executemany(
+            """INSERT INTO stats (kind, account_id, updated, data) VALUES (?, ?, ?, ?)
+                ON CONFLICT (kind, account_id) DO UPDATE
+                SET updated = excluded.updated, data = excluded.data
+                WHERE excluded.updated >= stats.updated""",
+            [
+                (kind, account_id, updated, zlib.compress(data, STORE_COMPRESS_LEVEL))
+                for account_id, data in items
+            ],
+        )
+        await self.db.commit()
+
+
+def _write_records(f: BinaryIO, records: List[_ExportRecord]) -> None:
+    for kind_idx, account_id, updated, data in records:
+        f.write(_EXPORT_RECORD.pack(kind_idx, account_id, updated, len(data)))
+        f.write(data)
+
+
+def _iter_records(f: BinaryIO, filename: Path) -> Iterator[_ExportRecord]:
+    """Read (kind index, account_id, updated, data) records of a stats export file"""
+    if f.read(len(EXPORT_MAGIC)) != EXPORT_MAGIC:
+        raise ValueError(f"not a stats export file: {filename}")
+    while len(header := f.read(_EXPORT_RECORD.size)) == _EXPORT_RECORD.size:
+        kind_idx, account_id, updated, data_len = _EXPORT_RECORD.unpack(header)
+        if len(data := f.read(data_len)) != data_len:
+            raise EOFError(f"truncated record in {filename}: {account_id}")
+        yield kind_idx, account_id, updated, data
+    if len(header) > 0:
+        raise EOFError(f"truncated record header in {filename}")
+
+
+def _read_records(
+    records: Iterator[_ExportRecord], size: int = IMPORT_BATCH
+) -> List[_ExportRecord]:
+    return list(islice(records, size))
@@ -1,7 +1,9 @@
 import typer
 from typing import Annotated, Optional, List
+from asyncio import to_thread
 import logging
 from pathlib import Path
+from tempfile import TemporaryDirectory
 from configparser import ConfigParser
 from alive_progress import alive_bar  # type: ignore
 
@@ -13,6 +15,10 @@ from blitzmodels import (
 )
 from blitzmodels.wotinspector.wi_apiv2 import WoTinspector, Replay
 
+from .analyze import iter_chunks
+from .archive import iter_archive, member_name, member_path, split_archives
+from .ratelimit import RateLimiter, rate_limit_file
+
 app = AsyncTyper()
 
 logger = logging.getLogger()
@@ -65,12 +71,21 @@ async def upload(
         Optional[float],
         typer.Option(help="rate-limit for WoTinspector.com"),
     ] = None,
+    wi_rate_limit_fn: Annotated[
+        Optional[Path],
+        typer.Option(
+            "--wi-rate-limit-file",
+            show_default=False,
+            help="share WoTinspector.com rate-limit with other processes using the same file (default: WOTINSPECTOR.rate_limit_file config)",
+        ),
+    ] = None,
     wi_auth_token: Annotated[
         Optional[str],
         typer.Option(help="authentication token for WoTinsepctor.com"),
     ] = None,
     replays: List[Path] = typer.Argument(
-        help="replays to upload", callback=callback_paths
+        help="replays, directories or zip/tar archives to upload",
+        callback=callback_paths,
     ),
 ) -> int:
     """
@@ -84,6 +99,7 @@ async def upload(
         wi_rate_limit = set_config(
             config, WI_RATE_LIMIT, "WOTINSPECTOR", "rate_limit_upload", wi_rate_limit
         )
+        wi_rate_limit_fn = rate_limit_file(config, "WOTINSPECTOR", wi_rate_limit_fn)
         configWI = config["WOTINSPECTOR"]
         if wi_auth_token is None:
             wi_auth_token = configWI.get("auth_token", fallback=WI_AUTH_TOKEN)
@@ -109,53 +125,88 @@ async def upload(
         typer.Exit(code=7)
         raise SystemExit(7)
 
-    WI = WoTinspector(rate_limit=wi_rate_limit, auth_token=wi_auth_token)
+    # uploads are rate limited by rate_limiter
+    WI = WoTinspector(rate_limit=0, auth_token=wi_auth_token)
+    rate_limiter = RateLimiter(
+        "WoTinspector", rate=wi_rate_limit, filename=wi_rate_limit_fn
+    )
     stats = EventCounter("Upload replays")
+    archives: List[Path]
+    archives, replays = split_archives(replays)
     replayQ = FileQueue(filter="*.wotbreplay")
     await replayQ.mk_queue(replays)
 
     try:
+        await rate_limiter.open()
         with alive_bar(
-            replayQ.qsize(), title="Uploading replays", enrich_print=False
+            replayQ.qsize() if len(archives) == 0 else None,
+            title="Uploading replays",
+            enrich_print=False,
         ) as bar:
             async for fn in replayQ:
                 try:
-                    if not force and (fn.parent / (fn.name + ".json")).is_file():
-                        message(f"skipped {fn.name}: replay already uploaded")
-                        stats.log("skipped")
-                        continue
-
-                    replay: Replay | None = None
-                    if (
-                        replay := await WI.post_replay(
-                            replay=fn,
-                            tankopedia=tankopedia,
-                            maps=maps,
-                            priv=private,
-                        )
-                    ) is None:
-                        raise ValueError(f"could not upload replay: {fn}")
-                    message(f"posted {fn.name}: {replay.title}")
-                    stats.log("uploaded")
-                    # save JSON
-                    if (
-                        _ := await replay.save_json(fn.parent / (fn.name + ".json"))
-                    ) > 0:
-                        stats.log("JSON saved")
-                except KeyboardInterrupt:
-                    message("cancelled")
-                    raise
-                except Exception as err:
-                    error(f"could not post replay: {fn}: {type(err)}: {err}")
-                    stats.log("errors")
+                    await upload_replay(
+                        WI,
+                        rate_limiter=rate_limiter,
+                        replay_fn=fn,
+                        json_fn=fn.parent / (fn.name + ".json"),
+                        stats=stats,
+                        tankopedia=tankopedia,
+                        maps=maps,
+                        private=private,
+                        force=force,
+                    )
                 finally:
                     bar()
 
+            if len(archives) > 0:
+                # WoTinspector client uploads files: write one member at a time
+                with TemporaryDirectory() as tmp_dir:
+                    for archive in archives:
+                        try:
+                            # JSON files are named after the member paths so that
+                            # members in different directories do not overwrite each other
+                            async for name, data in iter_chunks(
+                                iter_archive(archive, filter="*.wotbreplay", paths=True)
+                            ):
+                                fn = Path(tmp_dir) / member_name(name)
+                                try:
+                                    json_fn: Path = archive.parent / (
+                                        member_path(name) + ".json"
+                                    )
+                                    if not force and json_fn.is_file():
+                                        message(
+                                            f"skipped {name}: replay already uploaded"
+                                        )
+                                        stats.log("skipped")
+                                        continue
+                                    await to_thread(fn.write_bytes, data)
+                                    await upload_replay(
+                                        WI,
+                                        rate_limiter=rate_limiter,
+                                        replay_fn=fn,
+                                        json_fn=json_fn,
+                                        stats=stats,
+                                        tankopedia=tankopedia,
+                                        maps=maps,
+                                        private=private,
+                                        force=True,
+                                    )
+                                finally:
+                                    fn.unlink(missing_ok=True)
+                                    bar()
+                        except KeyboardInterrupt:
+                            raise
+                        except Exception as err:
+                            error(f"could not read archive: {archive}: {err}")
+                            stats.log("archive errors")
+
     except Exception as err:
         error(f"{err}")
         typer.Exit(code=8)
         raise SystemExit(8)
     finally:
+        await rate_limiter.close()
         await WI.close()
 
     stats.print()
@@ -163,6 +214,51 @@ async def upload(
     return 0
 
 
+async def upload_replay(
+    WI: WoTinspector,
+    rate_limiter: RateLimiter,
+    replay_fn: Path,
+    json_fn: Path,
+    stats: EventCounter,
+    tankopedia: WGApiWoTBlitzTankopedia,
+    maps: Maps,
+    private: bool | None = False,
+    force: bool | None = False,
+) -> None:
+    """
+    Upload a replay to WoTinspector.com and save the replay JSON to 'json_fn'
+    """
+    try:
+        if not force and json_fn.is_file():
+            message(f"skipped {replay_fn.name}: replay already uploaded")
+            stats.log("skipped")
+            return None
+
+        replay: Replay | None = None
+        await rate_limiter.acquire()
+        if (
+            replay := await WI.post_replay(
+                replay=replay_fn,
+                tankopedia=tankopedia,
+                maps=maps,
+                priv=private,
+            )
+        ) is None:
+            raise ValueError(f"could not upload replay: {replay_fn}")
+        message(f"posted {replay_fn.name}: {replay.title}")
+        stats.log("uploaded")
+        # save JSON
+        if (_ := await replay.save_json(json_fn)) > 0:
+            stats.log("JSON saved")
+    except KeyboardInterrupt:
+        message("cancelled")
+        raise
+    except Exception as err:
+        error(f"could not post replay: {replay_fn}: {type(err)}: {err}")
+        stats.log("errors")
+    return None
+
+
 ########################################################
 #
 # main() entry
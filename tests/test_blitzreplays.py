@@ -1,12 +1,57 @@
 import pytest  # type: ignore
 from os.path import dirname, realpath
 from pathlib import Path
+from shutil import make_archive
 from typer.testing import CliRunner
 from click.testing import Result
-from typing import List
+from types import SimpleNamespace
+from array import array
+from datetime import datetime
+from math import inf
+from typing import Any, Dict, List, Tuple
+from zipfile import ZipFile
+import asyncio
+import json
 import logging
+import random
+
+from blitzmodels import Maps, WGApiWoTBlitzTankopedia
 
 from blitzreplays.blitzreplays import app
+from blitzreplays.replays import (
+    analyze as analyze_module,
+    cache as cache_module,
+    ratelimit as ratelimit_module,
+    retry as retry_module,
+    rows as rows_module,
+    store as store_module,
+)
+from blitzreplays.replays.archive import iter_archive, member_path
+from blitzreplays.replays.cache import APICache, TankStatsArray
+from blitzreplays.replays.models_fields import (
+    Fields,
+    HistogramField,
+    HistogramStore,
+    QuantileStore,
+    ValueStore,
+)
+from blitzreplays.replays.models_replay import (
+    EnrichedPlayerData,
+    EnrichedReplay,
+    ReplayHeader,
+)
+from blitzreplays.replays.models_reports import (
+    BucketCategorization,
+    DiffBucketCategorization,
+    StrCategorization,
+    TimeCategorization,
+)
+from blitzreplays.replays.plan import Plan
+from blitzreplays.replays.ratelimit import RateLimiter
+from blitzreplays.replays.retry import CircuitBreaker, RetryQueue, backoff
+from blitzreplays.replays.rows import ParquetTable, model_types
+from blitzreplays.replays.sketch import QuantileSketch
+from blitzreplays.replays.store import CLAIM_TTL, HISTORY_KEYFRAME, StatsStore
 
 logger = logging.getLogger()
 error = logger.error
@@ -152,9 +197,21 @@ def test_1_blitzreplays_upload(
         ),
         (["--stats-type", "tier", "files"]),
         (["--stats-type", "tank", "files"]),
+        (["--stats-type", "multi", "--fields", "+multi_stats", "files"]),
         (["--fields", "+extra", "files"]),
+        (["--fields", "+percentiles", "--reports", "+extra", "files"]),
+        (["--fields", "+distributions", "files", "--export"]),
+        (["files", "--json-reader", "text"]),
+        (["files", "--queue-size", "10"]),
+        (["files", "--spill-after", "1"]),
+        (["files", "--analyze-workers", "2"]),
+        (["files", "--analyze-workers", "2", "--spill-after", "1"]),
+        (["--stats-type", "tier", "files", "--historical-stats"]),
         (["--player", "521458531", "files"]),
+        (["files", "--filter", "date>=2023-12-29", "--filter", "battle_type=1"]),
+        (["files", "--filter", "tier=8,9,10", "--filter", "map!=Mines"]),
         (["--reports", "extra", "files"]),
+        (["--reports", "+time", "--fields", "+percentiles", "files", "--export"]),
         (
             [
                 "--reports",
@@ -251,3 +308,988 @@ def test_3_blitzreplays_analyze_info(
     assert (
         result.exit_code == 0
     ), f"blitzreplays analyze {' '.join(args)}: {result.output}"
+
+
+@REPLAY_ANALYZE_FILES
+def test_4_blitzreplays_pack(tmp_path: Path, datafiles: Path, analyze_dir: str) -> None:
+    pack_fn: Path = tmp_path / "replays.wotbpack"
+    for _ in range(2):  # second run appends nothing
+        result: Result = CliRunner().invoke(
+            app,
+            ["pack", str(pack_fn), f"{tmp_path}/{analyze_dir}"],
+            catch_exceptions=False,
+        )
+        assert result.exit_code == 0, f"blitzreplays pack failed: {result.output}"
+    assert pack_fn.is_file(), "replay pack was not created"
+
+    result = CliRunner().invoke(
+        app,
+        ["analyze", "files", str(pack_fn)],
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 0, f"blitzreplays analyze failed: {result.output}"
+
+
+@pytest.mark.parametrize("archive_format", ["zip", "gztar"])
+@REPLAY_ANALYZE_FILES
+def test_5_blitzreplays_analyze_archive(
+    tmp_path: Path, datafiles: Path, analyze_dir: str, archive_format: str
+) -> None:
+    archive: str = make_archive(
+        str(tmp_path / "replays"), archive_format, root_dir=tmp_path / analyze_dir
+    )
+    export_fn: Path = tmp_path / "export.csv"
+    result: Result = CliRunner().invoke(
+        app,
+        ["analyze", "files", "--export", "--filename", str(export_fn), archive],
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 0, f"blitzreplays analyze failed: {result.output}"
+    assert export_fn.is_file(), "CSV export file was not created"
+
+
+@pytest.mark.parametrize("stats_type", ["player", "tank"])
+@REPLAY_ANALYZE_FILES
+def test_6_blitzreplays_analyze_stats_cache(
+    tmp_path: Path, datafiles: Path, analyze_dir: str, stats_type: str
+) -> None:
+    stats_cache: Path = tmp_path / "stats.sqlite"
+    for _ in range(2):  # second run reads stats from the cache
+        result: Result = CliRunner().invoke(
+            app,
+            [
+                "analyze",
+                "--stats-type",
+                stats_type,
+                "files",
+                "--stats-cache",
+                str(stats_cache),
+                "--stats-cache-mem",
+                "1",
+                f"{tmp_path}/{analyze_dir}",
+            ],
+            catch_exceptions=False,
+        )
+        assert result.exit_code == 0, f"blitzreplays analyze failed: {result.output}"
+    assert stats_cache.is_file(), "stats cache was not created"
+
+
+@REPLAY_ANALYZE_FILES
+def test_7_blitzreplays_stats_prefetch(
+    tmp_path: Path, datafiles: Path, analyze_dir: str
+) -> None:
+    stats_cache: Path = tmp_path / "stats.sqlite"
+    result: Result = CliRunner().invoke(
+        app,
+        [
+            "stats",
+            "--stats-cache",
+            str(stats_cache),
+            "prefetch",
+            "--stats-type",
+            "tank",
+            f"{tmp_path}/{analyze_dir}",
+        ],
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 0, f"blitzreplays stats prefetch failed: {result.output}"
+    assert stats_cache.is_file(), "stats cache was not created"
+
+    export_fn: Path = tmp_path / "stats.export"
+    result = CliRunner().invoke(
+        app,
+        ["stats", "--stats-cache", str(stats_cache), "export", str(export_fn)],
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 0, f"blitzreplays stats export failed: {result.output}"
+    assert export_fn.is_file(), "stats export file was not created"
+
+    stats_cache = tmp_path / "imported.sqlite"
+    result = CliRunner().invoke(
+        app,
+        ["stats", "--stats-cache", str(stats_cache), "import", str(export_fn)],
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 0, f"blitzreplays stats import failed: {result.output}"
+
+    result = CliRunner().invoke(
+        app,
+        [
+            "analyze",
+            "--stats-type",
+            "tank",
+            "files",
+            "--stats-cache",
+            str(stats_cache),
+            f"{tmp_path}/{analyze_dir}",
+        ],
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 0, f"blitzreplays analyze failed: {result.output}"
+
+
+@REPLAY_ANALYZE_FILES
+def test_8_blitzreplays_analyze_export_rows(
+    tmp_path: Path, datafiles: Path, analyze_dir: str
+) -> None:
+    pq = pytest.importorskip("pyarrow.parquet")
+    rows_fn: Path = tmp_path / "rows.parquet"
+    result: Result = CliRunner().invoke(
+        app,
+        [
+            "analyze",
+            "files",
+            "--spill-after",
+            "1",
+            "--export-rows",
+            str(rows_fn),
+            f"{tmp_path}/{analyze_dir}",
+        ],
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 0, f"blitzreplays analyze failed: {result.output}"
+    replays: int = pq.read_table(rows_fn).num_rows
+    assert replays > 0, "no replay rows exported"
+    assert (
+        pq.read_table(tmp_path / "rows_players.parquet").num_rows > replays
+    ), "no player rows exported"
+
+
+def test_9_archive_member_paths(tmp_path: Path) -> None:
+    archive: Path = tmp_path / "replays.zip"
+    with ZipFile(archive, mode="w") as zf:
+        zf.writestr("a/replay.wotbreplay", b"1")
+        zf.writestr("b/replay.wotbreplay", b"2")
+        zf.writestr("b/notes.txt", b"3")
+    names: List[str] = [
+        member_path(name)
+        for name, _ in iter_archive(archive, filter="*.wotbreplay", paths=True)
+    ]
+    assert (
+        names == ["a_replay.wotbreplay", "b_replay.wotbreplay"]
+    ), f"archive members in different directories got the same name: {names}"
+    assert member_path("../c/./replay.wotbreplay") == "c_replay.wotbreplay"
+
+
+class DictStatsCache(APICache):
+    """APICache storing dict stats with deltas for testing the stats history"""
+
+    kind = "player"
+
+    def sizeof(self, stats: Dict[str, int]) -> int:
+        return 1
+
+    def dump(self, stats: Dict[str, int]) -> bytes:
+        return json.dumps(stats).encode()
+
+    def load(self, data: bytes) -> Dict[str, int]:
+        return json.loads(data)
+
+    def diff(self, prev: Dict[str, int], stats: Dict[str, int]) -> bytes | None:
+        return json.dumps({k: v - prev.get(k, 0) for k, v in stats.items()}).encode()
+
+    def patch(self, stats: Dict[str, int], delta: bytes) -> Dict[str, int]:
+        res: Dict[str, int] = dict(stats)
+        for k, v in json.loads(delta).items():
+            res[k] = res.get(k, 0) + v
+        return res
+
+    async def stats_worker(self, accountQ: Any) -> Any:
+        raise NotImplementedError
+
+    async def get_stats(self, query: Any) -> Any:
+        raise NotImplementedError
+
+
+def test_10_stats_history_import(tmp_path: Path, monkeypatch) -> None:
+    now: List[int] = [0]
+    monkeypatch.setattr(cache_module, "time", lambda: now[0])
+    export_fn: Path = tmp_path / "stats.export"
+
+    async def fetch(store: StatsStore, at: int, stats: Dict[str, int]) -> None:
+        now[0] = at
+        await DictStatsCache(None, store=store).cache_stats_many({1: stats})
+
+    async def snapshot(store: StatsStore, at: int) -> Dict[str, int] | None:
+        return await DictStatsCache(None, store=store).get_snapshot(1, at)
+
+    async def run() -> None:
+        async with StatsStore(tmp_path / "other.sqlite", ttl=0) as store:
+            await fetch(store, 1000, {"battles": 10, "wins": 5})
+            await store.export_stats(export_fn)
+
+        async with StatsStore(tmp_path / "stats.sqlite", ttl=0) as store:
+            await fetch(store, 500, {"battles": 1, "wins": 1})
+            assert await store.import_stats(export_fn) == (1, 1), "import failed"
+            await fetch(store, 2000, {"battles": 20, "wins": 9})
+            assert await snapshot(store, 500) == {"battles": 1, "wins": 1}
+            assert await snapshot(store, 1000) == {"battles": 10, "wins": 5}
+            assert await snapshot(store, 2000) == {"battles": 20, "wins": 9}
+
+            # a fetch in the same second replaces the snapshot
+            cache = DictStatsCache(None, store=store)
+            assert await cache.get_snapshot(1, 2000) == {"battles": 20, "wins": 9}
+            await cache.cache_stats_many({1: {"battles": 21, "wins": 9}})
+            now[0] = 3000
+            await cache.cache_stats_many({1: {"battles": 30, "wins": 15}})
+            assert await snapshot(store, 2000) == {"battles": 21, "wins": 9}
+            assert await snapshot(store, 3000) == {"battles": 30, "wins": 15}
+
+    asyncio.run(run())
+
+
+@pytest.fixture
+def clock(monkeypatch) -> List[float]:
+    """Fake monotonic clock of the retry module advanced by sleep()"""
+    now: List[float] = [100.0]
+
+    async def sleep(delay: float) -> None:
+        now[0] += delay
+
+    monkeypatch.setattr(retry_module, "monotonic", lambda: now[0])
+    monkeypatch.setattr(retry_module, "sleep", sleep)
+    monkeypatch.setattr(retry_module, "uniform", lambda low, high: high)
+    return now
+
+
+def test_11_retry_queue(clock: List[float]) -> None:
+    assert [backoff(attempt) for attempt in range(8)] == [1, 2, 4, 8, 16, 32, 60, 60]
+
+    retryQ: RetryQueue[str] = RetryQueue(max_attempts=3)
+    assert retryQ.put("a", 0), "first retry was not scheduled"
+    assert retryQ.put("b", 1), "second retry was not scheduled"
+    assert not retryQ.put("c", 2), "retry scheduled after the last attempt"
+    assert len(retryQ) == 2
+    assert retryQ.pop_due() == []
+    clock[0] += 1
+    assert retryQ.pop_due() == [("a", 1)]
+    clock[0] += 1
+    assert retryQ.pop_due() == [("b", 2)]
+
+    retryQ.put("d", 0)
+    start: float = clock[0]
+    assert asyncio.run(retryQ.get()) == ("d", 1)
+    assert clock[0] == start + 1, "get() did not wait for the retry to be due"
+    assert asyncio.run(retryQ.get()) is None
+
+
+def test_12_circuit_breaker(clock: List[float]) -> None:
+    breaker = CircuitBreaker(threshold=3, pause=10, max_pause=25)
+    assert not breaker.failure() and not breaker.failure()
+    assert breaker.failure(), "circuit did not open after 'threshold' failures"
+    assert breaker.is_open
+    assert not breaker.failure(), "circuit reopened while open"
+
+    start: float = clock[0]
+    asyncio.run(breaker.wait())
+    assert clock[0] == start + 10 and not breaker.is_open
+
+    # half-open: the first failure after the pause opens the circuit again
+    assert breaker.failure(), "circuit did not reopen after a failure"
+    clock[0] += 19.9
+    assert breaker.is_open, "pause was not doubled"
+    clock[0] += 0.1
+    assert breaker.failure()
+    clock[0] += 25
+    assert not breaker.is_open, "pause exceeds max_pause"
+
+    breaker.success()
+    assert not breaker.failure() and not breaker.failure()
+    assert breaker.failure()
+    clock[0] += 10
+    assert not breaker.is_open, "success() did not reset the pause"
+
+
+@pytest.mark.parametrize("shared", [False, True])
+def test_13_rate_limiter(tmp_path: Path, monkeypatch, shared: bool) -> None:
+    now: List[float] = [1000.0]
+    waits: List[float] = list()
+
+    async def sleep(delay: float) -> None:
+        waits.append(round(delay, 6))
+
+    monkeypatch.setattr(ratelimit_module, "monotonic", lambda: now[0])
+    monkeypatch.setattr(ratelimit_module, "time", lambda: now[0])
+    monkeypatch.setattr(ratelimit_module, "sleep", sleep)
+    filename: Path | None = tmp_path / "ratelimit.sqlite" if shared else None
+
+    async def run() -> None:
+        # limiters sharing a file share the tokens as do users of the same limiter
+        limiter = RateLimiter("WG API", rate=10, filename=filename)
+        other = RateLimiter("WG API", rate=10, filename=filename) if shared else limiter
+        async with limiter, other:
+            for rate_limiter in [limiter, other, limiter, other]:
+                await rate_limiter.acquire()
+            assert waits == [0.1, 0.2, 0.3], "tokens were not taken in advance"
+
+            now[0] += 10  # the bucket is refilled up to 'burst'
+            waits.clear()
+            await limiter.acquire()
+            await other.acquire()
+            assert waits == [0.1], f"bucket was not refilled to 'burst': {waits}"
+
+            async with RateLimiter("WoTinspector", rate=2, filename=filename) as wi:
+                waits.clear()
+                await wi.acquire()
+                await wi.acquire()
+                assert (
+                    waits == [0.5]
+                ), "rate limits with different names are not separate"
+
+            waits.clear()
+            unlimited = RateLimiter("unlimited", rate=0)
+            for _ in range(3):
+                await unlimited.acquire()
+            assert waits == [], "rate=0 should not limit requests"
+
+    asyncio.run(run())
+
+
+def test_14_stats_history(tmp_path: Path, monkeypatch) -> None:
+    now: List[int] = [0]
+    monkeypatch.setattr(cache_module, "time", lambda: now[0])
+    snapshots: Dict[int, Dict[str, int]] = dict()
+
+    async def run() -> None:
+        async with StatsStore(tmp_path / "stats.sqlite", ttl=0) as store:
+            cache = DictStatsCache(None, store=store)
+            for i in range(2 * HISTORY_KEYFRAME + 3):
+                now[0] = 1000 * (i + 1)
+                snapshots[now[0]] = {"battles": 10 * i, "wins": 5 * i + i % 3}
+                await cache.cache_stats_many({1: snapshots[now[0]]})
+                assert await store.history_latest("player", 1) == (
+                    now[0],
+                    i % (HISTORY_KEYFRAME + 1),
+                ), "a full snapshot was not stored every HISTORY_KEYFRAME snapshots"
+
+            cache = DictStatsCache(None, store=store)  # empty in-memory cache
+            for updated, stats in snapshots.items():
+                assert await cache.get_snapshot(1, updated) == stats
+                assert (
+                    await cache.get_snapshot(1, updated + 400) == stats
+                ), "snapshot nearest to the battle time was not used"
+            assert await cache.get_snapshot(2, 1000) is None
+
+    asyncio.run(run())
+
+
+def test_15_plan_player_mean() -> None:
+    buckets: List[int | float] = [0, 0.2, 0.4, 0.6]
+    labels: List[str] = ["0-20%", "20-40%", "40-60%", "60%-"]
+    allies = BucketCategorization(
+        name="Allies WR",
+        field="player.wr",
+        buckets=buckets,
+        bucket_labels=labels,
+        filter="allies:all",
+    )
+    platoon = BucketCategorization(
+        name="Platoon WR",
+        field="player.wr",
+        buckets=buckets,
+        bucket_labels=labels,
+        filter="player:platoon",
+    )
+    wr_diff = DiffBucketCategorization(
+        name="WR Diff",
+        field="player.wr",
+        buckets=[-1, -0.1, 0, 0.1],
+        bucket_labels=["< -10%", "-10-0%", "0-10%", "> 10%"],
+        filter="allies:default",
+        filter2="enemies:all",
+    )
+    plan = Plan()
+    for cat in [allies, platoon, wr_diff]:
+        cat.compile(plan)
+
+    async def run() -> None:
+        tankopedia = await WGApiWoTBlitzTankopedia.open_json(FIXTURE_DIR / TANKOPEDIA)
+        maps = await Maps.open_json(FIXTURE_DIR / MAPS)
+        assert tankopedia is not None and maps is not None, "could not read metadata"
+        no_platoon: int = 0
+        for fn in sorted((FIXTURE_DIR / "replays-analyze").glob("*.wotbreplay.json")):
+            replay = await EnrichedReplay.read_json(fn)
+            assert replay is not None, f"could not read replay: {fn.name}"
+            if not (await replay.enrich(tankopedia=tankopedia, maps=maps)).is_ok():
+                continue
+            for i, player in enumerate(replay.players_dict.values()):
+                player.wr = (i % 7) / 10  # some players without stats
+            if len(replay.plat_mate) == 0:
+                no_platoon += 1
+            values = plan.evaluate(replay)
+            for cat in [allies, platoon, wr_diff]:
+                assert cat._filter is not None
+                players = replay.get_players(cat._filter)
+                assert (
+                    cat.get_planned_float(values, cat._slot)
+                    == cat.get_category_float(replay, players)
+                ), f"{cat.name}: planned value differs: {fn.name}"
+                assert cat.get_category(replay, values) is cat.get_category(
+                    replay
+                ), f"{cat.name}: planned category differs: {fn.name}"
+        assert no_platoon > 0, "no solo replays to test players missing"
+
+    asyncio.run(run())
+
+
+@REPLAY_ANALYZE_FILES
+def test_16_blitzreplays_analyze_workers(
+    tmp_path: Path, datafiles: Path, analyze_dir: str, monkeypatch
+) -> None:
+    monkeypatch.setattr(analyze_module, "ANALYZE_BATCH", 5)  # several batches
+    stats_cache: Path = tmp_path / "stats.sqlite"
+    exports: List[str] = list()
+    for workers in ["1", "3"]:  # the second run reads stats from the cache
+        export_fn: Path = tmp_path / f"export_{workers}.csv"
+        result: Result = CliRunner().invoke(
+            app,
+            [
+                "analyze",
+                "files",
+                "--stats-cache",
+                str(stats_cache),
+                "--analyze-workers",
+                workers,
+                "--export",
+                "--filename",
+                str(export_fn),
+                f"{tmp_path}/{analyze_dir}",
+            ],
+            catch_exceptions=False,
+        )
+        assert result.exit_code == 0, f"blitzreplays analyze failed: {result.output}"
+        exports.append(export_fn.read_text(encoding="utf-8"))
+    assert (
+        exports[0] == exports[1]
+    ), "reports merged from analysis workers differ from serial analysis"
+
+
+def test_17_str_categorization_top_k() -> None:
+    report = StrCategorization(name="Maps", field="map", limit=1)  # tracks 10 maps
+
+    def add(map: str, replays: int = 1) -> None:
+        for _ in range(replays):
+            cat = report.get_category(SimpleNamespace(map=map, title=map))
+            assert cat is not None, f"no category for map={map}"
+            cat.replays += 1
+
+    for i in range(10):
+        add(f"map_{i}", i + 1)
+    add("new")
+    assert "map_0" not in report._categories, "the smallest category was not evicted"
+    assert (
+        report._categories["new"].replays == 2
+    ), "a new category did not inherit the evicted category's replays"
+    add("newer")  # 'map_1' and 'new' have 2 replays
+    assert (
+        "map_1" not in report._categories and "new" in report._categories
+    ), "eviction did not use the current replay counts"
+    assert len(report._categories) == 10
+    assert [key for key, _ in report.rows(Fields())] == ["map_9"]
+
+
+def test_18_str_categorization_sort_by() -> None:
+    fields = Fields()
+    fields.add("dmg", "Avg Dmg", "average", fields="damage_made", format=".0f")
+    report = StrCategorization(name="Maps", field="map", sort_by="dmg")
+    for map, dmg in [("a", 1000), ("b", 2000), ("c", None)]:
+        cat = report.get_category(SimpleNamespace(map=map, title=map))
+        assert cat is not None, f"no category for map={map}"
+        cat.replays += 1
+        if dmg is not None:
+            cat.record("dmg", ValueStore(dmg, 1))
+    assert [key for key, _ in report.rows(fields)] == [
+        "b",
+        "a",
+        "c",
+    ], "a category without values was not sorted last"
+    assert "dmg" not in report._categories["c"].values, "sorting added a value"
+
+
+def test_19_parquet_table_schema(tmp_path: Path, monkeypatch) -> None:
+    pq = pytest.importorskip("pyarrow.parquet")
+    monkeypatch.setattr(rows_module, "ROWS_BATCH", 2)
+    columns = model_types(EnrichedPlayerData, ["battles", "wr", "tank", "no_such"])
+    assert columns["no_such"] is None
+    table = ParquetTable(tmp_path / "rows.parquet", columns)
+    # the first batch has no values
+    for row in [[None] * 4, [None] * 4, [100, 0.5, "T-34", 1], [200, 1, "IS", "a"]]:
+        table.append(row)
+    table.close()
+    res = pq.read_table(tmp_path / "rows.parquet")
+    assert res.num_rows == 4, "rows were not written"
+    assert [str(field.type) for field in res.schema] == [
+        "int64",
+        "double",
+        "string",
+        "string",
+    ], f"schema was not declared from the column types: {res.schema}"
+    assert res.column("wr").to_pylist() == [None, None, 0.5, 1.0]
+    assert res.column("no_such").to_pylist() == [None, None, "1", "a"]
+
+
+ANALYZE_REPLAYS: List[Path] = sorted(
+    (FIXTURE_DIR / "replays-analyze").glob("*.wotbreplay.json")
+)
+
+
+def assert_header(header: ReplayHeader, replay: EnrichedReplay, name: str) -> None:
+    assert header.protagonist == replay.protagonist, f"wrong protagonist: {name}"
+    assert header.allies == replay.allies, f"wrong allies: {name}"
+    assert header.enemies == replay.enemies, f"wrong enemies: {name}"
+    assert (
+        header.account_ids == replay.allies + replay.enemies
+    ), f"wrong account_ids: {name}"
+
+
+@pytest.mark.parametrize("replay_fn", ANALYZE_REPLAYS, ids=lambda fn: fn.name[:13])
+def test_20_replay_header(replay_fn: Path) -> None:
+    data: bytes = replay_fn.read_bytes()
+    assert (
+        data.find(b'"allies"') < data.find(b'"players_data"')
+    ), "test replay's players are not before 'players_data'"
+    replay = EnrichedReplay.parse_bytes(data)
+    assert replay is not None, f"could not parse replay: {replay_fn.name}"
+    assert_header(ReplayHeader.from_bytes(data), replay, replay_fn.name)
+
+
+def test_21_replay_header_fallback() -> None:
+    replay_fn: Path = ANALYZE_REPLAYS[0]
+    data: Dict[str, Any] = json.loads(replay_fn.read_bytes())
+    # 'players_data' first: the header scan stops there and parses the full JSON
+    reordered: bytes = json.dumps(
+        {"players_data": data.pop("players_data")} | data
+    ).encode()
+    replay = EnrichedReplay.parse_bytes(reordered)
+    assert replay is not None, f"could not parse replay: {replay_fn.name}"
+    assert_header(ReplayHeader.from_bytes(reordered), replay, replay_fn.name)
+
+    truncated: bytes = replay_fn.read_bytes()
+    truncated = truncated[: truncated.find(b'"enemies"')]
+    with pytest.raises(ValueError):
+        ReplayHeader.from_bytes(truncated)
+
+
+@pytest.fixture
+def tank_stats() -> List[Tuple[int, int, int, int]]:
+    """(tank_id, battles, wins, damage_dealt) rows sorted by tank_id"""
+    return [
+        (16 * i + 1, 10 * i + 1, 5 * i + i % 3, 1200 * (10 * i + 1)) for i in range(50)
+    ]
+
+
+@pytest.fixture
+def tank_tiers(tank_stats: List[Tuple[int, int, int, int]]) -> Dict[int, int]:
+    # some tanks are missing from the tankopedia
+    return {row[0]: i % 10 + 1 for i, row in enumerate(tank_stats) if i % 7 != 0}
+
+
+def test_22_tank_stats_array(
+    tank_stats: List[Tuple[int, int, int, int]], tank_tiers: Dict[int, int]
+) -> None:
+    stats = TankStatsArray(7, reversed(tank_stats), tank_tiers)
+    assert list(stats.rows()) == tank_stats, "rows were not sorted by tank_id"
+
+    copy = TankStatsArray.from_bytes(stats.to_bytes(), tank_tiers)
+    assert copy.account_id == 7
+    assert list(copy.rows()) == tank_stats, "to_bytes()/from_bytes() changed rows"
+    assert copy.tiers == stats.tiers
+
+    for tank_id, battles, wins, damage in tank_stats:
+        ps = stats.get_tank_stat(tank_id)
+        assert ps.tank_id == tank_id and ps.battles == battles
+        assert ps.wr == wins / battles and ps.avgdmg == damage / battles
+    for tank_id in [0, 2, 16 * 50 + 1]:  # before, between and after the tanks
+        assert stats.get_tank_stat(tank_id).battles == 0, f"tank_id={tank_id} found"
+
+    tiers: Dict[int, List[int]] = dict()
+    for tank_id, battles, wins, damage in tank_stats:
+        tier: int = tank_tiers.get(tank_id, 0)
+        sums: List[int] = tiers.setdefault(tier, [0, 0, 0])
+        sums[0] += battles
+        sums[1] += wins
+        sums[2] += damage
+    for tier in range(11):
+        ps = stats.get_tier_stats(tier)
+        battles, wins, damage = tiers.get(tier, [0, 0, 0])
+        assert ps.tier == tier and ps.battles == battles, f"tier={tier}"
+        if battles > 0:
+            assert ps.wr == wins / battles and ps.avgdmg == damage / battles
+    assert stats.get_player_stats().battles == sum(row[1] for row in tank_stats)
+
+
+def test_23_tank_stats_array_diff(
+    tank_stats: List[Tuple[int, int, int, int]], tank_tiers: Dict[int, int]
+) -> None:
+    prev = TankStatsArray(7, tank_stats, tank_tiers)
+    assert TankStatsArray(7, tank_stats, tank_tiers).diff(prev) == []
+
+    rows: List[Tuple[int, int, int, int]] = list(tank_stats)
+    rows[3] = (rows[3][0], rows[3][1] + 2, rows[3][2] + 1, rows[3][3] + 3000)
+    rows.append((10000, 1, 0, 500))  # a new tank
+    assert TankStatsArray(7, rows, tank_tiers).diff(prev) == [
+        (rows[3][0], 2, 1, 3000),
+        (10000, 1, 0, 500),
+    ], "wrong stats differences"
+
+    assert (
+        TankStatsArray(7, tank_stats[1:], tank_tiers).diff(prev) is None
+    ), "diff() did not return None when a tank was removed"
+    rows = list(tank_stats)
+    rows[0] = (rows[0][0], rows[0][1] - 1, rows[0][2], rows[0][3])
+    assert (
+        TankStatsArray(7, rows, tank_tiers).diff(prev) is None
+    ), "diff() did not return None when stats decreased"
+
+
+def test_24_reset_claims(tmp_path: Path, monkeypatch) -> None:
+    now: List[int] = [1000]
+    monkeypatch.setattr(cache_module, "time", lambda: now[0])
+    monkeypatch.setattr(store_module, "time", lambda: now[0])
+
+    async def run() -> None:
+        async with StatsStore(tmp_path / "stats.sqlite", ttl=100) as store:
+            cache = DictStatsCache(None, store=store)
+            assert await cache.claim(1), "could not claim an account"
+            await cache.cache_stats_many({1: {"battles": 1}})
+            await cache.release([1])
+            assert not await cache.claim(1), "an account was claimed twice"
+            cache.reset_claims()
+            assert not await cache.claim(1), "up-to-date stats were claimed"
+            now[0] += 101  # the stats expire
+            assert not await cache.claim(1), "a claimed account was claimed again"
+            cache.reset_claims()
+            assert await cache.claim(1), "expired stats were not claimed after reset"
+
+    asyncio.run(run())
+
+
+def test_25_plan_shared_subexpressions() -> None:
+    fields = Fields()
+    fields.add(
+        "wr_diff",
+        "WR Diff",
+        "difference",
+        fields="player.wr",
+        format=".1%",
+        filter="allies:default",
+        filter2="enemies:all",
+    )
+    fields.add(
+        "allies_wr",
+        "Allies WR",
+        "average",
+        fields="player.wr",
+        format=".1%",
+        filter="allies:default",
+    )
+    plan = Plan()
+    fields.compile(plan)
+    size: int = len(plan)
+    wr_diff = DiffBucketCategorization(
+        name="WR Diff",
+        field="player.wr",
+        buckets=[-1, 0],
+        bucket_labels=["< 0%", "> 0%"],
+        filter="allies:default",
+        filter2="enemies:all",
+    )
+    wr_diff.compile(plan)
+    # the means use the players' sums the fields added
+    assert len(plan) == size + 2, "the report did not reuse the fields' subexpressions"
+
+    replay = SimpleNamespace(
+        player=1,
+        players_dict={
+            p: SimpleNamespace(wr=wr)
+            for p, wr in [(1, 0.6), (2, 0.5), (3, 0), (4, 0.4), (5, 0.45)]
+        },
+        get_players=lambda filter: [2, 3] if filter.team == "allies" else [4, 5],
+        title="test",
+        title_uniq="test",
+    )
+    values = plan.evaluate(replay)
+    assert values[wr_diff._slot] == 0.5, "players without stats were averaged"
+    assert values[wr_diff._slot2] == pytest.approx(0.425)
+    assert dict(fields.calc(replay, values))["wr_diff"].value == pytest.approx(-0.175)
+
+    uncompiled = Fields()
+    uncompiled.add("battles", "Battles", "count", fields="exp", format=".0f")
+    with pytest.raises(AssertionError):
+        list(uncompiled.calc(replay))  # type: ignore
+
+
+SKETCH_VALUES: int = 20000
+SKETCH_ERROR: float = 0.02  # max rank error
+
+
+def assert_sketch(sketch: QuantileSketch) -> None:
+    assert len(sketch) == SKETCH_VALUES, "values were lost"
+    assert sketch._size < sketch._max_size, "the sketch was not compressed"
+    for q in [0.01, 0.1, 0.25, 0.5, 0.75, 0.9, 0.99]:
+        rank: float = sketch.quantile(q) / SKETCH_VALUES
+        assert abs(rank - q) <= SKETCH_ERROR, f"q={q}: rank={rank}"
+
+
+def test_26_quantile_sketch() -> None:
+    random.seed(42)
+    values: List[int] = list(range(SKETCH_VALUES))
+    random.shuffle(values)
+    sketch = QuantileSketch()
+    for value in values:
+        sketch.add(value)
+    assert_sketch(sketch)
+    assert_sketch(QuantileSketch(values))
+    assert QuantileSketch().quantile(0.5) == inf, "empty sketch did not return inf"
+
+
+def test_27_quantile_sketch_merge() -> None:
+    random.seed(42)
+    values: List[int] = list(range(SKETCH_VALUES))
+    random.shuffle(values)
+    parts: List[List[int]] = [values[i::4] for i in range(4)]
+    for order in [[0, 1, 2, 3], [3, 2, 1, 0], [2, 0, 3, 1]]:
+        sketch = QuantileSketch()
+        for i in order:
+            part = QuantileSketch()
+            for value in parts[i]:
+                part.add(value)
+            sketch.merge(part)
+        assert_sketch(sketch)
+    sketch = QuantileSketch(values)
+    sketch.merge(QuantileSketch())
+    assert_sketch(sketch)
+
+
+HISTOGRAM_BINS: List[float] = [0, 1000, 2000]
+HISTOGRAM_VALUES: List[Tuple[float, int]] = [
+    (-5, 0),  # below the range
+    (0, 0),
+    (999, 0),
+    (1000, 1),  # on a bin edge
+    (1999.9, 1),
+    (2000, 2),
+    (5000, 2),  # above the range
+]
+
+
+def test_28_histogram_field() -> None:
+    fields = Fields()
+    field = fields.add(
+        "dmg_histogram",
+        "DPB",
+        "histogram",
+        fields="exp",
+        format=".0%",
+        bins=HISTOGRAM_BINS,
+    )
+    assert isinstance(field, HistogramField)
+    assert field.bin_labels == ["0-1000", "1000-2000", "2000+"]
+    for value, bin in HISTOGRAM_VALUES:
+        assert field._bin(value) == bin, f"value={value} went to a wrong bin"
+        res = field.calc(SimpleNamespace(exp=value, title="test"))  # type: ignore
+        assert isinstance(res, HistogramStore)
+        assert list(res.counts) == [int(i == bin) for i in range(3)]
+        assert (res.value, res.n) == (value, 1)
+
+    players = fields.add(
+        "players_histogram",
+        "DPB",
+        "histogram",
+        fields="player.damage_made",
+        format=".0%",
+        filter="allies:default",
+        bins=HISTOGRAM_BINS,
+    )
+    plan = Plan()
+    calc = players.compile(plan)
+    replay = SimpleNamespace(
+        player=0,
+        players_dict={
+            p: SimpleNamespace(damage_made=value)
+            for p, (value, _) in enumerate(HISTOGRAM_VALUES)
+        },
+        get_players=lambda filter: list(range(1, len(HISTOGRAM_VALUES))),
+        title="test",
+        title_uniq="test",
+    )
+    res = calc(replay, plan.evaluate(replay))  # type: ignore
+    assert isinstance(res, HistogramStore)
+    assert list(res.counts) == [2, 2, 2], "compiled bins do not match"
+    assert list(res.counts) == list(players.calc(replay).counts)  # type: ignore
+    assert res.n == len(HISTOGRAM_VALUES) - 1
+
+
+def test_29_histogram_store() -> None:
+    a = HistogramStore(1000, 2, array("q", [1, 1, 0]))
+    b = HistogramStore(4000, 2, array("q", [0, 1, 1]))
+    total = HistogramStore()
+    total.record(a)
+    assert list(total.counts) == [1, 1, 0], "counts were not extended"
+    total.record(b)
+    assert (total.value, total.n) == (5000, 4)
+    assert list(total.counts) == [1, 2, 1]
+    total.record(ValueStore(100, 1))  # a plain value does not touch the bins
+    assert list(total.counts) == [1, 2, 1]
+    total.remove(ValueStore(100, 1))
+    total.remove(a)
+    assert (total.value, total.n) == (4000, 2)
+    assert list(total.counts) == list(b.counts), "counts were not removed"
+
+    field = HistogramField(
+        key="hist", name="Hist", fields="exp", format=".0%", bins=HISTOGRAM_BINS
+    )
+    assert field.shares(total) == [0, 0.5, 0.5]
+    assert field.shares(HistogramStore()) == [0, 0, 0], "empty store has shares"
+
+
+TIME_REPLAYS: List[Tuple[datetime, int, int]] = [
+    (datetime(2024, 1, 1, 20, 0, 0), 1001, 1000),
+    (datetime(2024, 1, 1, 20, 0, 0), 1002, 2000),  # started in the same second
+    (datetime(2024, 1, 2, 18, 30, 0), 1003, 3000),
+    (datetime(2024, 1, 3, 12, 0, 0), 1004, 4000),
+    (datetime(2024, 1, 3, 12, 10, 0), 1005, 5000),
+]
+
+
+def record_time(report: TimeCategorization) -> None:
+    for battle_time, arena_id, dmg in TIME_REPLAYS:
+        replay = SimpleNamespace(
+            battle_start_time=battle_time, arena_unique_id=arena_id, title="test"
+        )
+        cat = report.get_category(replay)  # type: ignore
+        assert cat is not None, f"no category for battle={arena_id}"
+        cat.replays += 1
+        cat.record("dmg", ValueStore(dmg, 1))
+        cat.record("dmg_median", QuantileStore(dmg, 1, QuantileSketch([dmg])))
+
+
+def test_30_time_categorization() -> None:
+    fields = Fields()
+    report = TimeCategorization(name="Day", period="day")
+    record_time(report)
+    assert [(key, cat.replays) for key, cat in report.rows(fields)] == [
+        ("2024-01-01", 2),
+        ("2024-01-02", 1),
+        ("2024-01-03", 2),
+    ]
+
+    report = TimeCategorization(name="Battle", period="battle")
+    record_time(report)
+    assert [key for key, _ in report.rows(fields)] == [
+        "2024-01-01 20:00:00 1001",
+        "2024-01-01 20:00:00 1002",
+        "2024-01-02 18:30:00 1003",
+        "2024-01-03 12:00:00 1004",
+        "2024-01-03 12:10:00 1005",
+    ], "battles in the same second were not kept separate"
+
+
+def test_31_time_categorization_window() -> None:
+    fields = Fields()
+    for period, window, expected in [
+        ("battle", 2, [(1, 1000), (2, 3000), (2, 5000), (2, 7000), (2, 9000)]),
+        ("day", 2, [(2, 3000), (3, 6000), (3, 12000)]),
+        ("day", 5, [(2, 3000), (3, 6000), (5, 15000)]),
+    ]:
+        report = TimeCategorization(name="Trend", period=period, window=window)
+        record_time(report)
+        rows: List[Tuple[int, int | float]] = list()
+        for _, cat in report.rows(fields):  # a rolling row is valid until the next
+            dmg: ValueStore = cat.values["dmg"]
+            median = cat.values["dmg_median"]
+            assert isinstance(median, QuantileStore)
+            assert (
+                dmg.n == cat.replays == median.n == len(median.sketch)
+            ), f"period={period}, window={window}: values outside the window"
+            rows.append((cat.replays, dmg.value))
+        assert rows == expected, f"period={period}, window={window}"
+
+
+def test_32_claimed_stats_expire(tmp_path: Path, monkeypatch) -> None:
+    now: List[int] = [1000]
+    monkeypatch.setattr(cache_module, "time", lambda: now[0])
+    monkeypatch.setattr(store_module, "time", lambda: now[0])
+
+    async def run() -> None:
+        async with StatsStore(tmp_path / "stats.sqlite", ttl=100) as store:
+            await DictStatsCache(None, store=store).cache_stats_many(
+                {1: {"battles": 1}}
+            )
+            now[0] += 50
+            cache = DictStatsCache(None, store=store)
+            assert not await cache.claim(1), "up-to-date stats were claimed"
+            now[0] += 51  # the stats expire before they are read
+            assert await cache.get_cached(1) == {
+                "battles": 1
+            }, "stats found at claim time were not read"
+            assert (
+                await DictStatsCache(None, store=store).get_cached(1) is None
+            ), "expired stats were read without a claim"
+
+    asyncio.run(run())
+
+
+def test_33_stats_without_store() -> None:
+    async def run() -> None:
+        cache = DictStatsCache(None, max_bytes=1)
+        assert await cache.claim(1), "could not claim an account"
+        assert not await cache.claim(1), "an account was claimed twice"
+        await cache.cache_stats_many({1: {"battles": 1}, 2: {"battles": 2}})
+        await cache.release([1])
+        assert await cache.get_cached(1) == {"battles": 1}, "stats were evicted"
+        assert await cache.get_cached(2, at=1000) == {"battles": 2}
+        assert await cache.get_cached(3) is None
+
+    asyncio.run(run())
+
+
+def test_34_reclaim(tmp_path: Path, monkeypatch) -> None:
+    now: List[int] = [1000]
+    monkeypatch.setattr(store_module, "time", lambda: now[0])
+    fn: Path = tmp_path / "stats.sqlite"
+
+    async def run() -> None:
+        async with StatsStore(fn) as store, StatsStore(fn) as other:
+            cache = DictStatsCache(None, store=store)
+            assert await cache.claim(1) and await cache.claim(2)
+            now[0] += CLAIM_TTL - 1
+            assert await cache.reclaim([1]) == {1}, "a claim was not refreshed"
+            now[0] += 2  # the claim of account 2 expires
+            assert not await other.claim("player", 1), "a refreshed claim expired"
+            assert await other.claim("player", 2), "an expired claim was kept"
+            assert await cache.reclaim([1, 2]) == {
+                1
+            }, "an account claimed by another process was reclaimed"
+
+    asyncio.run(run())
+
+
+def test_35_stats_export(tmp_path: Path) -> None:
+    export_fn: Path = tmp_path / "stats.export"
+    accounts: int = 2500  # several export and import batches
+
+    async def run() -> None:
+        async with StatsStore(tmp_path / "other.sqlite", ttl=0) as store:
+            for kind in ["player", "tank"]:
+                await store.put_many(
+                    kind,  # type: ignore
+                    [(i, f"{kind} {i}".encode()) for i in range(accounts)],
+                    updated=1000,
+                )
+            assert await store.export_stats(export_fn) == 2 * accounts
+
+        async with StatsStore(tmp_path / "stats.sqlite", ttl=0) as store:
+            assert await store.import_stats(export_fn) == (2 * accounts, 2 * accounts)
+            assert await store.get("tank", 2000) == b"tank 2000"
+            assert await store.get("player", 0) == b"player 0"
+
+            data: bytes = export_fn.read_bytes()
+            export_fn.write_bytes(data[:-1])
+            with pytest.raises(EOFError):
+                await store.import_stats(export_fn)
+            export_fn.write_bytes(data[1:])
+            with pytest.raises(ValueError):
+                await store.import_stats(export_fn)
+
+    asyncio.run(run())